@@ -0,0 +1,100 @@
+'''
+Latency of appending lists of events to event store.
+
+Usage: python benchmarks/bench_append.py [lists] [size]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), bench_events and bench_dispatch tables are recreated there.
+Given number of event lists (200 by default) of given size (1, 10 and 300 by
+default, as after archive upload) are appended as before: INSERT per event
+in interaction with per row dispatch trigger, and by PGSQLAppendOnlyStore
+with one INSERT per list and statement trigger.
+'''
+import sys
+import time
+from datetime import datetime
+
+from twisted.internet import reactor, defer
+
+from gorynych import OPTS
+from gorynych.common.infrastructure.dbpool import AsyncConnectionPool
+from gorynych.eventstore import store
+
+store.EVENTS_TABLE = 'bench_events'
+store.DISPATCH_TABLE = 'bench_dispatch'
+store.FUNC_NAME = 'bench_add_to_dispatch'
+store.TRIGGER_NAME = 'bench_to_dispatch'
+
+OLD_INSERT = """
+    INSERT INTO bench_events
+    (EVENT_NAME, AGGREGATE_ID, AGGREGATE_TYPE, EVENT_PAYLOAD, OCCURED_ON)
+    VALUES (%s, %s, %s, %s, %s);
+    """
+
+OLD_TRIGGER = """
+    CREATE OR REPLACE FUNCTION bench_add_to_dispatch() RETURNS TRIGGER AS $$
+        BEGIN
+          INSERT INTO bench_dispatch (EVENT_ID, EVENT_NAME)
+            VALUES (NEW.EVENT_ID, NEW.EVENT_NAME);
+          PERFORM pg_notify('dispatch', NEW.EVENT_NAME);
+          RETURN NEW;
+        END;
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER bench_to_dispatch ON bench_events;
+    CREATE TRIGGER bench_to_dispatch AFTER INSERT ON bench_events
+    FOR EACH ROW EXECUTE PROCEDURE bench_add_to_dispatch();
+    """
+
+
+def event_list(size):
+    return [dict(event_name='ParagliderFoundInArchive',
+        aggregate_id='race-%s' % i, aggregate_type='race',
+        event_payload=buffer('payload' * 10), occured_on=datetime.now())
+        for i in xrange(size)]
+
+
+def old_append(cur, evlist):
+    for ev in evlist:
+        cur.execute(cur.mogrify(OLD_INSERT, (ev['event_name'],
+            ev['aggregate_id'], ev['aggregate_type'], ev['event_payload'],
+            ev['occured_on'])))
+
+
+@defer.inlineCallbacks
+def measure(append, lists, size):
+    evlist = event_list(size)
+    t = time.time()
+    for i in xrange(lists):
+        yield append(evlist)
+    defer.returnValue((time.time() - t) / lists * 1000)
+
+
+@defer.inlineCallbacks
+def main(lists=200, size=None):
+    pool = AsyncConnectionPool(min=2, host=OPTS['dbhost'],
+        database=OPTS['dbname'], user=OPTS['dbuser'],
+        password=OPTS['dbpassword'])
+    aos = store.PGSQLAppendOnlyStore(pool)
+    for size in ([size] if size else [1, 10, 300]):
+        yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+            "bench_events CASCADE")
+        yield aos.initialize()
+        yield pool.runOperation(OLD_TRIGGER)
+        mean = yield measure(lambda evlist: pool.runInteraction(old_append,
+            evlist), lists, size)
+        print "%s events, INSERT per event: %0.2f ms/list" % (size, mean)
+        yield aos.initialize()
+        mean = yield measure(aos.append, lists, size)
+        print "%s events, one INSERT: %0.2f ms/list" % (size, mean)
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events CASCADE")
+    pool.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -0,0 +1,80 @@
+'''
+Memory and time spent on track point buffers for many online tracks.
+
+Usage: python benchmarks/bench_buffers.py [tracks] [hours]
+
+Every track gets a minute of points (one point per second) per cycle, as
+OnlineTrashService does. Track state buffer and processed points are kept
+as it was done before (create_uniq_hstack over whole history) and with
+RingBuffer. Buffer sizes and cycle time are printed per hour of flight.
+'''
+import sys
+import time
+
+import numpy as np
+
+from gorynych.processor.domain import track
+from gorynych.processor.domain.services import create_uniq_hstack
+
+
+class Legacy(object):
+    def __init__(self):
+        self._buffer = np.empty(0, dtype=track.DTYPE)
+        self.processed = np.empty(0, dtype=track.DTYPE)
+
+    def append(self, points):
+        self._buffer = create_uniq_hstack(self._buffer, points)
+        self.processed = create_uniq_hstack(self.processed, points)[-100:]
+
+    def nbytes(self):
+        return self._buffer.nbytes + self.processed.nbytes
+
+
+class Ring(object):
+    def __init__(self):
+        self.trck = track.Track(track.TrackID(), [])
+        self.state = self.trck._state
+
+    def append(self, points):
+        self.state.points_buffer.append(points)
+        self.trck._processed.append(points)
+
+    def nbytes(self):
+        return self.state.points_buffer._storage.nbytes + \
+            self.trck._processed._storage.nbytes
+
+
+def minute(n):
+    points = np.zeros(60, dtype=track.DTYPE)
+    points['timestamp'] = np.arange(n * 60, (n + 1) * 60)
+    points['alt'] = np.random.randint(500, 2000, 60)
+    return points
+
+
+def main(tracks, hours):
+    legacy = [Legacy() for i in xrange(tracks)]
+    ring = [Ring() for i in xrange(tracks)]
+    print '%5s %14s %14s %12s %12s' % ('hour', 'legacy, MB', 'ring, MB',
+        'legacy, ms', 'ring, ms')
+    for hour in xrange(hours):
+        spent = [0, 0]
+        for m in xrange(hour * 60, (hour + 1) * 60):
+            points = minute(m)
+            for i, bufs in enumerate((legacy, ring)):
+                t = time.time()
+                for buf in bufs:
+                    buf.append(points)
+                spent[i] += time.time() - t
+        for buf1, buf2 in zip(legacy, ring):
+            assert (buf1._buffer[-60:] == buf2.state._buffer[-60:]).all()
+            assert (buf1.processed == buf2.trck.processed).all()
+        print '%5d %14.1f %14.1f %12.1f %12.1f' % (hour + 1,
+            sum(b.nbytes() for b in legacy) / 1048576.,
+            sum(b.nbytes() for b in ring) / 1048576.,
+            spent[0] * 1000 / 60, spent[1] * 1000 / 60)
+
+
+if __name__ == '__main__':
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    main(tracks, hours)
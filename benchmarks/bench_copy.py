@@ -0,0 +1,54 @@
+'''
+Encoding of track points for COPY.
+
+Usage: python benchmarks/bench_copy.py [points]
+
+Rows per second of np_as_text as it was before (repr of every value),
+vectorized np_as_text and np_as_binary for a parsed competition track
+sized array (40k points by default).
+'''
+import sys
+import timeit
+from io import BytesIO
+
+import numpy as np
+
+from gorynych.common.infrastructure.persistence import np_as_text, \
+    np_as_binary
+from gorynych.processor.domain.track import DTYPE
+
+
+def np_as_text_repr(data):
+    cpy = BytesIO()
+    for row in data:
+        cpy.write('\t'.join([repr(x) for x in row]) + '\n')
+    cpy.seek(0)
+    return(cpy)
+
+
+def points(n):
+    np.random.seed(0)
+    result = np.empty(n, dtype=DTYPE)
+    result['id'] = 42
+    result['timestamp'] = np.arange(1374223800, 1374223800 + n)
+    result['lat'] = 42.6 + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+    result['lon'] = 24.7 + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+    result['alt'] = np.random.randint(500, 3000, n)
+    result['g_speed'] = np.random.uniform(0, 20, n)
+    result['v_speed'] = np.random.uniform(-5, 5, n)
+    result['distance'] = np.random.randint(0, 100000, n)
+    return result
+
+
+def main(n):
+    data = points(n)
+    print '%16s %14s %10s' % ('encoder', 'rows/s', 'MB')
+    for func in (np_as_text_repr, np_as_text, np_as_binary):
+        timer = timeit.Timer(lambda: func(data))
+        best = min(timer.repeat(3, 1))
+        size = len(func(data).getvalue()) / 1048576.
+        print '%16s %14.0f %10.2f' % (func.__name__, n / best, size)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 40000)
@@ -0,0 +1,112 @@
+'''
+Throughput of claiming undispatched events.
+
+Usage: python benchmarks/bench_dispatch.py [events] [consumers]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), bench_events and bench_dispatch tables are recreated there.
+Given number of events (10000 by default) of as many names as consumers (3
+by default) is queued, then the queue is drained by consumers which claim
+events and delete them as dispatched: by one consumer with the old claim
+(SELECT ... LIMIT 5 FOR UPDATE and UPDATE per row) and with the new one for
+several batch sizes, and by consumers subscribed to different event names
+at the same time.
+'''
+import sys
+import time
+
+from twisted.internet import reactor, defer
+
+from gorynych import OPTS
+from gorynych.common.infrastructure.dbpool import AsyncConnectionPool
+from gorynych.eventstore import store
+
+store.EVENTS_TABLE = 'bench_events'
+store.DISPATCH_TABLE = 'bench_dispatch'
+store.FUNC_NAME = 'bench_add_to_dispatch'
+store.TRIGGER_NAME = 'bench_to_dispatch'
+
+OLD_CLAIM = """
+    SELECT e.event_id, e.event_name, e.aggregate_id, e.aggregate_type,
+    e.event_payload, e.occured_on
+    FROM bench_events e, bench_dispatch d
+    WHERE e.event_id = d.event_id
+        AND d.taken = false
+        ORDER BY d.time
+        LIMIT 5
+        FOR UPDATE;
+    """
+
+DISPATCHED = "DELETE FROM bench_dispatch WHERE event_id = ANY(%s)"
+
+
+@defer.inlineCallbacks
+def queue_events(pool, aos, number, names):
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events CASCADE")
+    yield aos.initialize()
+    yield pool.runOperation("INSERT INTO bench_events (event_name, "
+        "aggregate_id, aggregate_type, event_payload, occured_on) SELECT "
+        "'Event' || (i %% %s), 'aggregate-' || i, 'bench', 'payload', now() "
+        "FROM generate_series(1, %s) i", (names, number))
+    yield pool.runOperation("ANALYZE bench_dispatch")
+
+
+def old_claim(cur):
+    cur.execute(OLD_CLAIM)
+    rows = cur.fetchall()
+    for row in rows:
+        cur.execute("UPDATE bench_dispatch SET TAKEN=TRUE "
+                    "WHERE event_id=%s" % (row[0],))
+    return rows
+
+
+@defer.inlineCallbacks
+def drain(pool, claim):
+    while True:
+        rows = yield claim()
+        if not rows:
+            break
+        yield pool.runOperation(DISPATCHED, ([row[0] for row in rows],))
+
+
+@defer.inlineCallbacks
+def measure(pool, aos, number, claims):
+    yield queue_events(pool, aos, number, len(claims))
+    t = time.time()
+    yield defer.gatherResults([drain(pool, claim) for claim in claims])
+    defer.returnValue(number / (time.time() - t))
+
+
+@defer.inlineCallbacks
+def main(number=10000, consumers=3):
+    pool = AsyncConnectionPool(min=consumers * 2, host=OPTS['dbhost'],
+        database=OPTS['dbname'], user=OPTS['dbuser'],
+        password=OPTS['dbpassword'])
+    aos = store.PGSQLAppendOnlyStore(pool)
+    names = ['Event%s' % i for i in range(consumers)]
+
+    rate = yield measure(pool, aos, number,
+        [lambda: pool.runInteraction(old_claim)])
+    print "old claim, 1 consumer: %0.0f events/s" % rate
+    for limit in (5, 100, 1000):
+        rate = yield measure(pool, aos, number,
+            [lambda: aos.load_undispatched_events(names, limit)])
+        print "new claim by %s, 1 consumer: %0.0f events/s" % (limit, rate)
+    rate = yield measure(pool, aos, number,
+        [lambda name=name: aos.load_undispatched_events([name], 100)
+            for name in names])
+    print "new claim by 100, %s subscribed consumers: %0.0f events/s" % (
+        consumers, rate)
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events CASCADE")
+    pool.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
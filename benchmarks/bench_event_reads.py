@@ -0,0 +1,111 @@
+'''
+Loading of aggregate events from a big event log.
+
+Usage: python benchmarks/bench_event_reads.py [events] [aggregates]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), bench_events and bench_dispatch tables are recreated there.
+Event log of given size (10M events by default) is filled with events of
+as many aggregates (100000 by default) which are interleaved as online
+tracks are. Events of random aggregates are read by the old query (no
+index, ORDER BY OCCURED_ON) and by load_events after store initialized its
+index. Then the whole log is read by stream_events with server-side cursor.
+'''
+import random
+import resource
+import sys
+import time
+
+from twisted.internet import reactor, defer
+
+from gorynych import OPTS
+from gorynych.common.infrastructure.dbpool import AsyncConnectionPool
+from gorynych.eventstore import store
+
+store.EVENTS_TABLE = 'bench_events'
+store.DISPATCH_TABLE = 'bench_dispatch'
+store.FUNC_NAME = 'bench_add_to_dispatch'
+store.TRIGGER_NAME = 'bench_to_dispatch'
+
+OLD_READ_EVENTS = """
+    SELECT * FROM bench_events
+      WHERE AGGREGATE_ID = %s
+      ORDER BY OCCURED_ON ASC;
+    """
+
+
+@defer.inlineCallbacks
+def fill(pool, number, aggregates):
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events CASCADE")
+    yield pool.runOperation(store.CREATE_EVENTS_TABLE.format(
+        events_table=store.EVENTS_TABLE))
+    yield pool.runOperation("INSERT INTO bench_events (event_name, "
+        "aggregate_id, aggregate_type, event_payload, occured_on) SELECT "
+        "'PointsAddedToTrack', 'aggregate-' || (i %% %s), 'track', "
+        "convert_to(repeat('p', 64), 'UTF8'), "
+        "now() + i * interval '1 millisecond' "
+        "FROM generate_series(1, %s) i", (aggregates, number))
+    yield pool.runOperation("ANALYZE bench_events")
+
+
+@defer.inlineCallbacks
+def read_random(read, aggregates, number):
+    t = time.time()
+    for i in xrange(number):
+        yield read('aggregate-%s' % random.randrange(aggregates))
+    defer.returnValue((time.time() - t) / number * 1000)
+
+
+@defer.inlineCallbacks
+def explain(pool, query, args):
+    rows = yield pool.runQuery("EXPLAIN " + query, args)
+    defer.returnValue('\n'.join('    ' + row[0] for row in rows))
+
+
+@defer.inlineCallbacks
+def main(number=10000000, aggregates=100000):
+    pool = AsyncConnectionPool(min=2, host=OPTS['dbhost'],
+        database=OPTS['dbname'], user=OPTS['dbuser'],
+        password=OPTS['dbpassword'])
+    aos = store.PGSQLAppendOnlyStore(pool)
+    t = time.time()
+    yield fill(pool, number, aggregates)
+    print "%s events of %s aggregates filled in %0.0f s" % (number,
+        aggregates, time.time() - t)
+
+    plan = yield explain(pool, OLD_READ_EVENTS, ('aggregate-1',))
+    print "old read plan:\n" + plan
+    mean = yield read_random(lambda aid: pool.runQuery(
+        OLD_READ_EVENTS, (aid,)), aggregates, 5)
+    print "old read: %0.1f ms/aggregate" % mean
+
+    t = time.time()
+    yield aos.initialize()
+    yield pool.runOperation("ANALYZE bench_events")
+    print "store initialized with index in %0.0f s" % (time.time() - t)
+    plan = yield explain(pool, store.READ_EVENTS.format(
+        events_table=store.EVENTS_TABLE), ('aggregate-1', 0))
+    print "load_events plan:\n" + plan
+    mean = yield read_random(aos.load_events, aggregates, 1000)
+    print "load_events: %0.2f ms/aggregate" % mean
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.time()
+    total = yield aos.stream_events(lambda rows: None, batch_size=10000)
+    print "stream_events: %0.0f events/s, max RSS grew by %s MB" % (
+        total / (time.time() - t),
+        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) // 1024)
+
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events CASCADE")
+    pool.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -0,0 +1,91 @@
+'''
+Replay of online tracker load through OnlineTrashService.
+
+Usage: python benchmarks/bench_ingestion.py [trackers] [seconds]
+
+Every tracker sends a point per second. Messages are handled one by one
+as before (race lookup and Track.append_data for every point) and with
+micro-batching (points are grouped by device and appended once per
+batch_interval seconds). Races and tracks are taken from service caches, so no database
+is needed.
+'''
+import cPickle
+import sys
+import time
+
+from twisted.internet import defer
+
+from gorynych.common.domain import events
+from gorynych.processor.domain import track
+from gorynych.processor.services.trackservice import OnlineTrashService
+
+sys.path.insert(0, 'benchmarks')
+from bench_racetypes import TASK
+
+
+def make_service(trackers):
+    service = OnlineTrashService(None, None, None)
+    service.processor.stop()
+    service.ingester.stop()
+    now = int(time.time())
+    service.races.loaded = True
+    for i in xrange(trackers):
+        imei = str(i)
+        service.races.add([(imei, 'race', str(i), now, now + 7 * 3600)])
+        tid = track.TrackID()
+        tc = events.TrackCreated(tid,
+            dict(race_task=TASK, track_type='online'))
+        trck = track.Track(tid, [tc])
+        trck.task
+        service.tracks['race'][imei] = trck
+    return service
+
+
+def messages(trackers, second):
+    ts = TASK['start_time'] + 600 + second
+    return [cPickle.dumps(dict(imei=str(i), ts=ts, lat=42.6 + i * 1e-4,
+        lon=24.7, alt=1000 + second % 50, h_speed=30)) for i in
+        xrange(trackers)]
+
+
+def one_by_one(service, body):
+    # How messages were handled before micro-batching.
+    data = cPickle.loads(body)
+    d = service.races.get(data['imei'], int(time.time()))
+    d.addCallback(service._get_track, data['imei'])
+    d.addCallback(lambda tr: tr.append_data(data))
+    return d
+
+
+def batched(service, body):
+    service.handle_payload(None, None, None, body, 'rdp')
+
+
+def replay(handle, trackers, seconds):
+    service = make_service(trackers)
+    bodies = [messages(trackers, s) for s in xrange(seconds)]
+    spent = 0
+    for i, second in enumerate(bodies):
+        t = time.time()
+        for body in second:
+            handle(service, body)
+        if handle is batched and (i + 1) % service.batch_interval == 0:
+            service.append_pending()
+        spent += time.time() - t
+    for trck in service.tracks['race'].values():
+        assert len(trck.buffer) == seconds
+    return trackers * seconds / spent, service
+
+
+def main(trackers, seconds):
+    old, _ = replay(one_by_one, trackers, seconds)
+    new, service = replay(batched, trackers, seconds)
+    print 'one by one: %10.0f points/s' % old
+    print 'batched:    %10.0f points/s' % new
+    print 'counter:    %10d points' % service.stats.points
+
+
+if __name__ == '__main__':
+    trackers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    main(trackers, seconds)
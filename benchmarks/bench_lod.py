@@ -0,0 +1,78 @@
+'''
+Payload size and latency of /group/{id}/tracks per level of detail.
+
+Usage: python benchmarks/bench_lod.py [pilots] [seconds]
+
+Race replay of given number of pilots sending a point per second (50 pilots
+for an hour by default) as in bench_wire.py. Points are saved into
+DownsamplingPyramid by one second batches as TrackRepository does and
+closed buckets are downsampled, then for raw points and every level json
+and binary timelines are prepared and encoded as TracksResource does.
+'''
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from gorynych.info.restui.base_resource import json_renderer
+from gorynych.processor.domain.services import DownsamplingPyramid, \
+    downsample
+from gorynych.processor.domain.track import DTYPE
+from gorynych.processor.services.visualization import \
+    TrackVisualizationService, encode_timeline
+
+from bench_wire import replay
+
+
+def build_pyramid(points, seconds):
+    '''
+    Return {level:downsampled rows} and mean time of one pyramid batch.
+    '''
+    rows = np.zeros(len(points), dtype=DTYPE)
+    rows['id'] = [int(row[0]) for row in points]
+    for i, name in enumerate(['timestamp', 'lat', 'lon', 'alt', 'v_speed',
+            'g_speed', 'distance']):
+        rows[name] = [row[i + 1] for row in points]
+    rows = rows[np.argsort(rows['timestamp'], kind='mergesort')]
+    pyramid = DownsamplingPyramid()
+    bounds = np.searchsorted(rows['timestamp'],
+        np.arange(rows['timestamp'][0], rows['timestamp'][-1] + 2))
+    t = time.time()
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        ranges, state = pyramid.add(rows[first:last])
+        pyramid.commit(state)
+    spent = (time.time() - t) / seconds
+    # Buckets are downsampled from saved points as TrackRepository does.
+    result = {}
+    for level in pyramid.levels:
+        lod = rows[downsample(rows['id'], rows['timestamp'], rows['alt'],
+            level)]
+        result[level] = [(str(row['id']), row['timestamp'], row['lat'],
+            row['lon'], row['alt'], row['v_speed'], row['g_speed'],
+            row['distance']) for row in lod]
+    return result, spent
+
+
+def main(pilots=50, seconds=3600):
+    points, agg, snaps = replay(pilots, seconds)
+    service = TrackVisualizationService(None)
+    levels, batch_time = build_pyramid(points, seconds)
+    print "%s pilots, %s points, pyramid batch %0.2fms" % (pilots,
+        len(points), batch_time * 1000)
+    for level, rows in [('raw', points)] + sorted(levels.items()):
+        t = time.time()
+        body = json_renderer(dict(timeline=service.prepare_result(rows,
+            snaps)))
+        json_time = time.time() - t
+        t = time.time()
+        data = encode_timeline(rows, snaps)
+        binary_time = time.time() - t
+        print "%4s: %7s points, json %6.2f MB (gzip %5.2f MB) in %0.3fs, " \
+            "binary %5.2f MB in %0.3fs" % (level, len(rows),
+            len(body) / 1e6, len(zlib.compress(body, 6)) / 1e6, json_time,
+            len(data) / 1e6, binary_time)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,62 @@
+'''
+Micro-benchmarks for create_uniq_hstack.
+
+Usage: python benchmarks/bench_merge.py [buffer length]
+
+New points are merged into buffer of points as Track.append_data and
+Track.process_data do it. Cases: one point in order, one slightly late
+point, a minute batch in order, a minute batch with late points, and
+heavily shuffled batch. Merge is compared with sort+unique which was
+used before.
+'''
+import sys
+import timeit
+
+import numpy as np
+
+from gorynych.processor.domain.track import DTYPE
+from gorynych.processor.domain.services import create_uniq_hstack
+
+
+def sort_uniq_hstack(array1, array2):
+    result = np.sort(np.hstack((array1, array2)), order='timestamp')
+    _, idxs = np.unique(result['timestamp'], return_index=True)
+    return result[idxs]
+
+
+def points(times):
+    result = np.zeros(len(times), dtype=DTYPE)
+    result['timestamp'] = times
+    result['alt'] = np.random.randint(500, 2000, len(times))
+    return result
+
+
+def cases(n):
+    buf = points(np.arange(0, n * 2, 2))
+    end = n * 2
+    late = np.arange(end, end + 60)
+    late[::10] -= 15
+    shuffled = np.random.permutation(np.arange(end - 600, end + 600, 2))
+    return [
+        ('1 point in order', buf, points([end])),
+        ('1 point, 10 s late', buf, points([end - 9])),
+        ('60 points in order', buf, points(np.arange(end, end + 60))),
+        ('60 points, some late', buf, points(np.unique(late))),
+        ('600 points shuffled', buf, points(shuffled))]
+
+
+def main(n):
+    np.random.seed(0)
+    print '%22s %12s %12s' % ('case', 'sort, us', 'merge, us')
+    for name, buf, new in cases(n):
+        assert (sort_uniq_hstack(buf, new)['timestamp'] ==
+            create_uniq_hstack(buf, new)['timestamp']).all()
+        times = []
+        for func in (sort_uniq_hstack, create_uniq_hstack):
+            timer = timeit.Timer(lambda: func(buf, new))
+            times.append(min(timer.repeat(5, 200)) / 200 * 1e6)
+        print '%22s %12.1f %12.1f' % (name, times[0], times[1])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3600)
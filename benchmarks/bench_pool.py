@@ -0,0 +1,91 @@
+'''
+Throughput of adbapi thread pool and AsyncConnectionPool under concurrent
+load.
+
+Usage: python benchmarks/bench_pool.py [clients] [queries] [connections]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), track tables are recreated there. Given number of concurrent
+clients (200 by default) make queries (50 by default each) which look up
+last state of a track by id, as repositories do, through adbapi pool with
+cp_max=connections (16 by default), through AsyncConnectionPool with the
+same number of connections and through it with prepared statement.
+'''
+import random
+import sys
+import time
+
+from twisted.enterprise import adbapi
+from twisted.internet import reactor, defer
+
+from gorynych import OPTS
+from gorynych.common.infrastructure.dbpool import AsyncConnectionPool
+from gorynych.info.infrastructure.test.db_helpers import initDB
+
+TRACKS = 1000
+
+QUERY = """
+    SELECT timestamp, lat, lon, alt FROM track_last_state WHERE id = %s;
+    """
+
+
+@defer.inlineCallbacks
+def setup_tracks(pool):
+    yield initDB('track', pool)
+    yield pool.runOperation("INSERT INTO track (track_id) SELECT 'bench-' "
+        "|| i FROM generate_series(1, %s) i", (TRACKS,))
+    yield pool.runOperation("INSERT INTO track_last_state (id, timestamp, "
+        "lat, lon, alt) SELECT id, 1374223800, 42.6, 24.7, 1000 FROM track")
+    rows = yield pool.runQuery("SELECT id FROM track")
+    defer.returnValue([row[0] for row in rows])
+
+
+@defer.inlineCallbacks
+def client(pool, ids, queries):
+    for i in xrange(queries):
+        yield pool.runQuery(QUERY, (random.choice(ids),))
+
+
+@defer.inlineCallbacks
+def load(pool, ids, clients, queries):
+    t = time.time()
+    yield defer.gatherResults([client(pool, ids, queries)
+        for i in xrange(clients)])
+    defer.returnValue(clients * queries / (time.time() - t))
+
+
+@defer.inlineCallbacks
+def main(clients=200, queries=50, connections=16):
+    connection = dict(host=OPTS['dbhost'], database=OPTS['dbname'],
+        user=OPTS['dbuser'], password=OPTS['dbpassword'])
+    threads = adbapi.ConnectionPool('psycopg2', cp_min=connections,
+        cp_max=connections, **connection)
+    ids = yield setup_tracks(threads)
+    yield threads.runOperation("ANALYZE")
+    # Warm up connections of every pool before measuring.
+    yield load(threads, ids, connections, 1)
+    rate = yield load(threads, ids, clients, queries)
+    print "adbapi, %s threads: %0.0f queries/s" % (connections, rate)
+    threads.close()
+
+    for prepared in (False, True):
+        pool = AsyncConnectionPool(min=connections, **connection)
+        if prepared:
+            pool.prepare(QUERY)
+        yield load(pool, ids, connections, 1)
+        rate = yield load(pool, ids, clients, queries)
+        stats = pool.stats()
+        print "async%s, %s connections: %0.0f queries/s, mean wait %0.1fms, " \
+            "max wait %0.1fms" % (' prepared' if prepared else '',
+            connections, rate, stats['wait_time'] / stats['queries'] * 1000,
+            stats['max_wait_time'] * 1000)
+        pool.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
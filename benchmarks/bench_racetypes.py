@@ -0,0 +1,164 @@
+'''
+Compare pointwise and vectorized checkpoint taking in race types.
+
+Usage: python benchmarks/bench_racetypes.py [track.igc]
+
+If no track is given a 10k-point IGC track flying through all checkpoints
+of the task is generated.
+'''
+import os
+import sys
+import tempfile
+import time
+from calendar import timegm
+
+import numpy as np
+
+from gorynych.common.domain import events
+from gorynych.processor.domain import track
+from gorynych.processor.domain.racetypes import RaceTypesFactory
+from gorynych.processor.domain.services import IGCTrackParser
+
+TASK = {
+    "race_type": "racetogoal", "start_time": 1374223800,
+    "end_time": 1374263800, "bearing": None,
+    "checkpoints": {"type": "FeatureCollection", "features": [
+        {"geometry": {"type": "Point", "coordinates": [42.687497, 24.750131]},
+         "type": "Feature", "properties": {"close_time": 1374238200,
+            "radius": 400, "name": "25S145", "checkpoint_type": "to",
+            "open_time": 1374223800}},
+        {"geometry": {"type": "Point", "coordinates": [42.603923, 25.019128]},
+         "type": "Feature", "properties": {"close_time": 1374263800,
+            "radius": 2000, "name": "40L057", "checkpoint_type": "ss",
+            "open_time": 1374226800}},
+        {"geometry": {"type": "Point", "coordinates": [42.502614, 24.16646]},
+         "type": "Feature", "properties": {"close_time": None,
+            "radius": 3000, "name": "04L055", "checkpoint_type": "ordinal",
+            "open_time": None}},
+        {"geometry": {"type": "Point", "coordinates": [42.504597, 25.026856]},
+         "type": "Feature", "properties": {"close_time": None,
+            "radius": 5000, "name": "41P075", "checkpoint_type": "ordinal",
+            "open_time": None}},
+        {"geometry": {"type": "Point", "coordinates": [42.659186, 24.68335]},
+         "type": "Feature", "properties": {"close_time": 1374263800,
+            "radius": 2000, "name": "21L043", "checkpoint_type": "es",
+            "open_time": 1374226800}},
+        {"geometry": {"type": "Point", "coordinates": [42.659186, 24.68335]},
+         "type": "Feature", "properties": {"close_time": 1374263800,
+            "radius": 200, "name": "21L043", "checkpoint_type": "goal",
+            "open_time": 1374226800}}]}}
+
+POINTS = 10000
+
+
+def _igc_coord(value, degrees_len, hemispheres):
+    hemisphere = hemispheres[0] if value >= 0 else hemispheres[1]
+    value = abs(value)
+    degrees = int(value)
+    minutes = (value - degrees) * 60
+    return '%0*d%05d%s' % (degrees_len, degrees, int(round(minutes * 1000)),
+        hemisphere)
+
+
+def write_igc(filename, points=POINTS):
+    '''
+    Write IGC track which goes through centers of all task checkpoints.
+    '''
+    coords = [f['geometry']['coordinates'] for f in
+        TASK['checkpoints']['features']]
+    legs = len(coords) - 1
+    per_leg = points // legs
+    lats, lons = [], []
+    for i in range(legs):
+        lats.append(np.linspace(coords[i][0], coords[i + 1][0], per_leg,
+            endpoint=False))
+        lons.append(np.linspace(coords[i][1], coords[i + 1][1], per_leg,
+            endpoint=False))
+    lats, lons = np.hstack(lats), np.hstack(lons)
+    lats[-1], lons[-1] = coords[-1]
+    start = TASK['start_time'] + 600
+    with open(filename, 'w') as f:
+        f.write('HFDTE%s\r\n' % time.strftime('%d%m%y', time.gmtime(start)))
+        for i in range(len(lats)):
+            f.write('B%s%s%sA%05d%05d\r\n' % (
+                time.strftime('%H%M%S', time.gmtime(start + i)),
+                _igc_coord(lats[i], 2, 'NS'), _igc_coord(lons[i], 3, 'EW'),
+                1000, 1000))
+
+
+def pointwise_process(race, points, trackstate, _id):
+    '''
+    Checkpoint taking as it was done before vectorization.
+    '''
+    eventlist = []
+    lastchp = trackstate.last_checkpoint
+    nextchp = race.checkpoints[lastchp + 1]
+    calculation_ended = trackstate.ended
+    for idx, p in np.ndenumerate(points):
+        lat, lon = p['lat'], p['lon']
+        if nextchp.is_taken_by(lat, lon, p['timestamp']) and \
+                (not calculation_ended):
+            eventlist.append(
+                events.TrackCheckpointTaken(
+                    _id,
+                    (lastchp + 1, nextchp.dist_to_center),
+                    occured_on=nextchp.take_time))
+            if nextchp.type == 'es':
+                eventlist.append(events.TrackFinishTimeReceived(_id,
+                    payload=p['timestamp'], occured_on=p['timestamp']))
+            if nextchp.type == 'goal':
+                eventlist.append(events.TrackFinished(_id,
+                    occured_on=p['timestamp']))
+                calculation_ended = True
+            if nextchp.type == 'ss':
+                eventlist.append(events.TrackStarted(_id,
+                    occured_on=p['timestamp']))
+            if lastchp + 1 < len(race.checkpoints) - 1:
+                nextchp = race.checkpoints[lastchp + 2]
+                lastchp += 1
+        p['distance'] = nextchp.dist_to_point(lat, lon) + nextchp.distance
+    return points, eventlist
+
+
+def run(process, data, repeat=5):
+    best = None
+    for i in range(repeat):
+        race = RaceTypesFactory().create('online', TASK)
+        trackstate = track.TrackState(track.TrackID(), [])
+        points = data.copy()
+        t1 = time.time()
+        points, evs = process(race, points, trackstate, trackstate.id)
+        spent = time.time() - t1
+        if best is None or spent < best:
+            best = spent
+    return best, points, [(ev.name, ev.occured_on, ev.payload) for ev in evs]
+
+
+def main(filename=None):
+    if not filename:
+        fd, filename = tempfile.mkstemp(suffix='.igc')
+        os.close(fd)
+        write_igc(filename)
+        generated = True
+    else:
+        generated = False
+    try:
+        data = IGCTrackParser(track.DTYPE).parse(filename)
+    finally:
+        if generated:
+            os.unlink(filename)
+    print "Track with %s points" % len(data)
+    old, old_points, old_evs = run(pointwise_process, data)
+    new, new_points, new_evs = run(
+        lambda race, *args: race.process(*args), data)
+    assert (old_points['distance'] == new_points['distance']).all(), \
+        "Distances differ."
+    assert old_evs == new_evs, "Events differ: %s %s" % (old_evs, new_evs)
+    print "%s events, distances and events are the same." % len(new_evs)
+    print "pointwise:  %8.4f s" % old
+    print "vectorized: %8.4f s" % new
+    print "speedup:    %8.1f x" % (old / new)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
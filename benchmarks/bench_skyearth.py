@@ -0,0 +1,93 @@
+'''
+Per-minute cost of takeoff/landing detection over a long online track.
+
+Usage: python benchmarks/bench_skyearth.py [hours]
+
+Track is fed minute by minute as OnlineTrashService does it. Cost of
+ParagliderSkyEarth.state_work is measured for pointwise and batched
+versions and printed per hour of flight.
+'''
+import sys
+import time
+
+import numpy as np
+
+from gorynych.common.domain import events
+from gorynych.processor.domain import track
+from gorynych.processor.domain.services import ParagliderSkyEarth, \
+    create_uniq_hstack
+
+
+class PointwiseSkyEarth(ParagliderSkyEarth):
+    '''
+    Takeoff and landing detection as it was done before batching.
+    '''
+    def state_work(self, data):
+        result = []
+        for point in data:
+            result.append(self._state_work(point, self._alt_diff(point)))
+        return [item for sublist in result for item in sublist]
+
+    def _alt_diff(self, data):
+        ts = data['timestamp']
+        start = np.where(self.trackstate._buffer['timestamp'] >= ts - 60)[0]
+        end = np.where(self.trackstate._buffer['timestamp'] == ts)[0]
+        if len(start) == 0 or len(end) == 0:
+            return False
+        start = start[0]
+        end = end[0] + 1
+        alts = self.trackstate._buffer['alt'][start:end]
+        return abs(np.max(alts) - np.min(alts))
+
+
+def make_track(hours):
+    np.random.seed(1)
+    n = hours * 3600
+    data = np.zeros(n, dtype=track.DTYPE)
+    data['timestamp'] = np.arange(n) + 1374223800
+    data['alt'] = np.cumsum(np.random.randint(-3, 4, n)) + 1500
+    # Thermalling and gliding: speed goes around threshold.
+    data['g_speed'] = 10 + 6 * np.sin(np.arange(n) / 90.) + \
+        np.random.normal(0, 1, n)
+    return data
+
+
+def run(cls, data, repeat=3):
+    tid = track.TrackID()
+    state = track.TrackState(tid, [events.TrackCreated(tid,
+        dict(race_task={}, track_type='online'))])
+    costs = []
+    amount = 0
+    for minute in xrange(len(data) // 60):
+        points = data[minute * 60:(minute + 1) * 60]
+        state._buffer = create_uniq_hstack(state._buffer, points)
+        best = None
+        for i in range(repeat):
+            # state_work doesn't change track state, so it can be repeated.
+            t1 = time.time()
+            evs = cls(state).state_work(points)
+            spent = time.time() - t1
+            if best is None or spent < best:
+                best = spent
+        costs.append(best)
+        for ev in evs:
+            state.mutate(ev)
+        amount += len(evs)
+    return np.array(costs), amount
+
+
+def main(hours=6):
+    data = make_track(int(hours))
+    old, old_amount = run(PointwiseSkyEarth, data)
+    new, new_amount = run(ParagliderSkyEarth, data)
+    assert old_amount == new_amount, "Different amount of events."
+    print "%s events for %s hours track." % (new_amount, hours)
+    print "hour  pointwise, ms/min  batched, ms/min"
+    for hour in xrange(int(hours)):
+        part = slice(hour * 60, (hour + 1) * 60)
+        print "%4d  %17.3f  %15.3f" % (hour + 1, old[part].mean() * 1000,
+            new[part].mean() * 1000)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
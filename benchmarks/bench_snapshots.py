@@ -0,0 +1,115 @@
+'''
+Cold restore of tracks from full event history and from snapshots.
+
+Usage: python benchmarks/bench_snapshots.py [tracks] [events]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), bench_events, bench_dispatch and bench_snapshot tables are
+recreated there. Given number of tracks (500 by default) get as many state
+events (300 by default) each, then every track state is restored as
+TrackRepository does: by replay of all its events, and from snapshot which
+was saved after all but last 10 events plus these events.
+'''
+import sys
+import time
+
+from twisted.internet import reactor, defer
+
+from gorynych import OPTS
+from gorynych.common.domain import events
+from gorynych.common.infrastructure.dbpool import AsyncConnectionPool
+from gorynych.common.infrastructure.serializers import SnapshotSerializer
+from gorynych.eventstore import store, snapshots
+from gorynych.eventstore.eventstore import EventStore
+from gorynych.processor.domain.track import TrackID, TrackState
+from gorynych.processor.infrastructure.persistence import \
+    TRACK_SNAPSHOT_VERSION
+
+store.EVENTS_TABLE = 'bench_events'
+store.DISPATCH_TABLE = 'bench_dispatch'
+store.FUNC_NAME = 'bench_add_to_dispatch'
+store.TRIGGER_NAME = 'bench_to_dispatch'
+snapshots.SNAPSHOTS_TABLE = 'bench_snapshot'
+
+# Events which are appended after snapshot.
+TAIL = 10
+
+
+def track_events(tid, number):
+    result = [events.TrackCreated(tid, dict(track_type='online',
+        race_task=None))]
+    for i in xrange(number - 1):
+        if i % 4 == 0:
+            result.append(events.TrackCheckpointTaken(tid, (i // 4, 10)))
+        elif i % 4 == 1:
+            result.append(events.TrackSpeedExceeded(tid, aggregate_type='track'))
+        elif i % 4 == 2:
+            result.append(events.TrackSlowedDown(tid, aggregate_type='track'))
+        else:
+            result.append(events.TrackInAir(tid, aggregate_type='track'))
+    return result
+
+
+@defer.inlineCallbacks
+def setup(pool, aos, es, tracks, number):
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events, bench_snapshot CASCADE")
+    yield aos.initialize()
+    ids = [TrackID() for i in xrange(tracks)]
+    for tid in ids:
+        yield es.persist(track_events(tid, number))
+    yield pool.runOperation("ANALYZE bench_events")
+    defer.returnValue(ids)
+
+
+@defer.inlineCallbacks
+def restore_all(ids, es, snapshot_store=None):
+    t = time.time()
+    for tid in ids:
+        if snapshot_store:
+            state, event_list, _ = yield snapshot_store.load_with_events(
+                tid, es)
+        else:
+            state, event_list = None, (yield es.load_events(tid))
+        if state is None:
+            TrackState(tid, event_list)
+        else:
+            for ev in event_list:
+                state.mutate(ev)
+    defer.returnValue((time.time() - t) / len(ids) * 1000)
+
+
+@defer.inlineCallbacks
+def main(tracks=500, number=300):
+    pool = AsyncConnectionPool(min=4, host=OPTS['dbhost'],
+        database=OPTS['dbname'], user=OPTS['dbuser'],
+        password=OPTS['dbpassword'])
+    aos = store.PGSQLAppendOnlyStore(pool)
+    es = EventStore(aos)
+    snapshot_store = snapshots.SnapshotStore(pool,
+        SnapshotSerializer(TRACK_SNAPSHOT_VERSION))
+    ids = yield setup(pool, aos, es, tracks, number)
+
+    mean = yield restore_all(ids, es)
+    print "full replay of %s events: %0.2f ms/track" % (number, mean)
+
+    for tid in ids:
+        event_list = yield es.load_events(tid)
+        head = event_list[:-TAIL]
+        yield snapshot_store.save(tid, head[-1].id, TrackState(tid, head),
+            [ev.id for ev in head])
+    mean = yield restore_all(ids, es, snapshot_store)
+    print "snapshot and %s events: %0.2f ms/track" % (TAIL, mean)
+
+    yield pool.runOperation("DROP TABLE IF EXISTS bench_dispatch, "
+        "bench_events, bench_snapshot CASCADE")
+    pool.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
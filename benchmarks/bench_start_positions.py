@@ -0,0 +1,114 @@
+'''
+Start positions from window functions and from track_last_state.
+
+Usage: python benchmarks/bench_start_positions.py [pilots] [hours]
+
+Needs PostgreSQL from gorynych options (dbhost, dbname, dbuser,
+dbpassword), track tables are recreated there. A race of 200 pilots
+sending a point per second for 8 hours (by default) is written with
+TrackRepository, then start positions at the end of the race are selected
+with GET_HEADERS_DATA/GET_HEADERS_SNAPSHOTS and with GET_LAST_STATES.
+'''
+import sys
+import time
+
+import numpy as np
+from twisted.enterprise import adbapi
+from twisted.internet import reactor, defer
+from txpostgres import txpostgres
+
+from gorynych import OPTS
+from gorynych.info.infrastructure.test.db_helpers import initDB
+from gorynych.processor.domain.track import DTYPE
+from gorynych.processor.infrastructure.persistence import TrackRepository, \
+    copy_snapshots
+from gorynych.processor.services.visualization import \
+    TrackVisualizationService, GET_HEADERS_DATA, GET_HEADERS_SNAPSHOTS, \
+    GET_LAST_STATES
+
+GROUP = 'r-bench-start-positions-id'
+START = 1374223800
+REPEAT = 10
+
+
+@defer.inlineCallbacks
+def write_race(pool, pilots, seconds):
+    yield initDB('track', pool)
+    repo = TrackRepository(pool)
+    ids = []
+    for i in xrange(pilots):
+        rows = yield pool.runQuery("INSERT INTO track (track_id) VALUES (%s)"
+            " RETURNING id", ('bench-%s' % i,))
+        ids.append(rows[0][0])
+        yield pool.runOperation("INSERT INTO tracks_group VALUES (%s, %s, %s)",
+            (GROUP, ids[-1], str(i)))
+    # Points are written by hour as processor does by ticks.
+    for hour in xrange(0, seconds, 3600):
+        points = np.zeros(pilots * min(3600, seconds - hour), dtype=DTYPE)
+        points['id'] = np.repeat(ids, len(points) / pilots)
+        points['timestamp'] = np.tile(np.arange(START + hour,
+            START + hour + len(points) / pilots), pilots)
+        points['lat'] = 42.6 + np.random.uniform(-0.1, 0.1, len(points))
+        points['lon'] = 24.7 + np.random.uniform(-0.1, 0.1, len(points))
+        points['alt'] = np.random.randint(500, 3000, len(points))
+        yield pool.runInteraction(repo._write_points, points)
+    snapshots = [(_id, START + t, '["%s"]' % state) for _id in ids
+        for t, state in [(0, 'started'), (600, 'in_air_true'),
+            (seconds - 60, 'es_taken'), (seconds - 30, 'in_air_false')]]
+    yield pool.runInteraction(copy_snapshots, snapshots)
+    yield pool.runOperation("ANALYZE")
+
+
+@defer.inlineCallbacks
+def timed(query):
+    t = time.time()
+    for i in xrange(REPEAT):
+        result = yield query()
+    defer.returnValue(((time.time() - t) / REPEAT, result))
+
+
+@defer.inlineCallbacks
+def main(pilots=200, hours=8):
+    connection = dict(host=OPTS['dbhost'], database=OPTS['dbname'],
+        user=OPTS['dbuser'], password=OPTS['dbpassword'])
+    writer = adbapi.ConnectionPool('psycopg2', **connection)
+    seconds = hours * 3600
+    t = time.time()
+    yield write_race(writer, pilots, seconds)
+    print "%s pilots, %s points written in %0.1fs" % (pilots,
+        pilots * seconds, time.time() - t)
+
+    pool = txpostgres.ConnectionPool(None, min=1, **connection)
+    yield pool.start()
+    service = TrackVisualizationService(pool)
+    from_time = START + seconds
+
+    @defer.inlineCallbacks
+    def window():
+        hdata = yield pool.runQuery(GET_HEADERS_DATA, (GROUP,
+            from_time - service.track_gap, from_time))
+        hsnaps = yield pool.runQuery(GET_HEADERS_SNAPSHOTS,
+            (GROUP, from_time))
+        defer.returnValue(service.prepare_start_data(hdata, hsnaps))
+
+    @defer.inlineCallbacks
+    def last_state():
+        hdata, hsnaps = yield service.select_start_data(GROUP, from_time)
+        defer.returnValue(service.prepare_start_data(hdata, hsnaps))
+
+    old_time, old = yield timed(window)
+    new_time, new = yield timed(last_state)
+    assert old == new
+    print "window functions: %0.4fs, track_last_state: %0.4fs" % (old_time,
+        new_time)
+    pool.close()
+    writer.close()
+
+
+if __name__ == '__main__':
+    def run():
+        d = main(*map(int, sys.argv[1:]))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -0,0 +1,153 @@
+'''
+Load test of live track streaming against local PostgreSQL.
+
+Usage: python benchmarks/bench_stream.py [subscribers] [tracks] [seconds]
+
+Database is taken from gorynych options (dbhost, dbname, dbuser,
+dbpassword), track tables are recreated there. TrackVisualizationService
+listens on a local port and the given number of clients (5000 by default)
+subscribe to /stream/{group}. Every second points of all tracks are saved
+with TrackRepository, as OnlineTrashService does, and the time until every
+subscriber received them is measured together with the number of data
+queries made by visualization service. Run with open files limit higher
+then number of subscribers (ulimit -n).
+'''
+import sys
+import time
+
+from twisted.internet import epollreactor
+epollreactor.install()
+
+import numpy as np
+from twisted.enterprise import adbapi
+from twisted.internet import reactor, defer, protocol, task
+from twisted.web import server
+from txpostgres import txpostgres
+
+from gorynych import OPTS
+from gorynych.info.restui import base_resource
+from gorynych.info.infrastructure.test.db_helpers import initDB
+from gorynych.processor.domain.track import DTYPE
+from gorynych.processor.infrastructure.persistence import TrackRepository
+from gorynych.processor.services.visualization import \
+    TrackVisualizationService
+
+GROUP = 'r-bench-stream-group-id'
+PORT = 8899
+
+
+class Subscriber(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write('GET /stream/%s HTTP/1.1\r\nHost: localhost'
+            '\r\n\r\n' % GROUP)
+        self.factory.connected += 1
+
+    def dataReceived(self, data):
+        events = data.count('data: ')
+        if events:
+            self.factory.received(events)
+
+
+class SubscribersFactory(protocol.ClientFactory):
+    protocol = Subscriber
+
+    def __init__(self):
+        self.connected = 0
+        self.events = 0
+        self.waiting = None
+
+    def received(self, events):
+        self.events += events
+        if self.waiting and self.events >= self.waiting[0]:
+            d, self.waiting = self.waiting[1], None
+            d.callback(None)
+
+    def wait(self, events):
+        d = defer.Deferred()
+        self.waiting = (events, d)
+        return d
+
+
+class CountingPool(txpostgres.ConnectionPool):
+    queries = 0
+
+    def runQuery(self, *args, **kwargs):
+        self.queries += 1
+        return txpostgres.ConnectionPool.runQuery(self, *args, **kwargs)
+
+
+@defer.inlineCallbacks
+def setup_tracks(pool, tracks):
+    yield initDB('track', pool)
+    ids = []
+    for i in xrange(tracks):
+        rows = yield pool.runQuery("INSERT INTO track (track_id) VALUES (%s)"
+            " RETURNING id", ('bench-%s' % i,))
+        ids.append(rows[0][0])
+        yield pool.runOperation("INSERT INTO tracks_group VALUES (%s, %s, %s)",
+            (GROUP, ids[-1], str(i)))
+    defer.returnValue(ids)
+
+
+def points(ids, ts):
+    result = np.zeros(len(ids), dtype=DTYPE)
+    result['id'] = ids
+    result['timestamp'] = ts
+    result['lat'] = 42.6 + np.arange(len(ids)) * 1e-4
+    result['lon'] = 24.7
+    result['alt'] = 1000
+    return result
+
+
+@defer.inlineCallbacks
+def main(subscribers, tracks, seconds):
+    connection = dict(host=OPTS['dbhost'], database=OPTS['dbname'],
+        user=OPTS['dbuser'], password=OPTS['dbpassword'])
+    writer = adbapi.ConnectionPool('psycopg2', **connection)
+    repo = TrackRepository(writer)
+    ids = yield setup_tracks(writer, tracks)
+
+    pool = CountingPool(None, min=4, **connection)
+    service = TrackVisualizationService(pool)
+    yield service.startService()
+    tree = base_resource.resource_tree('gorynych/processor/vis.yaml')
+    reactor.listenTCP(PORT, server.Site(base_resource.APIResource(tree,
+        service)), backlog=1024)
+
+    factory = SubscribersFactory()
+    for i in xrange(subscribers):
+        reactor.connectTCP('localhost', PORT, factory)
+        if i % 500 == 0:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+    while sum(map(len, service.subscribers.values())) < subscribers:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    print "%s subscribers connected" % subscribers
+
+    latencies = []
+    start = int(time.time())
+    for second in xrange(seconds):
+        t = time.time()
+        d = factory.wait(factory.events + subscribers)
+        yield writer.runInteraction(repo._write_points,
+            points(ids, start + second))
+        yield d
+        latencies.append(time.time() - t)
+        yield task.deferLater(reactor, max(0, 1 - latencies[-1]),
+            lambda: None)
+    print "batches: %s, data queries: %s" % (seconds, pool.queries)
+    print "delivery to all subscribers: median %0.3fs, max %0.3fs" % (
+        np.median(latencies), max(latencies))
+    service.stopService()
+    writer.close()
+
+
+if __name__ == '__main__':
+    args = map(int, sys.argv[1:]) or [5000]
+    args += [100, 30][len(args) - 1:]
+
+    def run():
+        d = main(*args)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -0,0 +1,82 @@
+'''
+Size and encode time of /group/{id}/tracks timeline formats.
+
+Usage: python benchmarks/bench_wire.py [pilots] [seconds]
+
+Race replay of given number of pilots sending a point per second (50 pilots
+for an hour by default). Json is prepared from string_agg rows as it was
+before and from typed point rows with prepare_result, and encoded as
+TracksResource does; binary timeline is encoded from the same point rows.
+'''
+import sys
+import time
+import zlib
+
+from collections import defaultdict
+
+import numpy as np
+
+from gorynych.info.restui.base_resource import json_renderer
+from gorynych.processor.services.visualization import \
+    TrackVisualizationService, encode_timeline, decode_timeline, parse_result
+
+
+def prepare_result_text(tracks):
+    # How string_agg rows were parsed before.
+    result = defaultdict(dict)
+    for row in tracks:
+        for data in row[1].split(';'):
+            result[int(row[0])][str(data.split(',')[0])
+            ] = parse_result(data.split(',')[1:])
+    return result
+
+
+def replay(pilots, seconds):
+    np.random.seed(0)
+    n = pilots * seconds
+    start = 1374223800
+    lat = 42.6 + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+    lon = 24.7 + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+    alt = np.random.randint(500, 3000, n)
+    vspd = np.random.uniform(-5, 5, n)
+    gspd = np.random.uniform(0, 60, n)
+    dist = np.random.randint(0, 100000, n)
+    points = [(str(i / seconds), start + i % seconds, lat[i], lon[i],
+        alt[i], vspd[i], gspd[i], dist[i]) for i in xrange(n)]
+    by_ts = {}
+    for row in points:
+        by_ts.setdefault(row[1], []).append(','.join(
+            [row[0]] + [str(x) for x in row[2:]]))
+    agg = [(ts, ';'.join(by_ts[ts])) for ts in sorted(by_ts)]
+    snaps = [(start, '["started"]', str(i)) for i in xrange(pilots)]
+    return points, agg, snaps
+
+
+def main(pilots=50, seconds=3600):
+    points, agg, snaps = replay(pilots, seconds)
+    service = TrackVisualizationService(None)
+
+    t = time.time()
+    text = json_renderer(dict(timeline=prepare_result_text(agg)))
+    text_time = time.time() - t
+
+    t = time.time()
+    body = json_renderer(dict(timeline=service.prepare_result(points, [])))
+    json_time = time.time() - t
+    assert len(body) == len(text)
+
+    t = time.time()
+    data = encode_timeline(points, snaps)
+    binary_time = time.time() - t
+    header, tracks = decode_timeline(data)
+    assert sum(len(track) for track in tracks.values()) == len(points)
+
+    print "%s pilots, %s points" % (pilots, len(points))
+    for name, result, spent in [('text', text, text_time),
+            ('json', body, json_time), ('binary', data, binary_time)]:
+        print "%-6s: %6.2f MB (gzip %5.2f MB), encoded in %0.2fs" % (name,
+            len(result) / 1e6, len(zlib.compress(result, 6)) / 1e6, spent)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
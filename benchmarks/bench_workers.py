@@ -0,0 +1,95 @@
+'''
+Duration of OnlineTrashService processing tick against number of tracks.
+
+Usage: python benchmarks/bench_workers.py [workers] [ticks]
+
+Every track gets a minute of points (one per second) per tick and is
+processed in main process as before and in TrackWorkers processes.
+Saving isn't measured.
+'''
+import sys
+import time
+
+from gorynych.common.domain import events
+from gorynych.processor.domain import track
+from gorynych.processor.services.workers import TrackWorkers
+
+sys.path.insert(0, 'benchmarks')
+from bench_racetypes import TASK
+
+
+def create_tracks(n):
+    result = []
+    for i in xrange(n):
+        tid = track.TrackID()
+        tc = events.TrackCreated(tid,
+            dict(race_task=TASK, track_type='online'))
+        trck = track.Track(tid, [tc])
+        trck.task
+        result.append(trck)
+    return result
+
+
+def minute(tick, i):
+    start = TASK['start_time'] + 600 + tick * 60
+    return [dict(ts=start + s, lat=42.687497 - (tick * 60 + s) * 1e-4,
+        lon=24.750131 + i * 1e-4, alt=1000 + s % 7, h_speed=40)
+        for s in xrange(60)]
+
+
+def process_in_workers(workers, tracks):
+    '''
+    TrackWorkers.process without reactor threads. Return time spent in
+    main process.
+    '''
+    t = time.time()
+    jobs, shipped = workers._jobs(tracks)
+    for shard in jobs:
+        workers.connections[shard].send(jobs[shard])
+    main = time.time() - t
+    results = [(shard, (True, workers.connections[shard].recv()))
+        for shard in jobs]
+    t = time.time()
+    workers._apply(results, tracks, shipped)
+    return main + time.time() - t
+
+
+def tick_duration(tracks, workers, ticks):
+    '''
+    Return duration of tick and time spent in main process for it.
+    '''
+    spent = []
+    for tick in xrange(ticks):
+        for i, trck in enumerate(tracks):
+            trck.append_data(minute(tick, i))
+        t = time.time()
+        if workers:
+            main = process_in_workers(workers, tracks)
+        else:
+            for trck in tracks:
+                trck.process_data()
+        spent.append((time.time() - t, main if workers else None))
+        for trck in tracks:
+            trck.reset()
+    # First tick includes task creation in workers.
+    return min(spent[1:])
+
+
+def main(n_workers, ticks):
+    workers = TrackWorkers(n_workers)
+    print '%7s %12s %12s %12s' % ('tracks', 'main, s',
+        '%d workers, s' % n_workers, 'reactor, s')
+    try:
+        for n in (100, 250, 500, 1000):
+            local = tick_duration(create_tracks(n), None, ticks)
+            remote = tick_duration(create_tracks(n), workers, ticks)
+            print '%7d %12.3f %12.3f %12.3f' % (n, local[0], remote[0],
+                remote[1])
+    finally:
+        workers.stop()
+
+
+if __name__ == '__main__':
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    main(n_workers, ticks)
@@ -27,6 +27,8 @@ class BaseOptions(usage.Options):
         ['environment', 'e', 'develop'],
         ['config', 'c', 'config.yaml'],
         ['poolthreads', 'pt', 5, None, int],
+        ['dbconnections', 'dbc', 10, "Number of database connections.", int],
+        ['eventbatch', 'eb', 100, "Number of events claimed at once.", int],
         ['workdir', '', './'],
         ['apiurl', 'url', 'http://api.airtribune.com']
     ]
@@ -2,7 +2,6 @@
 Chat server realization for retrieve.
 '''
 from twisted.application import internet, service
-from twisted.enterprise import adbapi
 from twisted.web.resource import IResource
 from twisted.web import server
 from twisted.python import components
@@ -11,6 +10,7 @@ from gorynych import BaseOptions
 from gorynych.chat.application import IChatService
 from gorynych.chat.restui.resources import WebChat
 from gorynych.common.infrastructure import persistence
+from gorynych.common.infrastructure.dbpool import make_pool
 from gorynych.eventstore.eventstore import EventStore
 from gorynych.eventstore.store import PGSQLAppendOnlyStore
 
@@ -25,10 +25,7 @@ def makeService(config):
     from gorynych.chat.application import ChatApplication, IChatService
     from gorynych.chat.infrastructure import MessageRepository
     from gorynych.chat.domain.services import AuthenticationService
-    pool = adbapi.ConnectionPool('psycopg2', database=config['dbname'],
-        user=config['dbuser'],
-        password=config['dbpassword'],
-        host=config['dbhost'])
+    pool = make_pool(config)
 
     event_store = EventStore(PGSQLAppendOnlyStore(pool))
     persistence.add_event_store(event_store)
@@ -37,7 +34,8 @@ def makeService(config):
     r = MessageRepository(pool)
     ca = ChatApplication(pool, event_store,
                          repo=r,
-                         auth_service=AuthenticationService(pool))
+                         auth_service=AuthenticationService(pool),
+                         batch_size=config['eventbatch'])
     ca.setServiceParent(s)
 
     # website
@@ -46,7 +46,8 @@ class IChatService(Interface):
 class ChatApplication(EventPollingService):
     factory = MessageFactory()
 
-    def __init__(self, pool, event_store, repo, auth_service):
+    def __init__(self, pool, event_store, repo, auth_service,
+            batch_size=None):
         '''
         @param repo:
         @type repo:
@@ -56,7 +57,7 @@ class ChatApplication(EventPollingService):
         @return:
         @rtype:
         '''
-        EventPollingService.__init__(self, pool, event_store)
+        EventPollingService.__init__(self, pool, event_store, batch_size)
         self.repository = repo
         self.auth_service = auth_service
 
@@ -9,6 +9,8 @@ from gorynych.common.domain.services import AsynchronousAPIAccessor
 
 API = AsynchronousAPIAccessor()
 
+SELECT_ID_FOR_RETRIEVE = pe.select('id_for_retrieve', 'contest')
+
 class AuthenticationService(object):
     def __init__(self, pool):
         self.pool = pool
@@ -21,7 +23,7 @@ class AuthenticationService(object):
         @return: person_id
         @rtype: C{str}
         '''
-        d = self.pool.runQuery(pe.select('id_for_retrieve', 'contest'),
+        d = self.pool.runQuery(SELECT_ID_FOR_RETRIEVE,
             (retrieve_id,))
         d.addCallback(lambda x: x[0][0])
         return d
@@ -4,6 +4,10 @@ import time
 from gorynych.common.infrastructure import persistence as pe
 from gorynych.chat.domain.model import MessageFactory
 
+INSERT_MESSAGE = pe.insert('message', 'chat')
+
+SELECT_MESSAGE = pe.select('message', 'chat')
+
 
 class MessageRepository(object):
     def __init__(self, pool):
@@ -17,7 +21,7 @@ class MessageRepository(object):
         @return: message id
         @rtype: C{int}
         '''
-        d = self.pool.runQuery(pe.insert('message', 'chat'),
+        d = self.pool.runQuery(INSERT_MESSAGE,
             (msg.from_, msg.sender, msg.to, msg.body, msg.timestamp,
             chatroom_name))
         d.addCallback(lambda x: str(x[0][0]))
@@ -40,7 +44,7 @@ class MessageRepository(object):
         if end_time is None:
             end_time = int(time.time())
 
-        d = self.pool.runQuery(pe.select('message', 'chat'),
+        d = self.pool.runQuery(SELECT_MESSAGE,
             (chatroom, start_time, end_time))
         d.addCallback(self._restore_messages)
         return d
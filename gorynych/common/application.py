@@ -1,60 +1,141 @@
 __author__ = 'Boris Tsema'
 
 from twisted.application.service import Service
-from twisted.internet import task, reactor, defer
+from twisted.internet import reactor, defer
 from twisted.python import log
+from txpostgres import txpostgres, reconnection
+
+from gorynych.eventstore.store import DISPATCH_CHANNEL, UNDISPATCHED_EVENTS
 
 
 EVENT_DISPATCHED = """
     DELETE FROM dispatch WHERE event_id = %s
     """
 
-RETURN_UNDISPATCHED = """
-    UPDATE dispatch SET TAKEN=FALSE, TIME=NOW() WHERE event_id=%s;
+EVENTS_DISPATCHED = """
+    DELETE FROM dispatch WHERE event_id = ANY(%s)
     """
 
 class EventPollingService(Service):
     '''
-    Start to read events from db on start.
+    Dispatch events from event store to process_<EventName> methods.
+    Service listens for notifications about appended events and claims
+    undispatched events which it processes or drops until there are no more
+    of them. Events are also read after every (re)connection of listener, so
+    events appended while it was disconnected aren't missed. Only events
+    with names from event_names are claimed, so services of different types
+    don't take each other's events.
     '''
-    dont_dispatch = set(['PersonGotTrack', 'PointsAddedToTrack', 'RaceCheckpointsChanged',
-        'ParagliderRegisteredOnContest', 'TrackCheckpointTaken', 'TrackFinished',
-        'TrackFinishTimeReceived', 'TrackStarted', 'TrackEnded', 'TrackCreated', 'TrackArchiveUnpacked', 'TrackArchiveParsed', 'TrackWasNotParsed', 'TrackerAssigned', 'TrackerUnAssigned', 'TrackInAir', 'TrackSlowedDown',
-        'TrackSpeedExceeded', 'TrackLanded'])
-    polling_interval = 1
-
-    def __init__(self, pool, event_store):
+    # Event store doesn't put these events into dispatch table, rows which
+    # were left there are dropped.
+    dont_dispatch = set(UNDISPATCHED_EVENTS)
+    # How many events are claimed at once.
+    batch_size = 100
+    # Seconds before events are claimed again after failed claim.
+    retry_interval = 5
+    # Delayed call of claim after error.
+    _retry = None
+
+    def __init__(self, pool, event_store, batch_size=None):
         self.in_progress = set()
         self.pool = pool
         self.event_store = event_store
-        self.event_poller = task.LoopingCall(self.poll_for_events)
+        if batch_size:
+            self.batch_size = batch_size
+        # Names of events which are processed by this service.
+        self.event_names = set(
+            name[len('process_'):] for name in dir(self)
+            if name.startswith('process_') and name != 'process_events'
+        ) - self.dont_dispatch
+        # Connection which listens for appended events.
+        self.listener = None
+        self._loading = False
+        self._more = False
 
+    @defer.inlineCallbacks
     def startService(self):
-        self.pool.start()
-        log.msg("DB pool started.")
-        self.event_poller.start(self.polling_interval)
         Service.startService(self)
+        yield self.pool.start()
+        log.msg("DB pool started.")
+        # Trigger of database created from sql scripts is created by code,
+        # so events are dispatched by its list of undispatched events.
+        yield self.event_store.store.install_dispatch().addErrback(log.err,
+            "Dispatch trigger isn't installed")
+        self.listener = txpostgres.Connection(
+            detector=reconnection.DeadConnectionDetector())
+        self.listener.addNotifyObserver(self._on_notify)
+        self.listener.detector.addRecoveryHandler(self._listen)
+        d = self.listener.connect(*self.pool.connargs, **self.pool.connkw)
+        d.addCallbacks(lambda _: self._listen(),
+            self.listener.detector.checkForDeadConnection)
+        d.addErrback(log.err, "Events listener isn't connected")
+        yield d
         log.msg("EventPollinService %s started." % self.__class__.__name__)
 
     def stopService(self):
-        self.event_poller.stop()
         Service.stopService(self)
+        if self._retry and self._retry.active():
+            self._retry.cancel()
+        if self.listener:
+            self.listener.detector.removeRecoveryHandler(self._listen)
+            self.listener.close()
         return self.pool.close()
 
-    def poll_for_events(self):
-        d = self.event_store.load_undispatched_events()
-        d.addCallback(self.process_events)
+    def _listen(self):
+        d = self.listener.runOperation("LISTEN %s" % DISPATCH_CHANNEL)
+        # Notifications could be missed while listener was disconnected.
+        d.addCallback(lambda _: self.poll_for_events())
         return d
 
+    def _on_notify(self, notify):
+        if notify.payload in self.event_names:
+            self.poll_for_events()
+
+    def poll_for_events(self):
+        '''
+        Claim and process events by batches until there are no more of
+        them. Calls made while events are being claimed are joined into one
+        more claim.
+        '''
+        if self._loading:
+            self._more = True
+            return defer.succeed(None)
+        return self._load_events()
+
+    @defer.inlineCallbacks
+    def _load_events(self):
+        self._loading = True
+        try:
+            while True:
+                self._more = False
+                event_list = yield self.event_store.load_undispatched_events(
+                    self.event_names, self.batch_size)
+                event_list = event_list or []
+                claimed = len(event_list)
+                yield self.process_events(event_list)
+                if not self._more and claimed < self.batch_size:
+                    break
+        except Exception as e:
+            log.err(e, "Error while loading events in %s" %
+                self.__class__.__name__)
+            self._schedule_retry()
+        finally:
+            self._loading = False
+
+    def _schedule_retry(self):
+        if self.running and not (self._retry and self._retry.active()):
+            self._retry = reactor.callLater(self.retry_interval,
+                self.poll_for_events)
+
     @defer.inlineCallbacks
     def process_events(self, event_list):
-        while event_list:
-            ev = event_list.pop()
+        dropped = []
+        for ev in event_list or []:
             if ev.id in self.in_progress:
                 continue
             evname = ev.__class__.__name__
             if evname in self.dont_dispatch:
-                yield self.event_dispatched(ev.id)
+                dropped.append(long(ev.id))
                 continue
             attr = 'process_' + evname
             if hasattr(self, attr):
@@ -62,9 +143,10 @@ class EventPollingService(Service):
                                             self.__class__.__name__))
                 reactor.callLater(0, getattr(self, attr), ev)
             else:
-                log.msg("Event %s returned undispatched from %s" % (evname,
+                log.msg("Event %s isn't processed by %s" % (evname,
                                                     self.__class__.__name__))
-                yield self.pool.runOperation(RETURN_UNDISPATCHED, (ev.id,))
+        if dropped:
+            yield self.pool.runOperation(EVENTS_DISPATCHED, (dropped,))
 
     def event_dispatched(self, ev_id):
         if ev_id in self.in_progress:
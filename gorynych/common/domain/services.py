@@ -3,6 +3,7 @@ __author__ = 'Boris Tsema'
 import math
 import decimal
 
+import numpy as np
 import requests
 import simplejson as json
 from twisted.python import log
@@ -127,6 +128,27 @@ def point_dist_calculator(start_lat, start_lon, end_lat, end_lon):
     return c
 
 
+def vector_dist_calculator(start_lat, start_lon, end_lat, end_lon):
+    """
+    Vectorized L{point_dist_calculator}. Arguments can be arrays or scalars
+    and are broadcasted against each other. Operations are done in the
+    same order as in scalar function so results are the same.
+    @return: distances in meters.
+    @rtype: C{numpy.ndarray} of float64
+    """
+    start_lat = np.radians(np.asarray(start_lat, dtype=np.float64))
+    start_lon = np.radians(np.asarray(start_lon, dtype=np.float64))
+    end_lat = np.radians(np.asarray(end_lat, dtype=np.float64))
+    end_lon = np.radians(np.asarray(end_lon, dtype=np.float64))
+    d_lat = end_lat - start_lat
+    d_lon = end_lon - start_lon
+    df = 2 * np.arcsin(
+        np.sqrt(
+            np.sin(d_lat/2)**2 + np.cos(start_lat) * np.cos(end_lat) * np.sin(d_lon/2)**2))
+    c = df * EARTH_RADIUS
+    return c
+
+
 def bearing(start_lat, start_lon, end_lat, end_lon):
     '''
     Calculate bearing between points.
@@ -167,6 +189,37 @@ def bearing(start_lat, start_lon, end_lat, end_lon):
     return (z + 360.) % 360.
 
 
+def vector_bearing(start_lat, start_lon, end_lat, end_lon):
+    '''
+    Vectorized L{bearing}. Arguments are broadcasted against each other.
+    @return: bearings in degrees.
+    @rtype: C{numpy.ndarray} of float64
+    '''
+    start_lat = np.asarray(start_lat, dtype=np.float64)
+    start_lon = np.asarray(start_lon, dtype=np.float64)
+    end_lat = np.asarray(end_lat, dtype=np.float64)
+    end_lon = np.asarray(end_lon, dtype=np.float64)
+    lat1 = start_lat * math.pi / 180
+    lat2 = end_lat * math.pi / 180
+    lon1 = start_lon * math.pi / 180
+    lon2 = end_lon * math.pi / 180
+
+    cl1, cl2 = np.cos(lat1), np.cos(lat2)
+    sl1, sl2 = np.sin(lat1), np.sin(lat2)
+    cdelta = np.cos(lon2 - lon1)
+    sdelta = np.sin(lon2 - lon1)
+
+    x = (cl1 * sl2) - (sl1 * cl2 * cdelta)
+    y = sdelta * cl2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.degrees(np.arctan(y / x))
+    z = np.where(x < 0, z + 180, z)
+    result = (z + 360.) % 360.
+    # Same points and zero division give zero bearing as in scalar version.
+    zero = (x == 0) | ((start_lat == end_lat) & (start_lon == end_lon))
+    return np.where(zero, 0., result)
+
+
 def times_from_checkpoints(checkpoints):
     '''
     Look for checkpoints and get race times from them.
@@ -2,8 +2,10 @@ import unittest
 from unittest import TestCase
 
 import mock
+import numpy as np
 
 from gorynych.common.domain.services import times_from_checkpoints, bearing, SinglePollerService
+from gorynych.common.domain.services import point_dist_calculator, vector_dist_calculator, vector_bearing
 from gorynych.common.exceptions import BadCheckpoint
 from gorynych.info.domain.test.helpers import create_checkpoints
 from gorynych.common.infrastructure.messaging import FakeRabbitMQObject, RabbitMQObject
@@ -68,3 +70,55 @@ class TestBearing(TestCase):
             "Wrong bearing")
         self.assertAlmostEqual(91.00, bearing(61, 1, 60.96056, 3.31222), 2,
             "Wrong bearing")
+
+
+class TestVectorDistCalculator(TestCase):
+    def setUp(self):
+        np.random.seed(11)
+        self.lat1 = np.random.uniform(-80, 80, 500)
+        self.lon1 = np.random.uniform(-180, 180, 500)
+        self.lat2 = self.lat1 + np.random.uniform(-0.5, 0.5, 500)
+        self.lon2 = self.lon1 + np.random.uniform(-0.5, 0.5, 500)
+
+    def test_arrays(self):
+        result = vector_dist_calculator(self.lat1, self.lon1, self.lat2,
+            self.lon2)
+        self.assertEqual(result.shape, (500,))
+        expected = [point_dist_calculator(*p) for p in
+            zip(self.lat1, self.lon1, self.lat2, self.lon2)]
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_array_and_point(self):
+        result = vector_dist_calculator(self.lat1, self.lon1, 45.5, 6.5)
+        expected = [point_dist_calculator(lat, lon, 45.5, 6.5) for lat, lon
+            in zip(self.lat1, self.lon1)]
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_float32_points(self):
+        lat, lon = self.lat1.astype('f4'), self.lon1.astype('f4')
+        result = vector_dist_calculator(lat, lon, 45.5, 6.5)
+        expected = [point_dist_calculator(lat[i], lon[i], 45.5, 6.5)
+            for i in range(len(lat))]
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_scalars(self):
+        self.assertAlmostEqual(float(vector_dist_calculator(60, 0, 61, 1)),
+            point_dist_calculator(60, 0, 61, 1), 6)
+        self.assertEqual(float(vector_dist_calculator(45, 45, 45, 45)), 0)
+
+
+class TestVectorBearing(TestCase):
+    def test_parity(self):
+        np.random.seed(12)
+        lat = np.random.uniform(-80, 80, 500)
+        lon = np.random.uniform(-180, 180, 500)
+        result = vector_bearing(45.5, 6.5, lat, lon)
+        expected = [bearing(45.5, 6.5, lat[i], lon[i]) for i in
+            range(len(lat))]
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_special_cases(self):
+        result = vector_bearing(45, 45, [45, 60, 61], [45, 0, 1])
+        self.assertEqual(list(result[:2]), [bearing(45, 45, 45, 45),
+            bearing(45, 45, 60, 0)])
+        self.assertEqual(list(vector_bearing(60, 0, [61], [0])), [0.])
@@ -5,7 +5,7 @@ import simplejson as json
 
 from shapely.geometry import shape
 from gorynych.common.domain.model import ValueObject
-from gorynych.common.domain.services import point_dist_calculator
+from gorynych.common.domain.services import vector_dist_calculator
 
 
 class Name(ValueObject):
@@ -141,7 +141,7 @@ class Checkpoint(ValueObject):
             raise TypeError("Unknown type %s" % type(point))
         _lat = self.__geo_interface__['geometry']['coordinates'][0]
         _lon = self.__geo_interface__['geometry']['coordinates'][1]
-        return point_dist_calculator(lat, lon, _lat, _lon)
+        return float(vector_dist_calculator(lat, lon, _lat, _lon))
 
     @property
     def __geo_interface__(self):
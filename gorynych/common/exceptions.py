@@ -7,6 +7,12 @@ class NoAggregate(Exception):
     '''
 
 
+class UnknownStatement(LookupError):
+    '''
+    Raised when tagged SQL statement can't be found.
+    '''
+
+
 class DatabaseValueError(Exception):
     '''
     Raise when values from database are not so good as expected.
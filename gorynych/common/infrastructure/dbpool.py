@@ -0,0 +1,237 @@
+'''
+Pool of asynchronous PostgreSQL connections for all services.
+
+AsyncConnectionPool has the interface of adbapi.ConnectionPool, so
+repositories work with it as is. Queries and operations run on txpostgres
+connections and don't occupy threads. Interactions are functions which get
+blocking DB-API cursor (they use COPY and fetch results synchronously), so
+they run in threads of a small adbapi pool which is opened on first
+interaction.
+'''
+import re
+import time
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, task
+from twisted.python import log
+from txpostgres import txpostgres, reconnection
+
+
+def prepared_statement(name, query):
+    '''
+    Convert query with positional %s parameters into PREPARE command.
+    @param name: statement name.
+    @type name: C{str}
+    @param query: single SQL statement.
+    @type query: C{str}
+    @return: (PREPARE command, number of parameters)
+    @rtype: C{tuple}
+    '''
+    if '%(' in query:
+        raise ValueError("Only positional parameters can be prepared: %s"
+            % query)
+    numbers = []
+
+    def parameter(match):
+        if match.group(1) == '%':
+            return '%'
+        numbers.append(len(numbers) + 1)
+        return '$%d' % numbers[-1]
+
+    body = re.sub(r'%(%|s)', parameter, query.strip().rstrip(';'))
+    if ';' in body:
+        raise ValueError("Only single statement can be prepared: %s" % query)
+    return 'PREPARE %s AS %s' % (name, body), len(numbers)
+
+
+class AsyncConnectionPool(txpostgres.ConnectionPool):
+    '''
+    txpostgres pool with adbapi.ConnectionPool interface, statements which
+    are registered with L{prepare} are prepared on every connection at first
+    use and executed by name after that. Dead connections are reconnected.
+    Pool starts on first request if it wasn't started.
+    '''
+    def __init__(self, min=10, interaction_threads=3, stats_interval=None,
+            **connkw):
+        '''
+        @param min: number of connections.
+        @type min: C{int}
+        @param interaction_threads: maximum number of threads for
+        interactions.
+        @type interaction_threads: C{int}
+        @param stats_interval: how often to log pool stats, in seconds.
+        @type stats_interval: C{int}
+        @param connkw: psycopg2.connect keyword arguments.
+        '''
+        txpostgres.ConnectionPool.__init__(self, None, min=min, **connkw)
+        self.stats_interval = stats_interval
+        self._stats_logger = task.LoopingCall(
+            lambda: log.msg("Database pool: %r" % self.stats()))
+        self.interaction_threads = interaction_threads
+        self.interactions = None
+        self.running = False
+        self._starting = []
+        # {query:(statement name, PREPARE command, number of parameters)}
+        self._statements = {}
+        # {connection:set of prepared statement names}
+        self._prepared = {}
+        self.waiting = 0
+        self._stats = dict(queries=0, interactions=0, wait_time=0.,
+            max_wait_time=0., max_waiting=0)
+
+    def connectionFactory(self, reactor=None, cooperator=None):
+        connection = txpostgres.Connection(reactor, cooperator,
+            detector=reconnection.DeadConnectionDetector())
+        connection.detector.addRecoveryHandler(
+            lambda: self._prepared.pop(connection, None))
+        return connection
+
+    def start(self):
+        '''
+        Connect all connections, can be called many times.
+        @return: Deferred which fires with pool when it's started.
+        '''
+        if self.running:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._starting.append(d)
+        if len(self._starting) == 1:
+            txpostgres.ConnectionPool.start(self).addCallbacks(
+                self._started, self._started, callbackArgs=(True,),
+                errbackArgs=(False,))
+        return d
+
+    def _started(self, result, running):
+        self.running = running
+        if running and self.stats_interval:
+            self._stats_logger.start(self.stats_interval, now=False)
+        waiting, self._starting = self._starting, []
+        for d in waiting:
+            if self.running:
+                d.callback(self)
+            else:
+                d.errback(result)
+
+    def close(self):
+        '''
+        Close connections, pool is shared by services so it can be closed
+        many times.
+        '''
+        if self.running:
+            self.running = False
+            txpostgres.ConnectionPool.close(self)
+        if self._stats_logger.running:
+            self._stats_logger.stop()
+        if self.interactions:
+            self.interactions.close()
+            self.interactions = None
+
+    def prepare(self, query):
+        '''
+        Register query to be executed as prepared statement.
+        @param query: single statement with positional %s parameters.
+        @type query: C{str}
+        @return: statement name.
+        @rtype: C{str}
+        '''
+        if query not in self._statements:
+            name = 'gorynych_%d' % len(self._statements)
+            self._statements[query] = (name,) + \
+                prepared_statement(name, query)
+        return self._statements[query][0]
+
+    def stats(self):
+        '''
+        @return: connections number, idle connections, requests waiting for
+        connection, executed queries and interactions, total and maximum
+        time of waiting for connection.
+        @rtype: C{dict}
+        '''
+        result = dict(self._stats, size=self.min, idle=len(self.connections),
+            waiting=self.waiting, prepared=len(self._statements))
+        if self.interactions:
+            result['interaction_threads'] = len(
+                self.interactions.threadpool.threads)
+        return result
+
+    def runQuery(self, *args, **kwargs):
+        return self._run(self._runQuery, *args, **kwargs)
+
+    def runOperation(self, *args, **kwargs):
+        return self._run(self._runOperation, *args, **kwargs)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        '''
+        Run interaction with blocking DB-API cursor in a thread, as
+        adbapi.ConnectionPool does.
+        '''
+        if not self.interactions:
+            self.interactions = adbapi.ConnectionPool('psycopg2',
+                cp_min=1, cp_max=self.interaction_threads,
+                cp_reconnect=True, **self.connkw)
+        self._stats['interactions'] += 1
+        return self.interactions.runInteraction(interaction, *args, **kwargs)
+
+    def _run(self, method, *args, **kwargs):
+        if not self.running:
+            return self.start().addCallback(
+                lambda _: self._run(method, *args, **kwargs))
+        requested = time.time()
+        self.waiting += 1
+        self._stats['max_waiting'] = max(self._stats['max_waiting'],
+            self.waiting)
+
+        def acquired():
+            self.waiting -= 1
+            waited = time.time() - requested
+            self._stats['wait_time'] += waited
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'],
+                waited)
+            self._stats['queries'] += 1
+            return method(*args, **kwargs)
+
+        return self._semaphore.run(acquired)
+
+    def _runQuery(self, query, *args, **kwargs):
+        return self._runStatement('runQuery', query, *args, **kwargs)
+
+    def _runOperation(self, query, *args, **kwargs):
+        return self._runStatement('runOperation', query, *args, **kwargs)
+
+    def _runStatement(self, method, query, args=None, **kwargs):
+        c = self.connections.pop()
+        if query in self._statements:
+            d = self._prepare(c, query)
+            name, _, number = self._statements[query]
+            query = 'EXECUTE %s' % name
+            if number:
+                query += ' (%s)' % ', '.join(['%s'] * number)
+            d.addCallback(lambda _: getattr(c, method)(query, args, **kwargs))
+        else:
+            d = getattr(c, method)(query, args, **kwargs)
+        return d.addBoth(self._putBackAndPassthrough, c)
+
+    def _prepare(self, connection, query):
+        name, command, _ = self._statements[query]
+        prepared = self._prepared.setdefault(connection, set())
+        if name in prepared:
+            return defer.succeed(None)
+        d = connection.runOperation(command)
+        d.addCallback(lambda _: prepared.add(name))
+        return d
+
+
+def make_pool(config, **kwargs):
+    '''
+    Create pool from gorynych options.
+    @param config: options with dbhost, dbname, dbuser, dbpassword,
+    dbconnections and poolthreads.
+    @rtype: L{AsyncConnectionPool}
+    '''
+    kwargs.setdefault('min', config['dbconnections'])
+    kwargs.setdefault('interaction_threads', config['poolthreads'])
+    kwargs.setdefault('stats_interval', 60)
+    pool = AsyncConnectionPool(host=config['dbhost'], database=config['dbname'],
+        user=config['dbuser'], password=config['dbpassword'], **kwargs)
+    log.msg("Database pool with %s connections created" % pool.min)
+    return pool
@@ -7,9 +7,14 @@ For retreiving repository instance client use interface class as id.
 
 '''
 from io import BytesIO
+import itertools
 import os
 import re
+import struct
 
+import numpy as np
+
+from gorynych.common.exceptions import UnknownStatement
 from gorynych.eventstore.interfaces import IEventStore
 
 global_repository_registry = dict()
@@ -58,7 +63,7 @@ def create_tables(fname):
     @return: list of commands or None.
     '''
     with open(sqldir + fname + '.sql', 'r') as f:
-        tables = re.findall(r'''(CREATE\s+TABLE\s+[-(),.\s\w\\]*);''',
+        tables = re.findall(r'''(CREATE\s+TABLE\s+[-(),.\s\w\\\[\]]*);''',
                             f.read(), re.IGNORECASE)
     return tables
 
@@ -115,19 +120,128 @@ def update(name, filename=None):
     return _operation('update', name, filename)
 
 
+# Tagged statement: "-- Operation name" line followed by command.
+STATEMENT_PATTERN = re.compile(r'--\s+(insert|select|update)\s?(\w+)\n'
+    r'''\s*([\w()\s.,%=<>"'\*+]*);''', re.IGNORECASE)
+
+
+def load_statements(directory=None):
+    '''
+    Read tagged statements from all sql files in directory.
+    @param directory: directory with sql files, sqldir by default.
+    @type directory: C{str}
+    @return: {(operation, tag name, file name):command}, keys are in
+    lower case. If tag is repeated in file its first statement is taken.
+    @rtype: C{dict}
+    '''
+    directory = directory or sqldir
+    result = {}
+    for fname in sorted(os.listdir(directory)):
+        if not fname.endswith('.sql'):
+            continue
+        with open(os.path.join(directory, fname), 'r') as f:
+            text = f.read()
+        for match in STATEMENT_PATTERN.finditer(text):
+            key = (match.group(1).lower(), match.group(2).lower(),
+                fname[:-len('.sql')].lower())
+            result.setdefault(key, match.group(3))
+    return result
+
+
+# Statements are read once, lookups don't touch disk.
+statements = load_statements()
+
+
 def _operation(name, tagname, filename=None):
     if not filename:
         filename = tagname
-    with open(sqldir + filename + '.sql', 'r') as f:
-        pattern = r'--\s+' + name + r'\s?' + tagname + \
-                  r'''\n\s*([\w()\s.,%="'\*+]*);'''
-        command = re.search(pattern, f.read(), re.IGNORECASE)
-    return command.group(1)
+    try:
+        return statements[(name.lower(), tagname.lower(), filename.lower())]
+    except KeyError:
+        raise UnknownStatement("No statement tagged '-- %s %s' in %s.sql"
+            % (name, tagname, filename))
+
+
+def prepare(pool, *queries):
+    '''
+    Make queries server-side prepared statements if pool supports them
+    (see L{gorynych.common.infrastructure.dbpool.AsyncConnectionPool}).
+    @return: queries
+    @rtype: C{tuple}
+    '''
+    if hasattr(pool, 'prepare'):
+        for query in queries:
+            pool.prepare(query)
+    return queries
+
+
+def _text_format(dtype):
+    '''
+    Return printf-like format for COPY text representation of value of
+    given dtype. Floats are written with enough digits to be read back
+    exactly.
+    '''
+    if dtype.kind in 'iu':
+        return '%d'
+    if dtype.kind == 'f':
+        return {2: '%.5g', 4: '%.9g'}.get(dtype.itemsize, '%r')
+    return '%s'
 
 
 def np_as_text(data):
+    '''
+    Represent structured array as data for COPY in text format. All rows
+    are formatted by one string formatting operation.
+    @param data: structured array.
+    @type data: C{numpy.ndarray}
+    @return: file-like object with data.
+    @rtype: C{BytesIO}
+    '''
+    row = '\t'.join(_text_format(data.dtype[i])
+        for i in xrange(len(data.dtype))) + '\n'
+    values = tuple(itertools.chain.from_iterable(data.tolist()))
+    cpy = BytesIO()
+    cpy.write((row * len(data)) % values)
+    cpy.seek(0)
+    return(cpy)
+
+
+# Header and trailer of PostgreSQL binary COPY format: signature, flags
+# and header extension length; tuple with -1 fields.
+PGCOPY_HEADER = 'PGCOPY\n\377\r\n\0' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+# Numpy (kind, size) which can be written as PostgreSQL numbers.
+BINARY_TYPES = [('i', 2), ('i', 4), ('i', 8), ('f', 4), ('f', 8)]
+
+
+def np_as_binary(data):
+    '''
+    Represent structured array as data for COPY in binary format. Every
+    field is written as big-endian value of the same size, so fields must
+    have types of table columns: i2, i4, i8 for SMALLINT, INTEGER, BIGINT
+    and f4, f8 for REAL and DOUBLE PRECISION.
+    @param data: structured array.
+    @type data: C{numpy.ndarray}
+    @return: file-like object with data.
+    @rtype: C{BytesIO}
+    '''
+    names = data.dtype.names
+    layout = [('count', '>i2')]
+    for name in names:
+        field = data.dtype[name]
+        if (field.kind, field.itemsize) not in BINARY_TYPES:
+            raise ValueError("Field %s of type %s can't be written in "
+                             "binary COPY." % (name, field))
+        layout.append(('len_' + name, '>i4'))
+        layout.append((name, field.newbyteorder('>')))
+    rows = np.empty(len(data), dtype=layout)
+    rows['count'] = len(names)
+    for name in names:
+        rows['len_' + name] = data.dtype[name].itemsize
+        rows[name] = data[name]
     cpy = BytesIO()
-    for row in data:
-        cpy.write('\t'.join([repr(x) for x in row]) + '\n')
+    cpy.write(PGCOPY_HEADER)
+    cpy.write(rows.tostring())
+    cpy.write(PGCOPY_TRAILER)
     cpy.seek(0)
     return(cpy)
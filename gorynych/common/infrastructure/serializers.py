@@ -100,4 +100,23 @@ class PickleSerializer(object):
         return buffer(cPickle.dumps(value, -1))
 
     def from_bytes(self, value):
-        return cPickle.loads(str(value))
\ No newline at end of file
+        return cPickle.loads(str(value))
+
+
+class SnapshotSerializer(PickleSerializer):
+    '''
+    Pickle aggregate state with version of its structure. Version must be
+    changed when state class changes, then old snapshots aren't read.
+    '''
+    def __init__(self, version):
+        self.version = version
+
+    def to_bytes(self, value):
+        return PickleSerializer.to_bytes(self, (self.version, value))
+
+    def from_bytes(self, value):
+        version, state = PickleSerializer.from_bytes(self, value)
+        if version != self.version:
+            raise exceptions.DeserializationError("Snapshot version %s, "
+                "expected %s" % (version, self.version))
+        return state
\ No newline at end of file
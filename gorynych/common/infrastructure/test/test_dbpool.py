@@ -0,0 +1,114 @@
+import unittest
+
+from twisted.internet import defer
+
+from gorynych.common.infrastructure import dbpool
+
+
+def result_of(d):
+    result = []
+    d.addBoth(result.append)
+    if not result:
+        raise AssertionError("Deferred hasn't fired")
+    if hasattr(result[0], 'raiseException'):
+        result[0].raiseException()
+    return result[0]
+
+
+class FakeConnection(object):
+    '''
+    Connection which records queries and answers them when told to.
+    '''
+    def __init__(self):
+        self.queries = []
+        self.pending = []
+
+    def connect(self, *args, **kwargs):
+        return defer.succeed(self)
+
+    def runQuery(self, query, args=None):
+        self.queries.append((query, args))
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    runOperation = runQuery
+
+    def answer(self):
+        while self.pending:
+            self.pending.pop(0).callback([(1,)])
+
+    def close(self):
+        pass
+
+
+class FakeConnectionPool(dbpool.AsyncConnectionPool):
+    def connectionFactory(self, reactor=None, cooperator=None):
+        connection = FakeConnection()
+        self.__dict__.setdefault('created', []).append(connection)
+        return connection
+
+
+class TestPreparedStatement(unittest.TestCase):
+    def test_parameters(self):
+        self.assertEqual(dbpool.prepared_statement('s', """
+            SELECT * FROM t WHERE a = %s AND b LIKE 'x%%s'
+            AND c = ANY(%s::int[]);
+            """), ("PREPARE s AS SELECT * FROM t WHERE a = $1 AND b LIKE "
+            "'x%s'\n            AND c = ANY($2::int[])", 2))
+
+    def test_not_preparable(self):
+        self.assertRaises(ValueError, dbpool.prepared_statement, 's',
+            "SELECT 1; SELECT %s;")
+        self.assertRaises(ValueError, dbpool.prepared_statement, 's',
+            "SELECT %(a)s")
+
+
+class TestAsyncConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = FakeConnectionPool(min=2)
+
+    def test_started_on_first_query(self):
+        self.assertFalse(self.pool.running)
+        d = self.pool.runQuery("SELECT %s", (1,))
+        self.assertTrue(self.pool.running)
+        sent = [c for c in self.pool.created if c.queries]
+        self.assertEqual(len(sent), 1)
+        sent[0].answer()
+        self.assertEqual(result_of(d), [(1,)])
+
+    def test_waiting_for_connection(self):
+        self.pool.start()
+        connections = self.pool.created
+        ds = [self.pool.runOperation("UPDATE t SET a=%s", (i,))
+            for i in range(3)]
+        stats = self.pool.stats()
+        self.assertEqual((stats['queries'], stats['waiting'], stats['idle']),
+            (2, 1, 0))
+        for c in connections:
+            c.answer()
+        self.assertEqual(self.pool.stats()['waiting'], 0)
+        for c in connections:
+            c.answer()
+        for d in ds:
+            result_of(d)
+        stats = self.pool.stats()
+        self.assertEqual((stats['queries'], stats['max_waiting'],
+            stats['idle'], stats['size']), (3, 1, 2, 2))
+
+    def test_prepared_once_per_connection(self):
+        query = "SELECT * FROM t WHERE id = %s;"
+        name = self.pool.prepare(query)
+        self.assertEqual(self.pool.prepare(query), name)
+        self.pool.start()
+        connection = list(self.pool.connections)[0]
+        self.pool.connections = set([connection])
+        for i in range(2):
+            d = self.pool.runQuery(query, (i,))
+            connection.answer()
+            connection.answer()
+            result_of(d)
+        self.assertEqual([q for q, args in connection.queries], [
+            "PREPARE %s AS SELECT * FROM t WHERE id = $1" % name,
+            "EXECUTE %s (%%s)" % name, "EXECUTE %s (%%s)" % name])
+        self.assertEqual(connection.queries[-1][1], (1,))
@@ -1,8 +1,14 @@
+import os
+import re
+import shutil
+import struct
+import tempfile
 import unittest
 
 from zope.interface.declarations import implements
 import numpy as np
 
+from gorynych.common.exceptions import UnknownStatement
 from gorynych.common.infrastructure import persistence
 from gorynych.info.domain.interfaces import IPersonRepository
 
@@ -56,6 +62,99 @@ class TestNpAsText(unittest.TestCase):
         for i in (c[2], c[3], c[5], c[6]):
             self.assertEqual(i[:8], str(1/3.)[:8])
 
+    def test_exact(self):
+        np.random.seed(1)
+        a = np.zeros(100, dtype=self.dtype)
+        for name in a.dtype.names:
+            a[name] = np.random.uniform(-1000, 30000, 100)
+        rows = persistence.np_as_text(a).read().splitlines()
+        self.assertEqual(len(rows), 100)
+        for row, line in zip(a, rows):
+            values = line.split('\t')
+            for i, (name, t) in enumerate(self.dtype):
+                self.assertEqual(np.array(float(values[i])).astype(t), row[i])
+
+    def test_empty(self):
+        a = np.empty(0, dtype=self.dtype)
+        self.assertEqual(persistence.np_as_text(a).read(), '')
+
+
+class TestNpAsBinary(unittest.TestCase):
+    def setUp(self):
+        self.dtype = [('id', 'i4'), ('timestamp', 'i4'), ('lat', 'f8'),
+            ('alt', 'i2'), ('g_speed', 'f4')]
+
+    def test_format(self):
+        a = np.zeros(2, dtype=self.dtype)
+        a['id'], a['timestamp'], a['lat'] = 7, [10, 11], 1/3.
+        a['alt'], a['g_speed'] = -5, 2.5
+        b = persistence.np_as_binary(a).read()
+        self.assertEqual(b[:19], 'PGCOPY\n\377\r\n\0' + '\0' * 8)
+        self.assertEqual(b[-2:], '\xff\xff')
+        row = struct.pack('!hiiiiidihif', 5, 4, 7, 4, 10, 8, 1/3., 2, -5, 4,
+            2.5)
+        self.assertEqual(b[19:19 + len(row)], row)
+        self.assertEqual(len(b), 19 + 2 * len(row) + 2)
+
+    def test_wrong_type(self):
+        a = np.zeros(1, dtype=[('name', 'S4')])
+        self.assertRaises(ValueError, persistence.np_as_binary, a)
+
+
+
+class TestStatements(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'thing.sql'), 'w') as f:
+            f.write("""
+-- Select Thing
+SELECT id, name FROM thing WHERE thing_id = %s;
+
+-- Insert thing
+INSERT INTO thing (name) VALUES (%s) RETURNING id;
+
+-- Select thing
+SELECT 'repeated';
+""")
+        with open(os.path.join(self.directory, 'README'), 'w') as f:
+            f.write("-- Select readme\nSELECT 1;")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_statements(self):
+        statements = persistence.load_statements(self.directory)
+        self.assertEqual(statements, {
+            ('select', 'thing', 'thing'):
+                "SELECT id, name FROM thing WHERE thing_id = %s",
+            ('insert', 'thing', 'thing'):
+                "INSERT INTO thing (name) VALUES (%s) RETURNING id"})
+
+    def test_lookup(self):
+        self.assertIn('p.tracker_id',
+            persistence.select('Races_Of_Device', 'race'))
+        self.assertRaises(UnknownStatement, persistence.select, 'nothing',
+            'race')
+        self.assertRaises(UnknownStatement, persistence.update, 'race',
+            'nofile')
+
+    def test_used_statements_exist(self):
+        # Statements which are looked up with literal tags anywhere in the
+        # code are in sql files.
+        call = re.compile(r"\b(?:pe|persistence)\.(select|insert|update)\("
+            r"'(\w+)'(?:,\s*'(\w+)')?\)")
+        package = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))))
+        used = []
+        for root, dirs, files in os.walk(package):
+            for fname in files:
+                if fname.endswith('.py'):
+                    with open(os.path.join(root, fname)) as f:
+                        used.extend(call.findall(f.read()))
+        self.assertTrue(used)
+        for operation, name, filename in used:
+            getattr(persistence, operation)(name, filename or None)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -52,4 +52,13 @@ class PickleSerializer(unittest.TestCase):
         import numpy as np
         a = np.arange(5)
         s = serializers.PickleSerializer()
-        self.assertTrue((a == s.from_bytes(s.to_bytes(a))).all())
\ No newline at end of file
+        self.assertTrue((a == s.from_bytes(s.to_bytes(a))).all())
+
+
+class SnapshotSerializerTest(unittest.TestCase):
+    def test_versions(self):
+        s = serializers.SnapshotSerializer(1)
+        data = s.to_bytes({'a': [1, 2]})
+        self.assertEqual(s.from_bytes(data), {'a': [1, 2]})
+        self.assertRaises(exceptions.DeserializationError,
+            serializers.SnapshotSerializer(2).from_bytes, data)
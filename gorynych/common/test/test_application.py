@@ -0,0 +1,90 @@
+import unittest
+
+import mock
+from twisted.internet import defer
+
+from gorynych.common import application
+from gorynych.common.application import EventPollingService
+from gorynych.common.domain import events
+
+
+class Service(EventPollingService):
+    batch_size = 2
+
+    def process_ArchiveURLReceived(self, ev):
+        pass
+
+
+class TestEventPollingService(unittest.TestCase):
+    def setUp(self):
+        self.event_store = mock.Mock()
+        self.claims = []
+
+        def load_undispatched_events(names, limit):
+            d = defer.Deferred()
+            self.claims.append(d)
+            return d
+        self.event_store.load_undispatched_events.side_effect = \
+            load_undispatched_events
+        self.service = Service(mock.Mock(), self.event_store)
+        self.service.process_events = mock.Mock(return_value=None)
+
+    def events(self, number):
+        return [events.TrackerAssigned('pers-1', aggregate_type='person')
+            for i in range(number)]
+
+    def test_event_names(self):
+        self.assertIn('ArchiveURLReceived', self.service.event_names)
+        self.assertNotIn('TrackerAssigned', self.service.event_names)
+        self.assertNotIn('events', self.service.event_names)
+        self.service.poll_for_events()
+        self.assertEqual(self.event_store.load_undispatched_events.call_args,
+            mock.call(self.service.event_names, 2))
+
+    def test_claimed_until_drained(self):
+        self.service.poll_for_events()
+        self.claims[0].callback(self.events(2))
+        self.assertEqual(len(self.claims), 2)
+        self.claims[1].callback(self.events(1))
+        self.assertEqual(len(self.claims), 2)
+        self.assertEqual(self.service.process_events.call_count, 2)
+        self.assertFalse(self.service._loading)
+
+    @mock.patch.object(application, 'reactor')
+    def test_failed_claim_retried(self, reactor):
+        self.service.running = 1
+        self.service.poll_for_events()
+        self.claims[0].errback(Exception("Connection lost"))
+        self.assertFalse(self.service._loading)
+        self.assertEqual(reactor.callLater.call_args, mock.call(
+            self.service.retry_interval, self.service.poll_for_events))
+        reactor.callLater.return_value.active.return_value = True
+        self.service.poll_for_events()
+        self.claims[1].errback(Exception("Connection lost"))
+        self.assertEqual(reactor.callLater.call_count, 1)
+        self.service.stopService()
+        reactor.callLater.return_value.cancel.assert_called_once_with()
+
+    def test_notifications_are_joined(self):
+        self.service.poll_for_events()
+        for payload in ['ArchiveURLReceived', 'TrackerAssigned',
+                'UnknownEvent']:
+            self.service._on_notify(mock.Mock(payload=payload))
+        self.assertEqual(len(self.claims), 1)
+        self.claims[0].callback(None)
+        self.assertEqual(len(self.claims), 2)
+        self.claims[1].callback([])
+        self.assertEqual(len(self.claims), 2)
+        self.service._on_notify(mock.Mock(payload='UnknownEvent'))
+        self.assertEqual(len(self.claims), 2)
+
+    def test_dropped_events_deleted_at_once(self):
+        service = Service(mock.Mock(), self.event_store, batch_size=10)
+        self.assertEqual(service.batch_size, 10)
+        evs = self.events(3)
+        for i, ev in enumerate(evs):
+            ev.id = i + 1
+        service.process_events(evs)
+        self.assertEqual(service.pool.runOperation.call_args,
+            mock.call(application.EVENTS_DISPATCHED, ([1L, 2L, 3L],)))
+        self.assertEqual(service.pool.runOperation.call_count, 1)
@@ -22,21 +22,62 @@ class EventStore(object):
         '''
         self.store = store
 
-    def load_events(self, id):
+    def load_events(self, id, after=0):
         '''
 
         @param id: identificator of aggregate for which to load events.
         @type id: C{DomainIdentifier} subclass.
+        @param after: load only events appended after event with this id.
+        @type after: C{int}
         @return: list of events.
         @rtype: C{list}.
         '''
-        d = self.store.load_events(str(id))
+        d = self.store.load_events(str(id), after)
         return d.addCallback(self._construct_event_list)
 
-    def load_undispatched_events(self):
-        d = self.store.load_undispatched_events()
+    def load_undispatched_events(self, names=None, limit=100):
+        d = self.store.load_undispatched_events(names, limit)
         return d.addCallback(self._construct_event_list)
 
+    def load_events_since(self, event_id, names):
+        '''
+        Load events which were persisted after event with event_id.
+        @param event_id: id of the last known event.
+        @type event_id: C{int}
+        @param names: names of event classes to load.
+        @type names: C{list}
+        @return: events ordered by id.
+        @rtype: C{list}
+        '''
+        d = self.store.load_events_since(event_id, names)
+        d.addCallback(self._construct_event_list)
+        return d.addCallback(lambda result: result or [])
+
+    def last_event_id(self):
+        return self.store.last_event_id()
+
+    def stream_events(self, consumer, aggregate_ids=None, after=0,
+            batch_size=1000):
+        '''
+        Load events by batches without holding all of them in memory.
+        @param consumer: called with every list of events, can return
+        Deferred to delay loading of the next one.
+        @type consumer: C{callable}
+        @param aggregate_ids: load events of this aggregates, ordered by
+        aggregate and appending, all events in order of appending if None.
+        @type aggregate_ids: C{list}
+        @param after: load only events appended after event with this id.
+        @type after: C{int}
+        @param batch_size: number of events in list.
+        @type batch_size: C{int}
+        @return: Deferred which fires with number of loaded events.
+        '''
+        if aggregate_ids is not None:
+            aggregate_ids = [str(_id) for _id in aggregate_ids]
+        return self.store.stream_events(
+            lambda rows: consumer(self._construct_event_list(rows)),
+            aggregate_ids, after, batch_size)
+
     def _construct_event_list(self, stored_events):
         '''
         Create EventStream instance from a list of stored events.
@@ -70,14 +111,43 @@ class EventStore(object):
             return event
 
     def persist(self, event):
+        '''
+        Persist event or list of events at once. Persisted events get id.
+        @return: ids of persisted events.
+        @rtype: C{list}
+        '''
         if isinstance(event, list):
-            to_store = list()
-            for ev in event:
-                if ev:
-                    to_store.append(self._serialize(ev))
+            evlist = [ev for ev in event if ev]
         else:
-            to_store = [self._serialize(event)]
-        return self.store.append(to_store)
+            evlist = [event]
+        d = self.store.append([self._serialize(ev) for ev in evlist])
+        return d.addCallback(self._set_ids, evlist)
+
+    def persist_in_transaction(self, cur, event_list):
+        '''
+        Persist events in transaction of cursor, they are stored only if it
+        commits. Persisted events get id.
+        @param cur: DB-API cursor.
+        @type event_list: C{list}
+        @return: ids of persisted events.
+        @rtype: C{list}
+        '''
+        evlist = [ev for ev in event_list if ev]
+        ids = self.store.append_in_transaction(cur,
+            [self._serialize(ev) for ev in evlist])
+        return self._set_ids(ids, evlist)
+
+    def _set_ids(self, ids, evlist):
+        '''
+        @param ids: ids of appended events in order of list, as returned by
+        append of store.
+        '''
+        if len(ids) != len(evlist):
+            raise ValueError("Got %s ids for %s events" % (len(ids),
+                len(evlist)))
+        for ev, _id in zip(evlist, ids):
+            ev.id = _id
+        return ids
 
     def _serialize(self, event):
         '''
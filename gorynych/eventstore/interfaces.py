@@ -26,15 +26,30 @@ class IEventStore(Interface):
     give it to you.
     '''
 
-    def load_events(aggregate_id):
+    def load_events(aggregate_id, after=0):
         '''
-        Load events for aggregate_id.
+        Load events for aggregate_id which were persisted after event with
+        id after.
         @param aggregate_id:
         @type aggregate_id:
         @return:
         @rtype: C{list}
         '''
 
+    def persist_in_transaction(cur, event_list):
+        '''
+        Persist events in transaction of DB-API cursor cur.
+        @return: ids of persisted events.
+        '''
+
+    def stream_events(consumer, aggregate_ids=None, after=0,
+            batch_size=1000):
+        '''
+        Load events by batches and give every batch to consumer, so events
+        aren't held in memory at once.
+        @return: Deferred which fires with number of loaded events.
+        '''
+
     def persist(event):
         '''
         I persist event in store. Event must be an implementer of L{IEvent}
@@ -0,0 +1,143 @@
+'''
+Snapshots of event-sourced aggregates.
+
+Snapshot holds aggregate state after event with known id, so aggregate is
+restored from the latest snapshot and events which were appended after it
+instead of the whole history. Event ids are given when events are inserted,
+but events are visible after commit, so event with smaller id can appear
+after snapshot was saved. Snapshot keeps ids of events which were applied
+to it in a window before its event id, and events of this window are read
+again and skipped if they were applied.
+'''
+from twisted.internet import defer
+from twisted.python import log
+
+CREATE_SNAPSHOTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {snapshots_table} (
+      AGGREGATE_ID TEXT PRIMARY KEY,
+      -- Id of the last event applied to snapshot.
+      EVENT_ID BIGINT NOT NULL,
+      SNAPSHOT BYTEA NOT NULL,
+      -- Ids of events in window before EVENT_ID applied to snapshot.
+      APPLIED BIGINT[]
+    );
+    ALTER TABLE {snapshots_table} ADD COLUMN IF NOT EXISTS APPLIED BIGINT[];
+    """
+
+SAVE_SNAPSHOT = """
+    INSERT INTO {snapshots_table} (AGGREGATE_ID, EVENT_ID, SNAPSHOT, APPLIED)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (AGGREGATE_ID) DO UPDATE
+      SET EVENT_ID = EXCLUDED.EVENT_ID, SNAPSHOT = EXCLUDED.SNAPSHOT,
+        APPLIED = EXCLUDED.APPLIED
+      WHERE {snapshots_table}.EVENT_ID < EXCLUDED.EVENT_ID;
+    """
+
+LOAD_SNAPSHOT = """
+    SELECT EVENT_ID, SNAPSHOT, APPLIED FROM {snapshots_table}
+      WHERE AGGREGATE_ID = %s;
+    """
+
+SNAPSHOTS_TABLE = 'aggregate_snapshot'
+
+
+class SnapshotStore(object):
+    '''
+    Keep the latest snapshot of every aggregate of one type. Snapshot is
+    saved when aggregate is restored from more then every events.
+    '''
+    def __init__(self, pool, serializer, every=100, window=10000):
+        '''
+        @param serializer: serializer of aggregate state with to_bytes and
+        from_bytes methods.
+        @param every: how many events can be applied to the latest snapshot
+        before a new one is saved.
+        @type every: C{int}
+        @param window: how many event ids before snapshot are read again.
+        @type window: C{int}
+        '''
+        self.pool = pool
+        self.serializer = serializer
+        self.every = every
+        self.window = window
+
+    def initialize(self):
+        return self.pool.runOperation(CREATE_SNAPSHOTS_TABLE.format(
+            snapshots_table=SNAPSHOTS_TABLE))
+
+    @defer.inlineCallbacks
+    def load(self, aggregate_id):
+        '''
+        @return: (id of the last event in snapshot, state, ids of applied
+        events in window or None if they are unknown), (0, None, None) if
+        there is no snapshot or it can't be read.
+        @rtype: C{tuple}
+        '''
+        rows = yield self.pool.runQuery(LOAD_SNAPSHOT.format(
+            snapshots_table=SNAPSHOTS_TABLE), (str(aggregate_id),))
+        if not rows:
+            defer.returnValue((0, None, None))
+        event_id, data, applied = rows[0]
+        try:
+            state = self.serializer.from_bytes(data)
+        except Exception as e:
+            log.msg("Snapshot of %s can't be read, events will be replayed: "
+                "%r" % (aggregate_id, e))
+            defer.returnValue((0, None, None))
+        defer.returnValue((event_id, state, applied))
+
+    def save(self, aggregate_id, event_id, state, applied=()):
+        '''
+        Save snapshot unless newer one is saved already.
+        @param event_id: id of the last event applied to state.
+        @type event_id: C{int}
+        @param applied: ids of events applied to state, only ids in window
+        before event_id are saved.
+        @type applied: C{iterable}
+        '''
+        event_id = long(event_id)
+        applied = sorted(set(long(i) for i in applied
+            if event_id - self.window < i <= event_id))
+        return self.pool.runOperation(SAVE_SNAPSHOT.format(
+            snapshots_table=SNAPSHOTS_TABLE), (str(aggregate_id),
+            event_id, self.serializer.to_bytes(state), applied))
+
+    @defer.inlineCallbacks
+    def load_with_events(self, aggregate_id, event_store):
+        '''
+        Load the latest snapshot and events which weren't applied to it.
+        @param event_store: store with load_events(id, after) method.
+        @return: (state or None, events, ids of events in window applied to
+        snapshot)
+        @rtype: C{tuple}
+        '''
+        event_id, state, applied = yield self.load(aggregate_id)
+        if applied is None:
+            # Snapshot was saved without window.
+            after, applied = event_id, []
+        else:
+            after = max(event_id - self.window, 0)
+        event_list = yield event_store.load_events(aggregate_id, after)
+        done = set(applied)
+        event_list = [ev for ev in event_list or [] if ev.id not in done]
+        defer.returnValue((state, event_list, applied))
+
+    def save_after(self, aggregate_id, event_list, get_state, applied=()):
+        '''
+        Save snapshot if aggregate was restored from too many events.
+        Snapshot isn't important for caller, so errors are only logged.
+        @param event_list: events applied after the latest snapshot.
+        @type event_list: C{list}
+        @param get_state: function which returns state for snapshot.
+        @type get_state: C{callable}
+        @param applied: ids of events in window applied to the latest
+        snapshot, as returned by load_with_events.
+        @type applied: C{list}
+        '''
+        if len(event_list) < self.every:
+            return defer.succeed(None)
+        ids = list(applied) + [ev.id for ev in event_list]
+        d = defer.maybeDeferred(lambda: self.save(aggregate_id,
+            max(ids), get_state(), ids))
+        d.addErrback(log.err, "Snapshot of %s wasn't saved" % aggregate_id)
+        return d
@@ -1,9 +1,12 @@
 # coding=utf-8
 from collections import defaultdict
 from zope.interface import implementer
+from twisted.internet import defer, reactor, threads
 from twisted.python import log
 
 from gorynych.eventstore.interfaces import IAppendOnlyStore
+from gorynych.eventstore.snapshots import CREATE_SNAPSHOTS_TABLE, \
+    SNAPSHOTS_TABLE
 
 CREATE_EVENTS_TABLE = """
     CREATE TABLE IF NOT EXISTS {events_table}
@@ -28,6 +31,8 @@ CREATE_DISPATCH_TABLE = """
     CREATE TABLE IF NOT EXISTS {dispatch_table} (
     -- Идентификатор события
     EVENT_ID bigint NOT NULL,
+    -- Имя события, по нему сервисы выбирают свои события.
+    EVENT_NAME TEXT,
 
       TAKEN BOOLEAN DEFAULT FALSE ,
       TIME TIMESTAMP DEFAULT NOW(),
@@ -36,48 +41,163 @@ CREATE_DISPATCH_TABLE = """
     );
     """
 
+# Dispatch tables created before EVENT_NAME column was added are migrated.
+MIGRATE_DISPATCH_TABLE = """
+    ALTER TABLE {dispatch_table} ADD COLUMN IF NOT EXISTS EVENT_NAME TEXT;
+    UPDATE {dispatch_table} d SET EVENT_NAME = e.EVENT_NAME
+        FROM {events_table} e
+        WHERE d.EVENT_ID = e.EVENT_ID AND d.EVENT_NAME IS NULL;
+    """
+
+# Only not taken rows are claimed, taken rows are deleted soon after.
+CREATE_DISPATCH_INDEX = """
+    CREATE INDEX IF NOT EXISTS {dispatch_table}_claim
+        ON {dispatch_table} (EVENT_NAME, TIME) WHERE NOT TAKEN;
+    """
+
+# Aggregate is replayed from events in order of appending, so events of
+# aggregate are read by this index in EVENT_ID order without sorting. Index
+# is built concurrently, so events are appended while it's built on a big
+# table. It can't be built in transaction block.
+CREATE_EVENTS_INDEX = """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {events_table}_aggregate
+        ON {events_table} (AGGREGATE_ID, EVENT_ID);
+    """
+
+# Failed concurrent build leaves invalid index which isn't used by queries
+# and isn't built again by CREATE INDEX IF NOT EXISTS.
+INVALID_EVENTS_INDEX = """
+    SELECT NOT indisvalid FROM pg_index
+      WHERE indexrelid = to_regclass('{events_table}_aggregate');
+    """
+
+DROP_EVENTS_INDEX = """
+    DROP INDEX CONCURRENTLY IF EXISTS {events_table}_aggregate;
+    """
+
+# Events of a list are inserted by one statement, {values} is a row of
+# parameters for every event. RETURNING doesn't keep order of VALUES, so
+# every row has its ordinal in list. Ids are taken from sequence first and
+# given to rows in order of ordinals, then ids are returned with ordinals.
 INSERT_INTO_EVENTS = """
-    INSERT INTO {events_table}
-    (EVENT_NAME, AGGREGATE_ID, AGGREGATE_TYPE, EVENT_PAYLOAD, OCCURED_ON)
-    VALUES (%s, %s, %s, %s, %s);
+    WITH v (ORD, EVENT_NAME, AGGREGATE_ID, AGGREGATE_TYPE, EVENT_PAYLOAD,
+        OCCURED_ON) AS (VALUES {values}),
+    ids AS (
+      SELECT row_number() OVER (ORDER BY EVENT_ID) AS ORD, EVENT_ID
+      FROM (SELECT nextval(pg_get_serial_sequence('{events_table}',
+        'event_id')) AS EVENT_ID FROM v) seq),
+    inserted AS (
+      INSERT INTO {events_table}
+      (EVENT_ID, EVENT_NAME, AGGREGATE_ID, AGGREGATE_TYPE, EVENT_PAYLOAD,
+        OCCURED_ON)
+      SELECT ids.EVENT_ID, v.EVENT_NAME, v.AGGREGATE_ID, v.AGGREGATE_TYPE,
+        v.EVENT_PAYLOAD, v.OCCURED_ON
+      FROM v JOIN ids USING (ORD)
+      RETURNING EVENT_ID)
+    SELECT ids.ORD, ids.EVENT_ID FROM ids JOIN inserted USING (EVENT_ID);
     """
 
+EVENT_VALUES = "(%s, %s, %s, %s, %s, %s)"
+
 READ_EVENTS = """
     SELECT * FROM {events_table}
-      WHERE AGGREGATE_ID = %s
-      ORDER BY OCCURED_ON ASC;
+      WHERE AGGREGATE_ID = %s AND EVENT_ID > %s
+      ORDER BY EVENT_ID;
     """
 
+# Events which no service processes. They aren't put into dispatch table
+# and aren't announced, so services don't wake up and compete for them. It's
+# the only list of them: trigger function is created from it by initialize
+# and install_dispatch.
+UNDISPATCHED_EVENTS = ('ParagliderRegisteredOnContest', 'PersonGotTrack',
+    'PointsAddedToTrack', 'RaceCheckpointsChanged', 'TrackArchiveParsed',
+    'TrackArchiveUnpacked', 'TrackCheckpointTaken', 'TrackCreated',
+    'TrackEnded', 'TrackFinishTimeReceived', 'TrackFinished', 'TrackInAir',
+    'TrackLanded', 'TrackSlowedDown', 'TrackSpeedExceeded', 'TrackStarted',
+    'TrackWasNotParsed', 'TrackerAssigned', 'TrackerUnAssigned')
+
+# Trigger runs once per INSERT statement and fills dispatch table with
+# inserted events which are processed by services. Event name is sent to
+# channel, so services which don't process event aren't woken up, once for
+# every name in statement.
 CREATE_TRIGGER = """
     CREATE OR REPLACE FUNCTION {func_name}() RETURNS TRIGGER AS $$
         BEGIN
-          INSERT INTO {dispatch_table} (EVENT_ID) VALUES (NEW.EVENT_ID);
-          RETURN NEW;
+          INSERT INTO {dispatch_table} (EVENT_ID, EVENT_NAME)
+            SELECT EVENT_ID, EVENT_NAME FROM new_events
+            WHERE EVENT_NAME <> ALL ({undispatched});
+          PERFORM pg_notify('{channel}', names.EVENT_NAME)
+            FROM (SELECT DISTINCT EVENT_NAME FROM new_events
+              WHERE EVENT_NAME <> ALL ({undispatched})) names;
+          RETURN NULL;
         END;
     $$ LANGUAGE plpgsql;
     """
 
+# Events which were put into dispatch table by older trigger.
+DELETE_UNDISPATCHED = """
+    DELETE FROM {dispatch_table} WHERE EVENT_NAME = ANY(%s);
+    """
+
 ADD_TRIGGER = """
     CREATE TRIGGER {trigger_name}
     AFTER INSERT ON {events_table}
-    FOR EACH ROW EXECUTE PROCEDURE {func_name}();
+    REFERENCING NEW TABLE AS new_events
+    FOR EACH STATEMENT EXECUTE PROCEDURE {func_name}();
     """
 
-GET_UNDISPATCHED_EVENTS = """
+# Trigger is created by services which can start at the same time.
+ADD_TRIGGER_IF_MISSING = """
+    DO $$ BEGIN
+      CREATE TRIGGER {trigger_name}
+      AFTER INSERT ON {events_table}
+      REFERENCING NEW TABLE AS new_events
+      FOR EACH STATEMENT EXECUTE PROCEDURE {func_name}();
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$;
+    """
+
+# Rows which are being claimed by another service are skipped, so services
+# don't wait for each other.
+CLAIM_UNDISPATCHED_EVENTS = """
+    WITH claimed AS (
+        UPDATE {dispatch_table} SET TAKEN = TRUE
+        WHERE EVENT_ID IN (
+            SELECT event_id
+            FROM {dispatch_table}
+            WHERE NOT taken
+                {names_filter}
+            ORDER BY time, event_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED)
+        RETURNING EVENT_ID, TIME)
     SELECT e.event_id, e.event_name, e.aggregate_id, e.aggregate_type,
     e.event_payload, e.occured_on
-    FROM {events_table} e, {dispatch_table} d
-    WHERE e.event_id = d.event_id
-        AND d.taken = false
-        ORDER BY d.time
-        LIMIT 5
-        FOR UPDATE;
+    FROM {events_table} e, claimed c
+    WHERE e.event_id = c.event_id
+    ORDER BY c.time, c.event_id;
     """
 
 GET_EVENTS_FOR_AGGREGATES = """
     SELECT * FROM {events_table}
     WHERE AGGREGATE_ID in %s
+    ORDER BY AGGREGATE_ID, EVENT_ID;
+    """
+
+STREAM_EVENTS = """
+    SELECT * FROM {events_table}
+    WHERE EVENT_ID > %s {aggregates_filter}
+    ORDER BY {order};
+    """
+
+GET_EVENTS_SINCE = """
+    SELECT * FROM {events_table}
+    WHERE EVENT_ID > %s AND EVENT_NAME in %s
+    ORDER BY EVENT_ID;
+    """
 
+GET_LAST_EVENT_ID = """
+    SELECT COALESCE(MAX(EVENT_ID), 0) FROM {events_table};
     """
 
 
@@ -85,6 +205,15 @@ EVENTS_TABLE = 'events'
 FUNC_NAME = 'add_to_dispatch'
 DISPATCH_TABLE = 'dispatch'
 TRIGGER_NAME = 'to_dispatch'
+DISPATCH_CHANNEL = 'dispatch'
+
+
+def _execute_in_autocommit(conn, query):
+    conn.set_session(autocommit=True)
+    try:
+        conn.cursor().execute(query)
+    finally:
+        conn.set_session(autocommit=False)
 
 
 @implementer(IAppendOnlyStore)
@@ -103,9 +232,12 @@ class PGSQLAppendOnlyStore(object):
             log.msg("Creating dispatch table if not exists...")
             cur.execute(CREATE_DISPATCH_TABLE.format(
                 dispatch_table=DISPATCH_TABLE))
-            log.msg("Creating or replacing function if not exists...")
-            cur.execute(CREATE_TRIGGER.format(
-                func_name=FUNC_NAME, dispatch_table=DISPATCH_TABLE))
+            cur.execute(MIGRATE_DISPATCH_TABLE.format(
+                dispatch_table=DISPATCH_TABLE, events_table=EVENTS_TABLE))
+            log.msg("Creating dispatch index if not exists...")
+            cur.execute(CREATE_DISPATCH_INDEX.format(
+                dispatch_table=DISPATCH_TABLE))
+            self._create_dispatch_function(cur)
             log.msg("Dropping trigger if exists...")
             cur.execute(
                 "drop trigger if exists {trigger_name} "
@@ -115,34 +247,115 @@ class PGSQLAppendOnlyStore(object):
             cur.execute(ADD_TRIGGER.format(
                 trigger_name=TRIGGER_NAME, func_name=FUNC_NAME,
                 events_table=EVENTS_TABLE))
-            log.msg("PGSQL store initialized.")
+            log.msg("Creating snapshots table if not exists...")
+            cur.execute(CREATE_SNAPSHOTS_TABLE.format(
+                snapshots_table=SNAPSHOTS_TABLE))
+        d = self.pool.runInteraction(interaction)
+        d.addCallback(lambda _: self._create_events_index())
+        d.addCallback(lambda _: log.msg("PGSQL store initialized."))
+        return d
+
+    def install_dispatch(self):
+        '''
+        Replace trigger function with one which skips UNDISPATCHED_EVENTS
+        and create trigger if it doesn't exist. Called by services on start,
+        so database which was created from sql scripts dispatches events as
+        code expects.
+        '''
+        def interaction(cur):
+            self._create_dispatch_function(cur)
+            cur.execute(ADD_TRIGGER_IF_MISSING.format(
+                trigger_name=TRIGGER_NAME, func_name=FUNC_NAME,
+                events_table=EVENTS_TABLE))
         return self.pool.runInteraction(interaction)
 
+    def _create_dispatch_function(self, cur):
+        log.msg("Creating or replacing dispatch function...")
+        cur.execute(CREATE_TRIGGER.format(
+            func_name=FUNC_NAME, dispatch_table=DISPATCH_TABLE,
+            channel=DISPATCH_CHANNEL, undispatched="ARRAY[%s]" %
+            ', '.join("'%s'" % name for name in UNDISPATCHED_EVENTS)))
+        cur.execute(DELETE_UNDISPATCHED.format(
+            dispatch_table=DISPATCH_TABLE), (list(UNDISPATCHED_EVENTS),))
+
+    @defer.inlineCallbacks
+    def _create_events_index(self):
+        log.msg("Creating events index if not exists...")
+        invalid = yield self.pool.runQuery(INVALID_EVENTS_INDEX.format(
+            events_table=EVENTS_TABLE))
+        if invalid and invalid[0][0]:
+            log.msg("Dropping invalid events index...")
+            yield self._run_outside_transaction(DROP_EVENTS_INDEX.format(
+                events_table=EVENTS_TABLE))
+        yield self._run_outside_transaction(CREATE_EVENTS_INDEX.format(
+            events_table=EVENTS_TABLE))
+
+    def _run_outside_transaction(self, query):
+        '''
+        Run statement which can't be run in transaction block.
+        Statements of AsyncConnectionPool are run in autocommit mode, while
+        connections of adbapi pool open transaction.
+        '''
+        if hasattr(self.pool, 'runWithConnection'):
+            return self.pool.runWithConnection(_execute_in_autocommit, query)
+        return self.pool.runOperation(query)
+
     def append(self, serialized_event):
         '''
-        Append events from stream to store.
+        Append events from stream to store by one statement.
         @param serialized_event:
         @type serialized_event: C{list}
-        @return:
-        @rtype:
-        '''
-        def interaction(cur, evlist):
-            for ev in evlist:
-                insert = cur.mogrify(INSERT_INTO_EVENTS.format(
-                                            events_table=EVENTS_TABLE), (
-                                           ev['event_name'],
-                                           ev['aggregate_id'],
-                                           ev['aggregate_type'],
-                                           ev['event_payload'],
-                                           ev['occured_on']))
-                cur.execute(insert)
-            return
+        @return: ids of appended events in order of list.
+        @rtype: C{list}
+        '''
+        assert isinstance(serialized_event, list), "AOStore wait for a list."
+        if not serialized_event:
+            return defer.succeed([])
+        d = self.pool.runQuery(*self._insert(serialized_event))
+        return d.addCallback(self._ids_in_order, len(serialized_event))
+
+    def append_in_transaction(self, cur, serialized_event):
+        '''
+        Append events in transaction of cursor, so they are stored and
+        dispatched only if it commits.
+        @param cur: DB-API cursor.
+        @type serialized_event: C{list}
+        @return: ids of appended events in order of list.
+        @rtype: C{list}
+        '''
         assert isinstance(serialized_event, list), "AOStore wait for a list."
-        evlist = []
-        for ev in serialized_event:
+        if not serialized_event:
+            return []
+        cur.execute(*self._insert(serialized_event))
+        return self._ids_in_order(cur.fetchall(), len(serialized_event))
+
+    def _insert(self, serialized_event):
+        '''
+        @return: INSERT statement for events and its parameters.
+        @rtype: C{tuple}
+        '''
+        args = []
+        for i, ev in enumerate(serialized_event):
             self._check_event(ev)
-            evlist.append(ev)
-        return self.pool.runInteraction(interaction, evlist)
+            args.extend((i + 1, ev['event_name'], ev['aggregate_id'],
+                ev['aggregate_type'], ev['event_payload'], ev['occured_on']))
+        return INSERT_INTO_EVENTS.format(events_table=EVENTS_TABLE,
+            values=', '.join([EVENT_VALUES] * len(serialized_event))), args
+
+    def _ids_in_order(self, rows, number):
+        '''
+        @param rows: (ordinal, event id) rows returned by INSERT_INTO_EVENTS.
+        @param number: number of inserted events.
+        @return: event ids in order of ordinals.
+        @rtype: C{list}
+        '''
+        ids = [None] * number
+        for ordinal, event_id in rows:
+            ids[ordinal - 1] = event_id
+        if None in ids:
+            raise ValueError("Ids of %s events were returned for %s events" %
+                (len(rows), number))
+        return ids
 
     def _check_event(self, ev):
         columns = ['event_name', 'aggregate_id',
@@ -151,29 +364,36 @@ class PGSQLAppendOnlyStore(object):
             if not ev.has_key(col):
                 raise KeyError("Argument %s is missed" % col)
 
-    def load_events(self, aggregate_id):
+    def load_events(self, aggregate_id, after=0):
         '''
 
         @param aggregate_id:
         @type aggregate_id:
+        @param after: read only events with bigger id.
+        @type after: C{int}
         @return:
         @rtype: C{list}
         '''
         return self.pool.runQuery(READ_EVENTS.format(
-                            events_table=EVENTS_TABLE), (aggregate_id,))
+                            events_table=EVENTS_TABLE), (aggregate_id, after))
 
-    def load_undispatched_events(self):
-        def get_events(cur):
-            cur.execute(GET_UNDISPATCHED_EVENTS.format(events_table=EVENTS_TABLE, dispatch_table=DISPATCH_TABLE))
-            rows = cur.fetchall()
-            ids = []
-            for row in rows:
-                ids.append(row[0])
-            for id in ids:
-                cur.execute("UPDATE "+DISPATCH_TABLE+" SET TAKEN=TRUE "
-                            "WHERE event_id=%s" % (id,))
-            return rows
-        return self.pool.runInteraction(get_events)
+    def load_undispatched_events(self, names=None, limit=100):
+        '''
+        Claim undispatched events: they are marked as taken and returned.
+        @param names: claim only events with this names.
+        @type names: C{iterable}
+        @param limit: maximum number of events to claim.
+        @type limit: C{int}
+        @return: stored records in order of appending to dispatch table.
+        @rtype: C{list}
+        '''
+        names_filter, args = '', (limit,)
+        if names is not None:
+            names_filter, args = 'AND event_name in %s', (tuple(names),
+                limit)
+        return self.pool.runQuery(CLAIM_UNDISPATCHED_EVENTS.format(
+            events_table=EVENTS_TABLE, dispatch_table=DISPATCH_TABLE,
+            names_filter=names_filter), args)
 
     def load_events_for_aggregates(self, ags):
         assert isinstance(ags, list)
@@ -189,3 +409,65 @@ class PGSQLAppendOnlyStore(object):
         d.addCallback(process_list)
         return d
 
+    def stream_events(self, consumer, aggregate_ids=None, after=0,
+            batch_size=1000):
+        '''
+        Read events through server-side cursor by batches, so result of any
+        size isn't held in memory at once.
+        @param consumer: called in reactor thread with every batch of stored
+        records, next batch is read when Deferred returned by consumer fires.
+        @type consumer: C{callable}
+        @param aggregate_ids: read events of this aggregates ordered by
+        aggregate and event id, all events ordered by id if None.
+        @type aggregate_ids: C{list}
+        @param after: read only events with bigger id.
+        @type after: C{int}
+        @param batch_size: number of records fetched at once.
+        @type batch_size: C{int}
+        @return: Deferred which fires with number of read records.
+        '''
+        aggregates_filter, order, args = '', 'EVENT_ID', (after,)
+        if aggregate_ids is not None:
+            aggregates_filter = 'AND AGGREGATE_ID in %s'
+            order = 'AGGREGATE_ID, EVENT_ID'
+            args = (after, tuple(aggregate_ids))
+        query = STREAM_EVENTS.format(events_table=EVENTS_TABLE,
+            aggregates_filter=aggregates_filter, order=order)
+
+        def interaction(cur):
+            # Named cursor is declared on server in the transaction of cur.
+            stream = cur.connection.cursor('stream_' + EVENTS_TABLE)
+            try:
+                stream.execute(query, args)
+                total = 0
+                while True:
+                    rows = stream.fetchmany(batch_size)
+                    if not rows:
+                        return total
+                    total += len(rows)
+                    threads.blockingCallFromThread(reactor, consumer, rows)
+            finally:
+                stream.close()
+        return self.pool.runInteraction(interaction)
+
+    def load_events_since(self, event_id, names):
+        '''
+        Read events appended after event with given id.
+        @param event_id: id of the last known event.
+        @type event_id: C{int}
+        @param names: names of events to read.
+        @type names: C{list}
+        @return: stored records ordered by id.
+        @rtype: C{list}
+        '''
+        return self.pool.runQuery(GET_EVENTS_SINCE.format(
+            events_table=EVENTS_TABLE), (event_id, tuple(names)))
+
+    def last_event_id(self):
+        '''
+        @return: id of the last appended event, 0 if store is empty.
+        @rtype: C{long}
+        '''
+        d = self.pool.runQuery(GET_LAST_EVENT_ID.format(
+            events_table=EVENTS_TABLE))
+        return d.addCallback(lambda rows: rows[0][0])
@@ -1,11 +1,14 @@
 from datetime import datetime
 
 import mock
+from twisted.internet import defer
 from twisted.trial import unittest
 from zope.interface.verify import verifyObject
 
 from gorynych.eventstore.interfaces import IEventStore
 from gorynych.eventstore.eventstore import EventStore
+from gorynych.eventstore.store import PGSQLAppendOnlyStore, \
+    UNDISPATCHED_EVENTS
 from gorynych.common.domain.model import  DomainEvent, DomainIdentifier
 from gorynych.common.infrastructure.serializers import StringSerializer
 
@@ -51,4 +54,64 @@ class EventStoreTest(unittest.TestCase):
         result = es.persist(event)
         self.assertTrue(es.store.append.called)
 
+    def test_2_persist_list(self):
+        es = EventStore(self.store)
+        self.store.append.return_value = defer.succeed([7, 8])
+        evlist = [create_event(), None, create_event()]
+        ids = self.successResultOf(es.persist(evlist))
+        self.assertEqual(ids, [7, 8])
+        self.assertEqual(len(self.store.append.call_args[0][0]), 2)
+        self.assertEqual((evlist[0].id, evlist[2].id), (7, 8))
+
+    def test_2_persist_wrong_ids(self):
+        es = EventStore(self.store)
+        self.store.append.return_value = defer.succeed([7])
+        failure = self.failureResultOf(es.persist([create_event(),
+            create_event()]))
+        failure.trap(ValueError)
+
+    def test_3_stream_events(self):
+        es = EventStore(self.store)
+        es._construct_event_list = mock.Mock(return_value=['event'])
+        consumer = mock.Mock()
+        id = DomainIdentifier()
+        es.stream_events(consumer, [id], 5)
+        stream, ids, after, batch_size = self.store.stream_events.call_args[0]
+        self.assertEqual((ids, after, batch_size), ([str(id)], 5, 1000))
+        stream(['row'])
+        es._construct_event_list.assert_called_once_with(['row'])
+        consumer.assert_called_once_with(['event'])
+
+
+class PGSQLAppendOnlyStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock.Mock()
+        self.store = PGSQLAppendOnlyStore(self.pool)
+        self.evlist = [EventStore(None)._serialize(create_event())
+            for i in range(3)]
+
+    def test_append_ids_by_ordinal(self):
+        self.pool.runQuery.return_value = defer.succeed([(2, 11), (3, 12),
+            (1, 10)])
+        ids = self.successResultOf(self.store.append(self.evlist))
+        self.assertEqual(ids, [10, 11, 12])
+        args = self.pool.runQuery.call_args[0][1]
+        self.assertEqual(args[::6], [1, 2, 3])
+
+    def test_append_in_transaction_missed_id(self):
+        cur = mock.Mock()
+        cur.fetchall.return_value = [(1, 10), (3, 12)]
+        self.assertRaises(ValueError, self.store.append_in_transaction, cur,
+            self.evlist)
 
+    def test_install_dispatch(self):
+        self.pool.runInteraction.side_effect = lambda f: f(cur)
+        cur = mock.Mock()
+        self.store.install_dispatch()
+        statements = [c[0][0] for c in cur.execute.call_args_list]
+        self.assertEqual(len(statements), 3)
+        for name in UNDISPATCHED_EVENTS:
+            self.assertEqual(statements[0].count("'%s'" % name), 2)
+        self.assertEqual(cur.execute.call_args_list[1][0][1],
+            (list(UNDISPATCHED_EVENTS),))
+        self.assertIn('duplicate_object', statements[2])
@@ -0,0 +1,83 @@
+import mock
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from gorynych.common.infrastructure.serializers import SnapshotSerializer
+from gorynych.eventstore.snapshots import SnapshotStore
+
+
+class SnapshotStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock.Mock()
+        self.pool.runOperation.return_value = defer.succeed(None)
+        self.serializer = SnapshotSerializer(1)
+        self.store = SnapshotStore(self.pool, self.serializer, every=3,
+            window=5)
+
+    def test_load_without_snapshot(self):
+        self.pool.runQuery.return_value = defer.succeed([])
+        event_store = mock.Mock()
+        e1 = mock.Mock(id=1)
+        event_store.load_events.return_value = defer.succeed([e1])
+        result = self.successResultOf(self.store.load_with_events('a',
+            event_store))
+        self.assertEqual(result, (None, [e1], []))
+        event_store.load_events.assert_called_once_with('a', 0)
+
+    def test_load_with_snapshot(self):
+        self.pool.runQuery.return_value = defer.succeed(
+            [(10, self.serializer.to_bytes({'state': 1}), [7, 10])])
+        event_store = mock.Mock()
+        # Event 8 was committed after snapshot was saved.
+        events = [mock.Mock(id=i) for i in (7, 8, 10, 11)]
+        event_store.load_events.return_value = defer.succeed(events)
+        result = self.successResultOf(self.store.load_with_events('a',
+            event_store))
+        self.assertEqual(result, ({'state': 1}, [events[1], events[3]],
+            [7, 10]))
+        event_store.load_events.assert_called_once_with('a', 5)
+
+    def test_load_snapshot_without_window(self):
+        self.pool.runQuery.return_value = defer.succeed(
+            [(10, self.serializer.to_bytes({'state': 1}), None)])
+        event_store = mock.Mock()
+        event_store.load_events.return_value = defer.succeed([])
+        result = self.successResultOf(self.store.load_with_events('a',
+            event_store))
+        self.assertEqual(result, ({'state': 1}, [], []))
+        event_store.load_events.assert_called_once_with('a', 10)
+
+    def test_old_version_is_replayed(self):
+        self.pool.runQuery.return_value = defer.succeed(
+            [(10, SnapshotSerializer(0).to_bytes({'state': 1}), [])])
+        self.assertEqual(self.successResultOf(self.store.load('a')),
+            (0, None, None))
+
+    def test_save_after(self):
+        events = [mock.Mock(id=i) for i in range(1, 4)]
+        get_state = mock.Mock(return_value={'state': 1})
+        self.successResultOf(self.store.save_after('a', events[:2],
+            get_state))
+        self.assertFalse(self.pool.runOperation.called)
+        self.successResultOf(self.store.save_after('a', events, get_state))
+        args = self.pool.runOperation.call_args[0][1]
+        self.assertEqual(args[:2], ('a', 3))
+        self.assertEqual(self.serializer.from_bytes(args[2]), {'state': 1})
+        self.assertEqual(args[3], [1, 2, 3])
+
+    def test_applied_ids_in_window_saved(self):
+        # Events 8 and 9 were applied to previous snapshot at 9, event 7
+        # came after it.
+        events = [mock.Mock(id=i) for i in (7, 10, 13)]
+        self.successResultOf(self.store.save_after('a', events, lambda: 1,
+            [2, 8, 9]))
+        args = self.pool.runOperation.call_args[0][1]
+        self.assertEqual(args[1], 13)
+        self.assertEqual(args[3], [9, 10, 13])
+
+    def test_save_error_is_logged(self):
+        self.pool.runOperation.return_value = defer.fail(ValueError('db'))
+        events = [mock.Mock(id=i) for i in range(1, 4)]
+        self.successResultOf(self.store.save_after('a', events,
+            lambda: 1))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
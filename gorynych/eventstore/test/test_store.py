@@ -70,6 +70,14 @@ class PGSQLAOSInitTest(unittest.TestCase):
         func = yield self.pool.runQuery("select * from pg_proc where "
                                         "proname=%s", (FUNC_NAME,))
         self.assertTrue(FUNC_NAME in func[0])
+        index = yield self.pool.runQuery("SELECT indexname FROM pg_indexes "
+            "WHERE tablename=%s AND indexname=%s", (DISPATCH_TABLE,
+            DISPATCH_TABLE + '_claim'))
+        self.assertTrue(index, "Dispatch index hasn't been created.")
+        index = yield self.pool.runQuery("SELECT indexname FROM pg_indexes "
+            "WHERE tablename=%s AND indexname=%s", (EVENTS_TABLE,
+            EVENTS_TABLE + '_aggregate'))
+        self.assertTrue(index, "Events index hasn't been created.")
 
 
 class PGSQLAOSTest(unittest.TestCase):
@@ -111,6 +119,20 @@ class PGSQLAOSTest(unittest.TestCase):
         defer.returnValue(self.assertEqual(long(eid),
             nondispatched_event[0][0]))
 
+    @defer.inlineCallbacks
+    def test_append_list(self):
+        evlist = [create_serialized_event(id=i) for i in range(3)]
+        ids = yield self.store.append(evlist)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids, sorted(ids))
+        stored = yield self.pool.runQuery("select event_id, aggregate_id "
+            "from {tbl} order by event_id".format(tbl=EVENTS_TABLE))
+        self.assertEqual(stored, [(ids[i], str(i)) for i in range(3)])
+        claimed = yield self.store.load_undispatched_events()
+        self.assertEqual([row[0] for row in claimed], ids)
+        ids = yield self.store.append([])
+        self.assertEqual(ids, [])
+
     @defer.inlineCallbacks
     def test_load_events(self):
         # Can fail if test_append fail.
@@ -123,6 +145,33 @@ class PGSQLAOSTest(unittest.TestCase):
         self.assertEqual(len(stored_event), 1)
         self.assertEqual(stored_event[0][2], id)
 
+    @defer.inlineCallbacks
+    def test_load_events_in_append_order(self):
+        ts = int(time.time())
+        yield self.store.append([create_serialized_event(ts=ts - i, id=4)
+            for i in range(3)])
+        stored = yield self.store.load_events('4')
+        self.assertEqual([row[5] for row in stored],
+            [datetime.fromtimestamp(ts - i) for i in range(3)])
+
+    @defer.inlineCallbacks
+    def test_stream_events(self):
+        yield self.store.append([create_serialized_event(id=i % 2)
+            for i in range(5)])
+        batches = []
+        total = yield self.store.stream_events(batches.append,
+            batch_size=2)
+        self.assertEqual(total, 5)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        ids = [row[0] for b in batches for row in b]
+        self.assertEqual(ids, sorted(ids))
+
+        batches = []
+        yield self.store.stream_events(batches.append, ['1', '0'],
+            after=ids[0], batch_size=10)
+        self.assertEqual([row[2] for row in batches[0]],
+            ['0', '0', '1', '1'])
+
     @defer.inlineCallbacks
     def test_load_undispatched(self):
         ts = int(time.time())
@@ -133,3 +182,29 @@ class PGSQLAOSTest(unittest.TestCase):
         self.assertEqual(len(und), 2)
         und2 = yield self.store.load_undispatched_events()
         self.assertEqual(len(und2), 0)
+
+    @defer.inlineCallbacks
+    def test_load_events_since(self):
+        last = yield self.store.last_event_id()
+        self.assertEqual(last, 0)
+        ser_event = create_serialized_event(id=4)
+        other = dict(create_serialized_event(id=5), event_name='other_name')
+        yield self.store.append([ser_event, other, ser_event])
+        last = yield self.store.last_event_id()
+        rows = yield self.store.load_events_since(0, ['event_name'])
+        self.assertEqual([row[0] for row in rows], [last - 2, last])
+        rows = yield self.store.load_events_since(last - 2, ['event_name'])
+        self.assertEqual([row[0] for row in rows], [last])
+
+    @defer.inlineCallbacks
+    def test_claim_by_names(self):
+        other = dict(create_serialized_event(id=5), event_name='other_name')
+        yield self.store.append([create_serialized_event(id=4)] * 3 +
+            [other])
+        claimed = yield self.store.load_undispatched_events(['other_name'])
+        self.assertEqual([row[1] for row in claimed], ['other_name'])
+        claimed = yield self.store.load_undispatched_events(
+            ['event_name', 'other_name'], limit=2)
+        self.assertEqual([row[1] for row in claimed], ['event_name'] * 2)
+        claimed = yield self.store.load_undispatched_events(limit=2)
+        self.assertEqual(len(claimed), 1)
@@ -4,7 +4,6 @@ it.
 '''
 from twisted.application import internet, service
 from twisted.web import server
-from twisted.enterprise import adbapi
 
 from gorynych import BaseOptions
 
@@ -28,6 +27,7 @@ def makeService(config, services=None):
     # import persistence staff
     from gorynych.info.domain import interfaces
     from gorynych.common.infrastructure import persistence
+    from gorynych.common.infrastructure.dbpool import make_pool
     from gorynych.common.infrastructure.messaging import RabbitMQObject
     from gorynych.eventstore.eventstore import EventStore
     from gorynych.eventstore.store import PGSQLAppendOnlyStore
@@ -38,11 +38,7 @@ def makeService(config, services=None):
     if not services:
         services = service.MultiService()
 
-    pool = adbapi.ConnectionPool('psycopg2', database=config['dbname'],
-                                 user=config['dbuser'],
-                                 password=config['dbpassword'],
-                                 host=config['dbhost'], cp_max=10,
-                                 cp_reconnect=True)
+    pool = make_pool(config)
 
     # EventStore init.
     event_store = EventStore(PGSQLAppendOnlyStore(pool))
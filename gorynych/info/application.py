@@ -13,6 +13,15 @@ from gorynych.common.domain.events import ContestRaceCreated
 from gorynych.common.domain.services import SinglePollerService
 from gorynych.common.application import DBPoolService
 
+SELECT_TRANSPORT_FOR_CONTEST = persistence.select('transport_for_contest',
+    'transport')
+
+SELECT_TRACKS = persistence.select('tracks', 'track')
+
+SELECT_TRACKERS = persistence.select('trackers', 'tracker')
+
+UPDATE_LAST_POINT = persistence.update('last_point', 'tracker')
+
 
 class BaseApplicationService(DBPoolService):
 
@@ -221,8 +230,7 @@ class ApplicationService(BaseApplicationService):
         # TODO: do in domain model style. Think before.
         # [(type, title, desc, tracker_id, transport_id),]
         transport_list = yield self.pool.runQuery(
-            persistence.select('transport_for_contest', 'transport'),
-                              (str(cont.id),))
+            SELECT_TRANSPORT_FOR_CONTEST, (str(cont.id),))
 
         new_race = race.create_race_for_contest(cont,
                                            person_list,
@@ -297,8 +305,7 @@ class ApplicationService(BaseApplicationService):
         #     if not ttype:
         #         return rows
         #     return filter(lambda row:row[0] == ttype, rows)
-        d = self.pool.runQuery(persistence.select('tracks', 'track'),
-            (group_id,))
+        d = self.pool.runQuery(SELECT_TRACKS, (group_id,))
         # d.addCallback(filtr)
         return d
 
@@ -314,7 +321,7 @@ class ApplicationService(BaseApplicationService):
         return d
 
     def get_trackers(self, params=None):
-        return self.pool.runQuery(persistence.select('trackers', 'tracker'))
+        return self.pool.runQuery(SELECT_TRACKERS)
 
     def get_tracker(self, params):
         return self._get_aggregate(params['tracker_id'],
@@ -360,9 +367,8 @@ class LastPointApplication(SinglePollerService):
             body, queue_name):
 
         def update_last_point(cur, data):
-            query = persistence.update('last_point', 'tracker')
             try:
-                cur.execute(query, (data['lat'], data['lon'], data['alt'], data['ts'],
+                cur.execute(UPDATE_LAST_POINT, (data['lat'], data['lon'], data['alt'], data['ts'],
                 data.get('battery'), data['h_speed'], data['imei']))
                 self.points[data['imei']] = data['ts']
             except Exception as e:
@@ -146,6 +146,8 @@ class Race(AggregateRoot):
         self._timezone = pytz.utc
         self.start_time = 0
         self.end_time = 0
+        # TrackArchive restored from snapshot, events are applied after it.
+        self.archive = None
 
     @property
     def title(self):
@@ -243,7 +245,7 @@ class Race(AggregateRoot):
 
     @property
     def track_archive(self):
-        track_archive = TrackArchive(self.events)
+        track_archive = TrackArchive(self.events, self.archive)
         return track_archive
 
     def add_track_archive(self, url):
@@ -274,9 +276,17 @@ class Race(AggregateRoot):
 
 class TrackArchive(object):
     states = ['no archive', 'unpacked', 'parsed']
-    def __init__(self, events):
+    def __init__(self, events, archive=None):
+        '''
+        @param archive: archive state to start from.
+        @type archive: L{TrackArchive}
+        '''
         self._state = 'no archive'
         self.progress = defaultdict(set)
+        if archive:
+            self._state = archive.state
+            for key, value in archive.progress.iteritems():
+                self.progress[key] = set(value)
         for event in events:
             self.apply(event)
 
@@ -195,6 +195,21 @@ class TrackArchiveTest(unittest.TestCase):
                 set(['track.igc']))
             self.assertSetEqual(t.progress['without_tracks'], set('2'))
 
+    def test_creation_from_archive(self):
+        r = RaceID()
+        archive = race.TrackArchive([
+            evs.ArchiveURLReceived(r, 'http://airtribune.com/hello'),
+            evs.TrackArchiveUnpacked(r, ([{'contest_number': '1'}],
+                ['path/to/unpacked/track.igc'], ['2']))])
+        t = race.TrackArchive([evs.RaceGotTrack(r, {'contest_number': '1',
+            'track_type': 'competition_aftertask'}),
+            evs.TrackArchiveParsed(r, 1)], archive)
+        self.assertEqual(t.state, 'parsed')
+        self.assertSetEqual(t.progress['parsed_tracks'], set('1'))
+        self.assertSetEqual(t.progress['without_tracks'], set('2'))
+        self.assertEqual(archive.state, 'unpacked')
+        self.assertSetEqual(archive.progress['parsed_tracks'], set())
+
 
     def test_state_changing(self):
         t = race.TrackArchive([])
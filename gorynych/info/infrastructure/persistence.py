@@ -16,11 +16,54 @@ from gorynych.common.domain.types import checkpoint_collection_from_geojson, geo
 from gorynych.info.domain.person import PersonFactory
 from gorynych.common.exceptions import NoAggregate, DatabaseValueError
 from gorynych.common.infrastructure import persistence as pe
+from gorynych.common.infrastructure.serializers import SnapshotSerializer
+from gorynych.eventstore.snapshots import SnapshotStore
 from gorynych.info.domain import interfaces
 from gorynych.info.domain.tracker import TrackerFactory
 from gorynych.info.domain.transport import TransportFactory
 
 
+UPDATE_PERSON = pe.update('person')
+
+INSERT_PERSON = pe.insert('person')
+
+SELECT_BY_EMAIL = pe.select('by_email', 'person')
+
+INSERT_PERSON_DATA = pe.insert('person_data', 'person')
+
+UPDATE_PERSON_DATA = pe.update('person_data', 'person')
+
+SELECT_PARAGLIDERS = pe.select('paragliders', 'race')
+
+SELECT_RACE_TRANSPORT = pe.select('race_transport', 'race')
+
+INSERT_RACE = pe.insert('race')
+
+SELECT_TRANSPORT = pe.select('transport', 'race')
+
+UPDATE_RACE = pe.update('race')
+
+SELECT_PARTICIPANTS = pe.select('participants', 'contest')
+
+SELECT_RETRIEVE_ID = pe.select('retrieve_id', 'contest')
+
+INSERT_CONTEST = pe.insert('contest')
+
+UPDATE_CONTEST = pe.update('contest')
+
+SELECT_LAST_POINT = pe.select('last_point', 'tracker')
+
+INSERT_TRACKER = pe.insert('tracker')
+
+UPDATE_TRACKER = pe.update('tracker')
+
+SELECT_ASSIGNEE = pe.select('assignee', 'tracker')
+
+INSERT_TRANSPORT = pe.insert('transport')
+
+UPDATE_TRANSPORT = pe.update('transport')
+
+
 def create_participants(paragliders_row):
     result = dict()
     if paragliders_row:
@@ -45,14 +88,24 @@ def find_delete_insert(indb, inobj, _id):
 
 @implementer(interfaces.IRepository)
 class BasePGSQLRepository(object):
+    # Version of snapshot state, repositories which have it restore
+    # aggregates from snapshot and events after it.
+    snapshot_version = None
+
     def __init__(self, pool):
         self.pool = pool
         self.name = self.__class__.__name__[5:-10].lower()
+        # Looked up here to fail on start if statements are missed.
+        self.select_all = pe.select('all_' + self.name, self.name)
+        self.select_one = pe.select(self.name)
+        self.snapshots = None
+        if self.snapshot_version:
+            self.snapshots = SnapshotStore(pool,
+                SnapshotSerializer(self.snapshot_version))
 
     @defer.inlineCallbacks
     def get_list(self, limit=20, offset=None):
-        name = 'all_' + self.name
-        rows = yield self.pool.runQuery(pe.select(name, self.name))
+        rows = yield self.pool.runQuery(self.select_all)
         a_ids = [row[0] for row in rows]
         event_dict = yield pe.event_store().load_events_for_aggregates(a_ids)
         result = yield self._restore_aggregates(rows)
@@ -70,12 +123,21 @@ class BasePGSQLRepository(object):
 
     @defer.inlineCallbacks
     def get_by_id(self, id):
-        data = yield self.pool.runQuery(pe.select(self.name), (str(id),))
+        data = yield self.pool.runQuery(self.select_one, (str(id),))
         if not data:
             raise NoAggregate("%s %s" % (self.name.title(), id))
         result = yield defer.maybeDeferred(self._restore_aggregate, data[0])
-        event_list = yield pe.event_store().load_events(result.id)
+        if not self.snapshots:
+            event_list = yield pe.event_store().load_events(result.id)
+            result.apply(event_list)
+            defer.returnValue(result)
+        state, event_list, applied = yield self.snapshots.load_with_events(
+            result.id, pe.event_store())
+        if state is not None:
+            self._apply_snapshot(result, state)
         result.apply(event_list)
+        yield self.snapshots.save_after(result.id, event_list,
+            lambda: self._get_snapshot(result), applied)
         defer.returnValue(result)
 
     @defer.inlineCallbacks
@@ -117,17 +179,17 @@ class PGSQLPersonRepository(BasePGSQLRepository):
     @defer.inlineCallbacks
     def save(self, pers):
         if pers._id:
-            yield self.pool.runOperation(pe.update('person'),
+            yield self.pool.runOperation(UPDATE_PERSON,
                 self._extract_sql_fields(pers))
             result = pers
         else:
             try:
-                data = yield self.pool.runQuery(pe.insert('person'),
+                data = yield self.pool.runQuery(INSERT_PERSON,
                     self._extract_sql_fields(pers))
             except psycopg2.IntegrityError as e:
                 if e.pgcode == '23505':   # unique constraint
-                    pid = yield self.pool.runQuery(pe.select('by_email',
-                        'person'), (str(pers.email),))
+                    pid = yield self.pool.runQuery(SELECT_BY_EMAIL,
+                        (str(pers.email),))
                     result = yield self.get_by_id(pid[0][0])
                     defer.returnValue(result)
             result = yield self._process_insert_result(data, pers)
@@ -154,10 +216,8 @@ class PGSQLPersonRepository(BasePGSQLRepository):
     def _insert_person_data(self, pers):
         for data_type, data_value in pers._person_data.iteritems():
             try:
-                yield self.pool.runOperation(
-                    pe.insert('person_data', 'person'),
-                                             (pers._id, data_type,
-                                              data_value))
+                yield self.pool.runOperation(INSERT_PERSON_DATA,
+                    (pers._id, data_type, data_value))
             except psycopg2.IntegrityError as e:
                 if e.pgcode == '23505':   # unique constraint
                     # or replace it with error if persistence is needed
@@ -165,10 +225,8 @@ class PGSQLPersonRepository(BasePGSQLRepository):
                         data_value, pers._id, data_type
                     ))
                     try:
-                        yield self.pool.runOperation(
-                        pe.update('person_data', 'person'),
-                                                 (data_value, pers._id,
-                                                  data_type))
+                        yield self.pool.runOperation(UPDATE_PERSON_DATA,
+                            (data_value, pers._id, data_type))
                     except Exception as error:
                         log.msg("Pizdec occured while updating %r" % error)
                 else:
@@ -177,21 +235,27 @@ class PGSQLPersonRepository(BasePGSQLRepository):
 
 class PGSQLRaceRepository(BasePGSQLRepository):
     implements(IRaceRepository)
+    # Race state which is built from events is its track archive.
+    snapshot_version = 1
+
+    def _get_snapshot(self, race):
+        return race.track_archive
+
+    def _apply_snapshot(self, race, archive):
+        race.archive = archive
 
     @defer.inlineCallbacks
     def _restore_aggregate(self, race_data):
         # TODO: repository knows too much about Race's internals. Think about it
         i, rid, t, st, et, tz, rt, _chs, _aux, slt, elt = race_data
 
-        pgs = yield self.pool.runQuery(pe.select('paragliders', 'race'),
-            (race_data[0],))
+        pgs = yield self.pool.runQuery(SELECT_PARAGLIDERS, (race_data[0],))
         if not pgs:
             raise DatabaseValueError("No paragliders has been found for race"
                                      " %s." % race_data[1])
         ps = create_participants(pgs)
 
-        trs = yield self.pool.runQuery(pe.select('race_transport', 'race'),
-            (rid,))
+        trs = yield self.pool.runQuery(SELECT_RACE_TRANSPORT, (rid,))
 
         chs = checkpoint_collection_from_geojson(_chs)
 
@@ -218,7 +282,7 @@ class PGSQLRaceRepository(BasePGSQLRepository):
             return _list
 
         def save_new(cur):
-            cur.execute(pe.insert('race'), values['race'])
+            cur.execute(INSERT_RACE, values['race'])
             x = cur.fetchone()
             pq = ','.join(cur.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s)",
                 (insert_id(x[0], p))) for p in values['paragliders'])
@@ -232,13 +296,11 @@ class PGSQLRaceRepository(BasePGSQLRepository):
             return x
 
         if obj._id:
-            pgs = yield self.pool.runQuery(pe.select('paragliders', 'race'),
-                (obj._id,))
+            pgs = yield self.pool.runQuery(SELECT_PARAGLIDERS, (obj._id,))
             if not pgs:
                 raise DatabaseValueError(
                     "No paragliders has been found for race %s." % obj.id)
-            trs = yield self.pool.runQuery(pe.select('transport', 'race'),
-                (obj._id,))
+            trs = yield self.pool.runQuery(SELECT_TRANSPORT, (obj._id,))
             result = yield self.pool.runInteraction(self._update, pgs, trs,
                 values, obj)
         else:
@@ -264,7 +326,7 @@ class PGSQLRaceRepository(BasePGSQLRepository):
         @return: obj
         @rtype:
         '''
-        cur.execute(pe.update('race'), values['race'])
+        cur.execute(UPDATE_RACE, values['race'])
 
         # Update paragliders. Should it be in a separate method/function?
         to_delete_pg, to_insert_pg = find_delete_insert(
@@ -350,12 +412,12 @@ class PGSQLContestRepository(BasePGSQLRepository):
 
     @defer.inlineCallbacks
     def _append_data_to_contest(self, cont):
-        participants = yield self.pool.runQuery(
-            pe.select('participants', 'contest'), (cont._id,))
+        participants = yield self.pool.runQuery(SELECT_PARTICIPANTS,
+            (cont._id,))
         if participants:
             cont = self._add_participants_to_contest(cont, participants)
-        retrieve_id = yield self.pool.runQuery(
-            pe.select('retrieve_id', 'contest'), (cont._id,))
+        retrieve_id = yield self.pool.runQuery(SELECT_RETRIEVE_ID,
+            (cont._id,))
         if retrieve_id:
             cont.retrieve_id = retrieve_id[0][0]
         defer.returnValue(cont)
@@ -401,7 +463,7 @@ class PGSQLContestRepository(BasePGSQLRepository):
             Save just created contest.
             '''
 
-            i = cur.execute(pe.insert('contest'), values['contest'])
+            i = cur.execute(INSERT_CONTEST, values['contest'])
             _id = cur.fetchone()[0]
 
             if values['participants']:
@@ -417,7 +479,7 @@ class PGSQLContestRepository(BasePGSQLRepository):
             return _id
 
         def update(cur, prts):
-            cur.execute(pe.update('contest'), values['contest'])
+            cur.execute(UPDATE_CONTEST, values['contest'])
             if values['participants'] or prts:
                 inobj = values['participants']
                 indb = prts
@@ -443,8 +505,7 @@ class PGSQLContestRepository(BasePGSQLRepository):
 
         result = None
         if obj._id:
-            prts = yield self.pool.runQuery(pe.select('participants',
-                'contest'), (obj._id,))
+            prts = yield self.pool.runQuery(SELECT_PARTICIPANTS, (obj._id,))
             result = yield self.pool.runInteraction(update, prts)
         else:
             c__id = yield self.pool.runInteraction(save_new)
@@ -476,8 +537,7 @@ class PGSQLTrackerRepository(BasePGSQLRepository):
     def _restore_aggregate(self, row):
         factory = TrackerFactory()
         did, dtype, tid, name, _id = row
-        last_point = yield self.pool.runQuery(pe.select('last_point',
-            'tracker'), (_id,))
+        last_point = yield self.pool.runQuery(SELECT_LAST_POINT, (_id,))
         if last_point:
             last_point=last_point[0]
         assignee = yield self._get_assignee(_id)
@@ -488,14 +548,14 @@ class PGSQLTrackerRepository(BasePGSQLRepository):
 
     # TODO: generalize this.
     def _save_new(self, obj):
-        return self.pool.runQuery(pe.insert('tracker'),
-                                                self._extract_sql_fields(obj))
+        return self.pool.runQuery(INSERT_TRACKER,
+            self._extract_sql_fields(obj))
 
     @defer.inlineCallbacks
     def _update(self, obj):
         ass = yield self._get_assignee(obj._id)
         if ass == obj.assignee:
-            yield self.pool.runOperation(pe.update('tracker'),
+            yield self.pool.runOperation(UPDATE_TRACKER,
                 self._extract_sql_fields(obj))
             defer.returnValue('')
 
@@ -504,7 +564,7 @@ class PGSQLTrackerRepository(BasePGSQLRepository):
         to_delete = set(ass.items()).difference(set(obj.assignee.viewitems()))
 
         def update(cur):
-            cur.execute(pe.update('tracker'), self._extract_sql_fields(obj))
+            cur.execute(UPDATE_TRACKER, self._extract_sql_fields(obj))
             for ditem in to_delete:
                 cur.execute('delete from tracker_assignees where id=%s and '
                             'assignee_id=%s and assigned_for=%s',
@@ -517,8 +577,7 @@ class PGSQLTrackerRepository(BasePGSQLRepository):
 
     @defer.inlineCallbacks
     def _get_assignee(self, _id):
-        ass = yield self.pool.runQuery(pe.select('assignee', 'tracker'), (_id,
-        ))
+        ass = yield self.pool.runQuery(SELECT_ASSIGNEE, (_id,))
         assignee = dict()
         for item in ass:
             assignee[item[1]]=item[0]
@@ -551,11 +610,11 @@ class PGSQLTransportRepository(BasePGSQLRepository):
         return result
 
     def _save_new(self, obj):
-        return self.pool.runQuery(pe.insert('transport'),
+        return self.pool.runQuery(INSERT_TRANSPORT,
             self._extract_sql_fields(obj))
 
     def _update(self, obj):
-        return self.pool.runOperation(pe.update('transport'),
+        return self.pool.runOperation(UPDATE_TRANSPORT,
             self._extract_sql_fields(obj))
 
     def _extract_sql_fields(self, obj):
@@ -172,7 +172,7 @@ class APIResource(resource.Resource):
         @type res: list or instance of AggregateRoot subclass
         '''
         content_type = req.responseHeaders.getRawHeaders('content-type',
-            'application/json')
+            ['application/json'])[0]
         req.setResponseCode(200)
         # will try to translate resource object into dictionary.
         method = req.method
@@ -215,7 +215,7 @@ class APIResource(resource.Resource):
         req.setHeader('Content-Length', bytes(len(body)))
         req.setHeader('Content-Type',
             req.responseHeaders.getRawHeaders('content-type',
-                'application/json'))
+                ['application/json'])[0])
         req.write(bytes(body))
         req.finish()
         return server.NOT_DONE_YET
@@ -1,4 +1,3 @@
-import math
 import types
 
 import numpy as np
@@ -6,7 +5,8 @@ from zope.interface import implementer
 
 from gorynych.common.domain import events
 from gorynych.common.domain.types import checkpoint_collection_from_geojson
-from gorynych.common.domain.services import point_dist_calculator, bearing
+from gorynych.common.domain.services import point_dist_calculator, \
+    vector_dist_calculator, vector_bearing
 from gorynych.processor.domain import services
 from gorynych.processor.interfaces import IRaceType
 
@@ -59,31 +59,8 @@ class RaceToGoal(object):
                     p['distance'] = 200
                 return points, []
 
-        calculation_ended = trackstate.ended
-        for idx, p in np.ndenumerate(points):
-            lat, lon = p['lat'], p['lon']
-            if nextchp.is_taken_by(lat, lon, p['timestamp']) and \
-                    (not calculation_ended):
-                eventlist.append(
-                    events.TrackCheckpointTaken(
-                        _id,
-                        (lastchp + 1, nextchp.dist_to_center),
-                        occured_on=nextchp.take_time))
-                if nextchp.type == 'es':
-                    eventlist.append(events.TrackFinishTimeReceived(_id,
-                        payload=p['timestamp'], occured_on=p['timestamp']))
-                if nextchp.type == 'goal':
-                    eventlist.append(events.TrackFinished(_id,
-                        occured_on=p['timestamp']))
-                    calculation_ended = True
-                if nextchp.type == 'ss':
-                    eventlist.append(events.TrackStarted(_id,
-                        occured_on=p['timestamp']))
-                if lastchp + 1 < len(self.checkpoints) - 1:
-                    nextchp = self.checkpoints[lastchp + 2]
-                    lastchp += 1
-            p['distance'] = nextchp.dist_to_point(lat, lon) + nextchp.distance
-
+        eventlist = take_checkpoints_in_order(self.checkpoints, points,
+            lastchp, trackstate.ended, _id)
         return points, eventlist
 
 
@@ -132,31 +109,8 @@ class SpeedRun(object):
                     p['distance'] = 200
                 return points, []
 
-        calculation_ended = trackstate.ended
-        for idx, p in np.ndenumerate(points):
-            lat, lon = p['lat'], p['lon']
-            if nextchp.is_taken_by(lat, lon, p['timestamp']) and \
-                    (not calculation_ended):
-                eventlist.append(
-                    events.TrackCheckpointTaken(
-                        _id,
-                        (lastchp + 1, nextchp.dist_to_center),
-                        occured_on=nextchp.take_time))
-                if nextchp.type == 'es':
-                    eventlist.append(events.TrackFinishTimeReceived(_id,
-                        payload=p['timestamp'], occured_on=p['timestamp']))
-                if nextchp.type == 'goal':
-                    eventlist.append(events.TrackFinished(_id,
-                        occured_on=p['timestamp']))
-                    calculation_ended = True
-                if nextchp.type == 'ss':
-                    eventlist.append(events.TrackStarted(_id,
-                        occured_on=p['timestamp']))
-                if lastchp + 1 < len(self.checkpoints) - 1:
-                    nextchp = self.checkpoints[lastchp + 2]
-                    lastchp += 1
-            p['distance'] = nextchp.dist_to_point(lat, lon) + nextchp.distance
-
+        eventlist = take_checkpoints_in_order(self.checkpoints, points,
+            lastchp, trackstate.ended, _id)
         return points, eventlist
 
 
@@ -195,24 +149,36 @@ class OpenDistance(object):
         if self._checkpoint_is_last(lastchp_num):
             return self._calculate_last_leg(points, previous_leg)
         else:
-            # Calculate passed distance.
+            # Calculate passed distance. Distance is counted from the
+            # checkpoint which was the last one at the beginning of
+            # processing, only previous leg changes.
             nextchp = self.checkpoints[lastchp_num + 1]
-            for idx, p in np.ndenumerate(points):
-                lat, lon = p['lat'], p['lon']
-                p['distance'] = previous_leg + lastchp.dist_to_point(lat, lon)
-                if nextchp.is_taken_by(lat, lon, p['timestamp']):
-                    eventlist.append(
-                        events.TrackCheckpointTaken(_id,
-                            (lastchp_num + 1, nextchp.dist_to_center),
-                            occured_on=nextchp.take_time))
-                    if self._checkpoint_is_last(lastchp_num + 1):
-                        return self._calculate_last_leg(points,
-                            previous_leg, eventlist=eventlist,
-                            from_idx=idx[0])
-                    else:
-                        nextchp = self.checkpoints[lastchp_num + 2]
-                        lastchp_num += 1
-                        previous_leg = self.checkpoints[lastchp_num].distance
+            lats, lons, times = points['lat'], points['lon'], \
+                points['timestamp']
+            from_lastchp = lastchp.dists_to_points(lats, lons)
+            start = 0
+            while start < len(points):
+                idx = nextchp.first_taken_by(lats[start:], lons[start:],
+                    times[start:])
+                if idx is None:
+                    break
+                idx += start
+                points['distance'][start:idx + 1] = previous_leg + \
+                    from_lastchp[start:idx + 1]
+                eventlist.append(
+                    events.TrackCheckpointTaken(_id,
+                        (lastchp_num + 1, nextchp.dist_to_center),
+                        occured_on=nextchp.take_time))
+                if self._checkpoint_is_last(lastchp_num + 1):
+                    return self._calculate_last_leg(points,
+                        previous_leg, eventlist=eventlist,
+                        from_idx=idx)
+                else:
+                    nextchp = self.checkpoints[lastchp_num + 2]
+                    lastchp_num += 1
+                    previous_leg = self.checkpoints[lastchp_num].distance
+                start = idx + 1
+            points['distance'][start:] = previous_leg + from_lastchp[start:]
 
         return points, eventlist
 
@@ -222,21 +188,83 @@ class OpenDistance(object):
     def _calculate_last_leg(self, points, previous_leg, eventlist=None,
             from_idx=0):
         chp = self.checkpoints[-1]
-        for idx, p in np.ndenumerate(points[from_idx:]):
-            lat, lon = p['lat'], p['lon']
-            dist = chp.dist_to_point(lat, lon)
-            if not self.bearing is None:
-                # TODO: distance calculaction should be done in checkpoint.
-                dist = int(dist * math.cos(
-                    math.radians(bearing(chp.opt_lat, chp.opt_lon, lat, lon)
-                    - self.bearing)))
-            p['distance'] = previous_leg + dist
+        lats = points['lat'][from_idx:]
+        lons = points['lon'][from_idx:]
+        dist = chp.dists_to_points(lats, lons)
+        if not self.bearing is None:
+            # TODO: distance calculaction should be done in checkpoint.
+            dist = (dist * np.cos(np.radians(
+                vector_bearing(chp.opt_lat, chp.opt_lon, lats, lons)
+                - self.bearing))).astype(int)
+        points['distance'][from_idx:] = previous_leg + dist
 
         if eventlist is None:
             eventlist = []
         return points, eventlist
 
 
+def take_checkpoints_in_order(checkpoints, points, lastchp, ended, _id):
+    '''
+    Take checkpoints one by one and calculate distance to goal for every
+    point. Distances to checkpoint are calculated for the whole batch of
+    points at once, so Python code runs only when checkpoint is taken.
+    Result is the same as if checkpoints were checked point by point.
+    @param checkpoints: list of race checkpoints.
+    @type checkpoints: C{list} of L{CylinderCheckpointAdapter}
+    @param points: points which will get distance.
+    @type points: C{np.array}
+    @param lastchp: index of the last taken checkpoint.
+    @type lastchp: C{int}
+    @param ended: is calculation for track already ended.
+    @type ended: C{bool}
+    @return: occured events.
+    @rtype: C{list}
+    '''
+    eventlist = []
+    nextchp = checkpoints[lastchp + 1]
+    lats, lons, times = points['lat'], points['lon'], points['timestamp']
+    # Index of first point which wasn't checked against nextchp.
+    start = 0
+    # Index of first point without calculated distance.
+    dist_start = 0
+    while start < len(points) and not ended:
+        idx = nextchp.first_taken_by(lats[start:], lons[start:],
+            times[start:])
+        if idx is None:
+            break
+        idx += start
+        ts = times[idx]
+        eventlist.append(
+            events.TrackCheckpointTaken(
+                _id,
+                (lastchp + 1, nextchp.dist_to_center),
+                occured_on=nextchp.take_time))
+        if nextchp.type == 'es':
+            eventlist.append(events.TrackFinishTimeReceived(_id,
+                payload=ts, occured_on=ts))
+        if nextchp.type == 'goal':
+            eventlist.append(events.TrackFinished(_id, occured_on=ts))
+            ended = True
+        if nextchp.type == 'ss':
+            eventlist.append(events.TrackStarted(_id, occured_on=ts))
+        if lastchp + 1 < len(checkpoints) - 1:
+            points['distance'][dist_start:idx] = nextchp.distance + \
+                nextchp.dists_to_points(lats[dist_start:idx],
+                    lons[dist_start:idx])
+            dist_start = idx
+            nextchp = checkpoints[lastchp + 2]
+            lastchp += 1
+        start = idx + 1
+    if ended and start < len(points):
+        # Calculation has been ended but checkpoint still looks at the rest
+        # of points.
+        nextchp.first_taken_by(lats[start:], lons[start:], times[start:],
+            stop=False)
+    points['distance'][dist_start:] = nextchp.distance + \
+        nextchp.dists_to_points(lats[dist_start:], lons[dist_start:])
+    return eventlist
+
+
 def taken_on_enter(self, lat, lon, on_time):
     '''
     Is point (lat, lon) inside the circle?
@@ -287,6 +315,30 @@ def taken_on_exit(self, lat, lon, on_time):
         return False
 
 
+def taken_on_enter_mask(self, inside):
+    '''
+    Vectorized L{taken_on_enter}: every point inside the circle takes it.
+    @param inside: is point inside the circle.
+    @type inside: C{np.array} of bool
+    @return: mask of points which take checkpoint.
+    @rtype: C{np.array} of bool
+    '''
+    return inside
+
+
+def taken_on_exit_mask(self, inside):
+    '''
+    Vectorized L{taken_on_exit}: point takes cylinder if previous point was
+    inside it and this one is outside.
+    @param inside: is point inside the circle.
+    @type inside: C{np.array} of bool
+    @return: mask of points which take checkpoint.
+    @rtype: C{np.array} of bool
+    '''
+    was_inside = np.hstack(([self._point_inside], inside[:-1]))
+    return was_inside & ~inside
+
+
 class CylinderCheckpointAdapter(object):
     '''
     Adapter for cylinder checkpoints.
@@ -314,6 +366,46 @@ class CylinderCheckpointAdapter(object):
     def is_taken_by(self, lat, lon, on_time):
         pass
 
+    def taken_mask(self, inside):
+        pass
+
+    def first_taken_by(self, lats, lons, times, stop=True):
+        '''
+        Vectorized is_taken_by. Check points in order and look for the
+        first one which takes the checkpoint. Checkpoint is left in the
+        same state as if is_taken_by was called for every point up to the
+        found one.
+        @param lats:
+        @type lats: C{np.array}
+        @param lons:
+        @type lons: C{np.array}
+        @param times:
+        @type times: C{np.array}
+        @param stop: stop on first taken point. If False all points are
+        checked and None is returned.
+        @type stop: C{bool}
+        @return: index of point which took checkpoint or None.
+        @rtype: C{int}
+        '''
+        if len(lats) == 0:
+            return None
+        dists = vector_dist_calculator(lats, lons, self.checkpoint.lat,
+            self.checkpoint.lon).astype(int)
+        inside = dists < (self.checkpoint.radius + self.error_margin)
+        taken = np.flatnonzero(self.taken_mask(inside)) if stop else []
+        if len(taken) > 0:
+            last = taken[0]
+        else:
+            last = len(lats) - 1
+        self.dist_to_center = int(dists[last])
+        entered = np.flatnonzero(inside[:last + 1])
+        if len(entered) > 0:
+            self.take_time = times[entered[-1]]
+        if self.checkpoint.checked_on == 'exit':
+            self._point_inside = bool(inside[last])
+        if len(taken) > 0:
+            return int(last)
+
     def dist_to_point(self, lat, lon):
         '''
         Return distance in meters from point with coordinates lat,
@@ -325,8 +417,21 @@ class CylinderCheckpointAdapter(object):
         @return:
         @rtype: int
         '''
-        return int(point_dist_calculator(
-            lat, lon, self.opt_lat, self.opt_lon))
+        return int(vector_dist_calculator(lat, lon, self.opt_lat,
+            self.opt_lon))
+
+    def dists_to_points(self, lats, lons):
+        '''
+        Vectorized L{dist_to_point}.
+        @param lats:
+        @type lats: C{np.array}
+        @param lons:
+        @type lons: C{np.array}
+        @return: distances in meters.
+        @rtype: C{np.array} of int
+        '''
+        return vector_dist_calculator(lats, lons, self.opt_lat,
+            self.opt_lon).astype(int)
 
     @property
     def type(self):
@@ -361,9 +466,13 @@ class RaceTypesFactory(object):
                 if ch.checked_on == 'enter':
                     cp.is_taken_by = types.MethodType(taken_on_enter, cp,
                         CylinderCheckpointAdapter)
+                    cp.taken_mask = types.MethodType(taken_on_enter_mask,
+                        cp, CylinderCheckpointAdapter)
                 elif ch.checked_on == 'exit':
                     cp.is_taken_by = types.MethodType(taken_on_exit, cp,
                         CylinderCheckpointAdapter)
+                    cp.taken_mask = types.MethodType(taken_on_exit_mask,
+                        cp, CylinderCheckpointAdapter)
                 race_checkpoints.append(cp)
         race_checkpoints = getattr(self, '_distances_for_' + rtask[
             'race_type'])(race_checkpoints)
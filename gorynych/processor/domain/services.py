@@ -3,6 +3,7 @@
 __author__ = 'Boris Tsema'
 
 from calendar import timegm
+import bisect
 import time
 import math
 
@@ -12,7 +13,8 @@ import numpy as np
 import numpy.ma as ma
 from zope.interface import implementer
 
-from gorynych.common.domain.services import point_dist_calculator
+from gorynych.common.domain.services import point_dist_calculator, \
+    vector_dist_calculator
 from gorynych.common.exceptions import NoGPSData
 from gorynych.common.domain import events
 from gorynych.processor import interfaces
@@ -21,10 +23,297 @@ def choose_offline_parser(trackname):
     if trackname.endswith('.igc'): return IGCTrackParser
 
 
+def _sorted_uniq(array):
+    '''
+    Return array sorted by timestamp with unique timestamps, first of points
+    with equal timestamps is taken. Array which is already such is returned
+    as is.
+    '''
+    times = array['timestamp']
+    if len(array) < 2 or (times[1:] > times[:-1]).all():
+        return array
+    _, idxs = np.unique(times, return_index=True)
+    return array[idxs]
+
+
 def create_uniq_hstack(array1, array2):
-    result = np.sort(np.hstack((array1, array2)), order='timestamp')
-    _, idxs = np.unique(result['timestamp'], return_index=True)
-    return result[idxs]
+    '''
+    Merge two arrays of points into new array sorted by timestamp with unique
+    timestamps. Both arrays are usually sorted and unique already, so they
+    are merged without sorting; appending of newer points is just a
+    concatenation. If timestamp is in both arrays point from array1 is taken,
+    of points with equal timestamps in one array the first is taken. (Sort
+    which was used before took the point which is less by other fields.)
+    @param array1: points
+    @type array1: C{np.ndarray}
+    @param array2: points which are merged into array1.
+    @type array2: C{np.ndarray}
+    @rtype: C{np.ndarray}
+    '''
+    array1, array2 = _sorted_uniq(array1), _sorted_uniq(array2)
+    if len(array1) == 0 or len(array2) == 0:
+        return np.concatenate((array1, array2))
+    t1, t2 = array1['timestamp'], array2['timestamp']
+    if t2[0] > t1[-1]:
+        return np.concatenate((array1, array2))
+    if t1[0] > t2[-1]:
+        return np.concatenate((array2, array1))
+    # Place of every point from array2 in array1, points with timestamps
+    # from array1 are skipped.
+    pos = np.searchsorted(t1, t2)
+    new = np.ones(len(t2), dtype=bool)
+    inside = pos < len(t1)
+    new[inside] = t1[pos[inside]] != t2[inside]
+    pos = pos[new] + np.arange(new.sum())
+    result = np.empty(len(array1) + len(pos), dtype=array1.dtype)
+    old = np.ones(len(result), dtype=bool)
+    old[pos] = False
+    result[pos] = array2[new]
+    result[old] = array1
+    return result
+
+
+class RingBuffer(object):
+    '''
+    Bounded storage for points ordered by timestamp. Points live in
+    preallocated array twice bigger then capacity, when array end is reached
+    live points are moved to its beginning, so appending costs amortized
+    O(batch) and points are always available as contiguous array.
+    Buffer keeps no more then size last points (if size is given) and drops
+    points which are older then window seconds before first point of
+    appended batch (if window is given). Without size storage grows when
+    window holds more then capacity points.
+    '''
+    def __init__(self, dtype, capacity, size=None, window=None):
+        '''
+        @param dtype: dtype of points.
+        @type dtype: C{list}
+        @param capacity: initial number of points which can be hold.
+        @type capacity: C{int}
+        @param size: maximum number of points to hold.
+        @type size: C{int}
+        @param window: how many seconds before appended points to hold.
+        @type window: C{int}
+        '''
+        self.capacity = max(capacity, size) if size else capacity
+        self.size = size
+        self.window = window
+        self._storage = np.empty(2 * self.capacity, dtype=dtype)
+        self._start = self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def data(self):
+        '''
+        Points in buffer. It's a view which is valid until next append.
+        @rtype: C{np.ndarray}
+        '''
+        return self._storage[self._start:self._end]
+
+    def __getstate__(self):
+        # Only live points are pickled.
+        state = self.__dict__.copy()
+        state['_storage'] = self.data.copy()
+        state['_start'], state['_end'] = 0, len(self)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        live = self._storage
+        self._storage = np.empty(max(2 * self.capacity, len(live)),
+            dtype=live.dtype)
+        self._storage[:len(live)] = live
+
+    def reset(self, points):
+        '''
+        Replace buffer content with points.
+        @param points: points sorted by timestamp with unique timestamps.
+        @type points: C{np.ndarray}
+        '''
+        if self.size:
+            points = points[-self.size:]
+        self.capacity = max(self.capacity, len(points))
+        self._storage = np.empty(2 * self.capacity, dtype=points.dtype)
+        self._storage[:len(points)] = points
+        self._start, self._end = 0, len(points)
+
+    def append(self, points):
+        '''
+        Add points to buffer. Points with timestamps which are already in
+        buffer are ignored.
+        @param points: points to add.
+        @type points: C{np.ndarray}
+        '''
+        if len(points) == 0:
+            return
+        points = _sorted_uniq(points)
+        times = points['timestamp']
+        ts = self._storage['timestamp']
+        if self.window is not None:
+            self._start = bisect.bisect_left(ts, times[0] - self.window,
+                self._start, self._end)
+        pos = bisect.bisect_left(ts, times[0], self._start, self._end)
+        if pos < self._end:
+            # Late points: merge them with tail of the buffer, buffer points
+            # win on equal timestamps.
+            points = create_uniq_hstack(self._storage[pos:self._end], points)
+            self._end = pos
+        if self.size:
+            points = points[-self.size:]
+            self._start = max(self._start, self._end + len(points) - self.size)
+        self._reserve(len(points))
+        self._storage[self._end:self._end + len(points)] = points
+        self._end += len(points)
+
+    def _reserve(self, n):
+        '''
+        Make place for n points at the end of storage.
+        '''
+        if self._end + n <= len(self._storage):
+            return
+        live = self._storage[self._start:self._end]
+        if len(live) + n > self.capacity:
+            self.capacity = max(2 * self.capacity, len(live) + n)
+            storage = np.empty(2 * self.capacity, dtype=self._storage.dtype)
+        else:
+            storage = self._storage
+        storage[:len(live)] = live
+        self._storage = storage
+        self._start, self._end = 0, len(live)
+
+
+# Resolutions of downsampled tracks in seconds.
+LOD_LEVELS = (10, 60, 300)
+
+
+def downsample(tracks, timestamps, values, period):
+    '''
+    Choose points which represent tracks with given resolution. In every
+    period of every track points with minimal and maximal value are kept,
+    so peaks of value (altitude) survive downsampling.
+    @param tracks: track of every point, ids or labels.
+    @type tracks: C{np.ndarray}
+    @param timestamps: timestamps of points.
+    @type timestamps: C{np.ndarray}
+    @param values: values which extremums are kept.
+    @type values: C{np.ndarray}
+    @param period: seconds per bucket.
+    @type period: C{int}
+    @return: indexes of chosen points ordered by track and timestamp.
+    @rtype: C{np.ndarray}
+    '''
+    if len(timestamps) == 0:
+        return np.array([], dtype=int)
+    tracks = np.unique(tracks, return_inverse=True)[1]
+    buckets = timestamps // period
+    # Points of every bucket are ordered by value, so first and last points
+    # of bucket are its minimum and maximum.
+    order = np.lexsort((timestamps, values, buckets, tracks))
+    t, b = tracks[order], buckets[order]
+    edge = np.ones(len(order) + 1, dtype=bool)
+    edge[1:-1] = (t[1:] != t[:-1]) | (b[1:] != b[:-1])
+    kept = order[edge[:-1] | edge[1:]]
+    return kept[np.lexsort((timestamps[kept], tracks[kept]))]
+
+
+class DownsamplingPyramid(object):
+    '''
+    Keeps which buckets of downsampled tracks with several resolutions are
+    written. Bucket of track is closed when a later point of the track came
+    or bucket ended timeout seconds before the newest point. Closed buckets
+    and closed buckets into which late points came are downsampled from
+    saved points. Pyramid is changed by commit, when buckets are written,
+    so buckets of failed writes are closed again.
+    '''
+    def __init__(self, levels=LOD_LEVELS, timeout=120):
+        '''
+        @param levels: bucket sizes in seconds.
+        @type levels: C{tuple}
+        @param timeout: seconds after which bucket of silent track is closed.
+        @type timeout: C{int}
+        '''
+        self.levels = levels
+        self.timeout = timeout
+        # ({track id:(last timestamp, [open bucket start for every level])},
+        # newest timestamp)
+        self.state = ({}, None)
+
+    def __len__(self):
+        return len(self.state[0])
+
+    def __contains__(self, track_id):
+        return track_id in self.state[0]
+
+    def add(self, points, opened=None, state=None):
+        '''
+        Add points and find buckets which should be downsampled.
+        @param points: points with track database ids.
+        @type points: C{np.ndarray}
+        @param opened: {(level, track id):start of first bucket which isn't
+        written} for tracks which pyramid doesn't know, bucket of first
+        point of track is taken for others.
+        @type opened: C{dict}
+        @param state: state to start from instead of committed one.
+        @return: buckets as (levels, ids, from_times, to_times) lists, to_time
+        isn't included, and new state for L{commit}.
+        @rtype: C{tuple}
+        '''
+        tracks, newest = state or self.state
+        tracks = dict(tracks)
+        opened = opened or {}
+        ranges = []
+        if len(points):
+            ids, inverse = np.unique(points['id'], return_inverse=True)
+            times = points['timestamp']
+            first = np.full(len(ids), times.max(), dtype=times.dtype)
+            np.minimum.at(first, inverse, times)
+            last = np.full(len(ids), times.min(), dtype=times.dtype)
+            np.maximum.at(last, inverse, times)
+            for track_id, track_first, track_last in zip(ids.tolist(),
+                    first.tolist(), last.tolist()):
+                if track_id in tracks:
+                    track_last = max(tracks[track_id][0], track_last)
+                    starts = tracks[track_id][1]
+                else:
+                    starts = [opened.get((level, track_id),
+                        track_first // level * level)
+                        for level in self.levels]
+                tracks[track_id] = track_last, starts
+            for j, level in enumerate(self.levels):
+                starts = np.array([tracks[i][1][j] for i in ids.tolist()])
+                late = times < starts[inverse]
+                if late.any():
+                    # Closed buckets are downsampled again.
+                    buckets = set(zip(points['id'][late].tolist(),
+                        (times[late] // level * level).tolist()))
+                    ranges.extend((level, i, b, b + level)
+                        for i, b in sorted(buckets))
+            newest = max(newest, int(times.max()))
+        for track_id, (track_last, starts) in tracks.items():
+            new = []
+            for level, start in zip(self.levels, starts):
+                end = track_last // level * level
+                if end + level <= newest - self.timeout:
+                    end += level
+                if end > start:
+                    ranges.append((level, track_id, start, end))
+                    start = end
+                new.append(start)
+            if track_last < min(new):
+                # All buckets of silent track are closed.
+                del tracks[track_id]
+            else:
+                tracks[track_id] = track_last, new
+        return [list(x) for x in zip(*ranges)] or [[]] * 4, (tracks, newest)
+
+    def commit(self, state):
+        '''
+        Take state which was returned by L{add} after its buckets are
+        written.
+        '''
+        self.state = state
 
 
 def clean_events(evs):
@@ -176,12 +465,17 @@ class OnlineTrashAdapter(object):
         self.dtype = dtype
 
     def read(self, data):
-        result = np.empty(1, self.dtype)
-        result['timestamp'] = data['ts']
-        result['lat'] = data['lat']
-        result['lon'] = data['lon']
-        result['alt'] = data['alt']
-        result['g_speed'] = data['h_speed']
+        '''
+        @param data: point or list of points received from tracker.
+        @type data: C{dict} or C{list} of C{dict}
+        @rtype: C{np.ndarray}
+        '''
+        if isinstance(data, dict):
+            data = [data]
+        result = np.empty(len(data), self.dtype)
+        for key, field in [('ts', 'timestamp'), ('lat', 'lat'), ('lon', 'lon'),
+                ('alt', 'alt'), ('h_speed', 'g_speed')]:
+            result[field] = [point[key] for point in data]
         return result
 
     def process(self, data, trck):
@@ -399,10 +693,8 @@ def vspeed_calculator(alt, times, to_begin=1.):
 
 
 def gspeed_calculator(lat, lon, times):
-    result = [1]
-    for i in xrange(len(times) - 1):
-        result.append(point_dist_calculator(lat[i], lon[i], lat[i+1],lon[i+1]))
-    result = np.array(result) / np.ediff1d(times, to_begin=1)
+    dists = vector_dist_calculator(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    result = np.hstack(([1.], dists)) / np.ediff1d(times, to_begin=1)
     np.around(result, decimals=1, out=result)
     return  result
 
@@ -496,10 +788,85 @@ def runs_of_ones_array(bits):
     return run_starts, run_ends
 
 
+def next_one(runs, idx):
+    '''
+    Find first index not less then idx which is inside one of runs.
+    @param runs: run starts and ends from L{runs_of_ones_array}.
+    @type runs: C{tuple}
+    @param idx:
+    @type idx: C{int}
+    @return: index or None if there is no such index.
+    @rtype: C{int}
+    '''
+    run_starts, run_ends = runs
+    k = np.searchsorted(run_ends, idx, 'right')
+    if k == len(run_ends):
+        return None
+    return max(int(run_starts[k]), int(idx))
+
+
+def moving_range(times, values, at, window):
+    '''
+    Calculate difference between maximum and minimum of values in time
+    window [ts - window, ts] for every timestamp ts from at. Sparse table
+    of maximums and minimums is built only for the part of values which
+    is covered by windows.
+    @param times: sorted unique timestamps.
+    @type times: C{np.ndarray}
+    @param values: values for timestamps.
+    @type values: C{np.ndarray}
+    @param at: timestamps for which range is calculated.
+    @type at: C{np.ndarray}
+    @param window: window length in seconds.
+    @type window: C{int}
+    @return: ranges, zero for timestamps which aren't in times.
+    @rtype: C{np.ndarray}
+    '''
+    result = np.zeros(len(at), dtype=int)
+    if len(at) == 0:
+        return result
+    # Cut the part of arrays which can be in windows. Columns of structured
+    # array aren't contiguous and np.searchsorted would copy them, so bisect
+    # is used here.
+    lo = bisect.bisect_left(times, at.min() - window)
+    hi = bisect.bisect_right(times, at.max())
+    times, values = times[lo:hi], values[lo:hi]
+    ends = np.searchsorted(times, at, 'left')
+    found = ends < len(times)
+    found[found] = times[ends[found]] == at[found]
+    if not found.any():
+        return result
+    ends = ends[found]
+    starts = np.searchsorted(times, at[found] - window, 'left')
+    offset = starts.min()
+    values = values[offset:ends.max() + 1].astype(int)
+    starts -= offset
+    ends -= offset
+    # Window [start, end] is covered by two (maybe overlapping) intervals
+    # of length 2**level: [start, start + 2**level) and
+    # (end - 2**level, end].
+    levels = np.frexp(ends - starts + 1)[1] - 1
+    maxs, mins = [values], [values]
+    for level in xrange(1, levels.max() + 1):
+        half = 1 << (level - 1)
+        maxs.append(np.maximum(maxs[-1][:-half], maxs[-1][half:]))
+        mins.append(np.minimum(mins[-1][:-half], mins[-1][half:]))
+    ranges = np.empty(len(starts), dtype=int)
+    for level in np.unique(levels):
+        idxs = np.flatnonzero(levels == level)
+        left, right = starts[idxs], ends[idxs] - (1 << level) + 1
+        ranges[idxs] = np.maximum(maxs[level][left], maxs[level][right]) - \
+            np.minimum(mins[level][left], mins[level][right])
+    result[found] = ranges
+    return result
+
+
 class ParagliderSkyEarth(object):
     # Threshold value for 'flying'-'not started' or 'not started-flying'
     # change in km/h.
     t_speed = 10
+    # Window for altitude difference calculation in seconds.
+    alt_window = 60
 
     def __init__(self, trackstate):
         '''
@@ -518,18 +885,54 @@ class ParagliderSkyEarth(object):
 
     def state_work(self, data):
         '''
-
+        Look through points and emit events on state changes. Conditions
+        for every state are calculated for the whole array at once and only
+        points on which something happens are processed one by one.
         @param data:
         @type data: numpy.ndarray
         @return:
         @rtype:
         '''
         result = []
-        for point in data:
-            result.append(self._state_work(point))
-        return [item for sublist in result for item in sublist]
+        if len(data) == 0:
+            return result
+        times = data['timestamp']
+        alt_diffs = self._alt_diffs(times)
+        fast = runs_of_ones_array(data['g_speed'] > self.t_speed)
+        slow = runs_of_ones_array(data['g_speed'] < self.t_speed)
+        calm = runs_of_ones_array(alt_diffs <= 5)
+        climbing = runs_of_ones_array(alt_diffs > 30)
+        idx = 0
+        while idx < len(data):
+            if self._state == 'landed' or self._state == 'finished':
+                break
+            if self._in_air:
+                if self._bf:
+                    candidates = [next_one(slow, idx)]
+                elif self._bs:
+                    candidates = [next_one(fast, idx), next_one(calm,
+                        max(idx, np.searchsorted(times, self._bs + 60,
+                            'right')))]
+                else:
+                    candidates = [next_one(fast, idx), next_one(slow, idx)]
+            else:
+                if self._bf:
+                    candidates = [next_one(fast,
+                        max(idx, np.searchsorted(times, self._bf + 60,
+                            'right'))),
+                        next_one(slow, idx)]
+                else:
+                    candidates = [next_one(fast, idx)]
+                candidates.append(next_one(climbing, idx))
+            candidates = [c for c in candidates if c is not None]
+            if not candidates:
+                break
+            idx = min(candidates)
+            result.extend(self._state_work(data[idx], alt_diffs[idx]))
+            idx += 1
+        return result
 
-    def _state_work(self, data):
+    def _state_work(self, data, alt_diff):
         result = []
         if self._state == 'landed' or self._state == 'finished':
             return []
@@ -544,7 +947,7 @@ class ParagliderSkyEarth(object):
                     result.append(self._speed_exceed(data))
 
                 elif self._bs and data['timestamp'] - self._bs > 60 and (
-                    self._alt_diff(data) <= 5):
+                    alt_diff <= 5):
                     # Landed
                     result.append(self._track_landed(data))
                 elif not self._bs and data['g_speed'] < self.t_speed:
@@ -564,7 +967,7 @@ class ParagliderSkyEarth(object):
                 if data['g_speed'] > self.t_speed:
                     # Был медленный, стал быстрый.
                     result.append(self._speed_exceed(data))
-            if self._alt_diff(data) > 30:
+            if alt_diff > 30:
                 # Перепад высот за минуту больше 30 метров.
                 result.append(self._track_in_air(data))
         return result
@@ -590,23 +993,17 @@ class ParagliderSkyEarth(object):
         return events.TrackLanded(self._id, payload=data['distance'],
             occured_on=data['timestamp'])
 
-    def _alt_diff(self, data):
+    def _alt_diffs(self, times):
         '''
-        Return altitude difference for last minute.
-        @param data: track data with dtype=Track.dtype.
-        @type data: C{np.ndarray}
-        @return:
-        @rtype:
+        Return altitude difference for last minute for every timestamp.
+        @param times: timestamps of points from track state buffer.
+        @type times: C{np.ndarray}
+        @return: altitude differences, zero if point isn't in the buffer.
+        @rtype: C{np.ndarray}
         '''
-        ts = data['timestamp']
-        start = np.where(self.trackstate._buffer['timestamp'] >= ts - 60)[0]
-        end = np.where(self.trackstate._buffer['timestamp'] == ts)[0]
-        if len(start) == 0 or len(end) == 0:
-            return False
-        start = start[0] # Left index in time interval.
-        end = end[0] + 1 # Right index in time interval.
-        alts = self.trackstate._buffer['alt'][start:end]
-        return abs(np.max(alts) - np.min(alts))
+        buf = self.trackstate._buffer
+        return moving_range(buf['timestamp'], buf['alt'], times,
+            self.alt_window)
 
 
 class Point(object):
@@ -746,14 +1143,7 @@ class JavaScriptShortWay(object):
 
     @classmethod
     def distanceBetween(cls, lat1, lon1, lat2, lon2):
-        dLat = lat2 - lat1
-        dlon = lon2 - lon1
-        dLatSin = math.sin(cls.deg2rad(dLat)/2)
-        dlonSin = math.sin(cls.deg2rad(dlon)/2)
-        dLatCos1 = math.cos(cls.deg2rad(lat1))
-        dLatCos2 = math.cos(cls.deg2rad(lat2))
-        a = dLatSin*dLatSin + dLatCos1 * dLatCos2 * dlonSin * dlonSin
-        return 2 * math.asin(math.sqrt(a)) * cls.EARTH_RADIUS
+        return float(vector_dist_calculator(lat1, lon1, lat2, lon2))
 
     def lonCoefficientForLat(self, lat):
         return self.distanceBetween(lat, 0, lat, 1)
@@ -228,6 +228,69 @@ class TestTakenOnEnter(unittest.TestCase):
         self.assertEqual(self.adapter.take_time, 15)
 
 
+class TestFirstTakenBy(unittest.TestCase):
+
+    def _adapters(self, checked_on, taken, taken_mask):
+        result = []
+        for i in range(2):
+            adapter = racetypes.CylinderCheckpointAdapter(
+                create_checkpoint_adapter().checkpoint, (40.1, 40.2), 50)
+            adapter.checkpoint.checked_on = checked_on
+            adapter.is_taken_by = types.MethodType(taken, adapter,
+                racetypes.CylinderCheckpointAdapter)
+            adapter.taken_mask = types.MethodType(taken_mask, adapter,
+                racetypes.CylinderCheckpointAdapter)
+            result.append(adapter)
+        return result
+
+    def _points(self):
+        np.random.seed(7)
+        lats = 40.1 + np.random.uniform(-0.003, 0.003, 300).astype('f4')
+        lons = 40.2 + np.random.uniform(-0.003, 0.003, 300).astype('f4')
+        times = np.arange(300, dtype='i4') + 1000
+        return lats, lons, times
+
+    def _check_parity(self, checked_on, taken, taken_mask):
+        scalar, vector = self._adapters(checked_on, taken, taken_mask)
+        takes = 0
+        lats, lons, times = self._points()
+        start = 0
+        while start < len(lats):
+            expected = None
+            for i in range(start, len(lats)):
+                if scalar.is_taken_by(lats[i], lons[i], times[i]):
+                    expected = i
+                    break
+            idx = vector.first_taken_by(lats[start:], lons[start:],
+                times[start:])
+            if idx is not None:
+                idx += start
+            self.assertEqual(idx, expected)
+            self.assertEqual(vector.dist_to_center, scalar.dist_to_center)
+            self.assertEqual(getattr(vector, 'take_time', None),
+                getattr(scalar, 'take_time', None))
+            self.assertEqual(vector._point_inside, scalar._point_inside)
+            if idx is None:
+                break
+            takes += 1
+            start = idx + 1
+        self.assertTrue(takes > 1)
+
+    def test_taken_on_enter(self):
+        self._check_parity('enter', racetypes.taken_on_enter,
+            racetypes.taken_on_enter_mask)
+
+    def test_taken_on_exit(self):
+        self._check_parity('exit', racetypes.taken_on_exit,
+            racetypes.taken_on_exit_mask)
+
+    def test_no_points(self):
+        adapter = self._adapters('enter', racetypes.taken_on_enter,
+            racetypes.taken_on_enter_mask)[0]
+        empty = np.empty(0, dtype='f4')
+        self.assertIsNone(adapter.first_taken_by(empty, empty, empty))
+
+
 class TestRaceTypesFactoryCreate(unittest.TestCase):
 
     def setUp(self):
@@ -346,6 +409,25 @@ class TestRaceToGoal(RaceTestCase):
         self._check_distance(pts, [942144, 784919, 627742, 470637, 313627, 156737, 9])
         self.assertTrackIsComplete(pts, evlist)
 
+    def test_track_in_chunks(self):
+        pts, evlist = self.rt.process(
+            self.complete_track.copy(), self.ts, self.track_id)
+        rt = self.factory.create('online', self.test_race)
+        ts = track.TrackState(self.track_id, [])
+        chunk_evlist = []
+        chunks = []
+        for chunk in np.array_split(self.complete_track.copy(), 3):
+            chunk, evs = rt.process(chunk, ts, self.track_id)
+            for ev in evs:
+                ts.mutate(ev)
+            chunk_evlist.extend(evs)
+            chunks.append(chunk)
+        self.assertListEqual(list(np.hstack(chunks)['distance']),
+            list(pts['distance']))
+        self.assertListEqual(
+            [(ev.name, ev.occured_on, ev.payload) for ev in chunk_evlist],
+            [(ev.name, ev.occured_on, ev.payload) for ev in evlist])
+
     def test_one_checkpoint_missing(self):
         malformed_track = np.delete(self.complete_track, 3)
         pts, evlist = self.rt.process(malformed_track, self.ts, self.track_id)
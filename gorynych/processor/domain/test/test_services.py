@@ -8,6 +8,7 @@ from shapely.geometry import Point
 from gorynych.processor.domain import services, track
 from gorynych.common.domain.types import Checkpoint
 from gorynych.common.domain import events
+from gorynych.common.domain.services import point_dist_calculator
 
 
 class TestOfflineCorrectorService(unittest.TestCase):
@@ -97,6 +98,17 @@ class TestOnlineTrashAdapter(unittest.TestCase):
         self.assertEqual(len(self.ts._buffer), 2)
 
 
+    def test_read(self):
+        ta = services.OnlineTrashAdapter(track.DTYPE)
+        data = [dict(ts=10, lat=40.1, lon=40.2, alt=100, h_speed=36),
+            dict(ts=12, lat=40.3, lon=40.4, alt=110, h_speed=18)]
+        result = ta.read(data)
+        self.assertListEqual(list(result['timestamp']), [10, 12])
+        self.assertListEqual(list(result['alt']), [100, 110])
+        self.assertListEqual(list(result['g_speed']), [36, 18])
+        self.assertEqual(len(ta.read(data[0])), 1)
+
+
 class TestOptDistCalculator(unittest.TestCase):
     def setUp(self):
         self.calculator = services.JavaScriptShortWay()
@@ -137,6 +149,238 @@ class TestOptDistCalculator(unittest.TestCase):
         self.assertAlmostEqual(res/1000, 48.5, 0)
 
 
+class TestGSpeedCalculator(unittest.TestCase):
+    def test_parity(self):
+        np.random.seed(3)
+        lat = 45 + np.cumsum(np.random.uniform(-0.001, 0.001, 1000))
+        lon = 6 + np.cumsum(np.random.uniform(-0.001, 0.001, 1000))
+        times = np.cumsum(np.random.randint(1, 10, 1000)).astype('i4')
+        expected = [1]
+        for i in xrange(len(times) - 1):
+            expected.append(point_dist_calculator(lat[i], lon[i], lat[i+1],
+                lon[i+1]))
+        expected = np.around(np.array(expected) /
+            np.ediff1d(times, to_begin=1), decimals=1)
+        result = services.gspeed_calculator(lat, lon, times)
+        np.testing.assert_allclose(result, expected, atol=0.1)
+        self.assertTrue(np.mean(result == expected) > 0.99)
+
+    def test_one_point(self):
+        result = services.gspeed_calculator(np.array([45.]),
+            np.array([6.]), np.array([10]))
+        self.assertListEqual(list(result), [1.])
+
+
+class TestDistanceBetween(unittest.TestCase):
+    def test_parity(self):
+        for args in [(43.9785, 6.48, 44.371167, 6.309833), (0, 0, 0, 1),
+                (45.12298, 21.32548, 44.8502, 21.33993)]:
+            self.assertAlmostEqual(
+                services.JavaScriptShortWay.distanceBetween(*args),
+                point_dist_calculator(*args), 6)
+
+
+class TestMovingRange(unittest.TestCase):
+    def test_brute_force(self):
+        np.random.seed(5)
+        times = np.cumsum(np.random.randint(1, 20, 500)).astype('i4')
+        alts = (np.cumsum(np.random.randint(-10, 11, 500)) + 1000).astype(
+            'i2')
+        at = np.hstack((times[::3], [times[-1] + 1, 0])).astype('i4')
+        result = services.moving_range(times, alts, at, 60)
+        for i, ts in enumerate(at):
+            if ts not in times:
+                self.assertEqual(result[i], 0)
+                continue
+            window = alts[(times >= ts - 60) & (times <= ts)]
+            self.assertEqual(result[i], window.max() - window.min())
+
+    def test_nothing_found(self):
+        result = services.moving_range(np.arange(10), np.arange(10),
+            np.array([20, 30]), 60)
+        self.assertListEqual(list(result), [0, 0])
+
+
+class TestNextOne(unittest.TestCase):
+    def test_next_one(self):
+        runs = services.runs_of_ones_array(np.array([0, 1, 1, 0, 0, 1]))
+        self.assertEqual(services.next_one(runs, 0), 1)
+        self.assertEqual(services.next_one(runs, 2), 2)
+        self.assertEqual(services.next_one(runs, 3), 5)
+        self.assertIsNone(services.next_one(runs, 6))
+
+
+class TestCreateUniqHstack(unittest.TestCase):
+    def points(self, times, alt=0):
+        result = np.zeros(len(times), dtype=track.DTYPE)
+        result['timestamp'] = times
+        result['alt'] = alt
+        return result
+
+    def test_in_order(self):
+        result = services.create_uniq_hstack(self.points([1, 2]),
+            self.points([3, 5]))
+        self.assertListEqual(list(result['timestamp']), [1, 2, 3, 5])
+
+    def test_late_points(self):
+        result = services.create_uniq_hstack(self.points([1, 3, 5], 1),
+            self.points([0, 3, 4, 7], 2))
+        self.assertListEqual(list(result['timestamp']), [0, 1, 3, 4, 5, 7])
+        self.assertListEqual(list(result['alt']), [2, 1, 1, 2, 1, 2])
+
+    def test_unsorted(self):
+        result = services.create_uniq_hstack(self.points([5, 1, 5]),
+            self.points([]))
+        self.assertListEqual(list(result['timestamp']), [1, 5])
+
+    def test_ties_keep_first_point(self):
+        a = self.points([1, 3, 3], 5)
+        a['alt'][2] = 1
+        b = self.points([3, 1, 2], -5)
+        result = services.create_uniq_hstack(a, b)
+        self.assertListEqual(list(result['timestamp']), [1, 2, 3])
+        self.assertListEqual(list(result['alt']), [5, -5, 5])
+
+    def test_against_stable_sort(self):
+        np.random.seed(7)
+        for i in xrange(200):
+            a = self.points(np.random.randint(0, 100, 50))
+            b = self.points(np.random.randint(0, 100, 20))
+            a['alt'] = np.random.randint(-100, 100, len(a))
+            b['alt'] = np.random.randint(-100, 100, len(b))
+            both = np.hstack((a, b))
+            both = both[np.argsort(both['timestamp'], kind='mergesort')]
+            _, idxs = np.unique(both['timestamp'], return_index=True)
+            result = services.create_uniq_hstack(a, b)
+            self.assertListEqual(result.tolist(), both[idxs].tolist())
+
+
+class TestRingBuffer(unittest.TestCase):
+    def points(self, times):
+        result = np.zeros(len(times), dtype=track.DTYPE)
+        result['timestamp'] = times
+        result['alt'] = times
+        return result
+
+    def test_window(self):
+        buf = services.RingBuffer(track.DTYPE, 4, window=60)
+        for start in xrange(0, 1000, 30):
+            buf.append(self.points(np.arange(start, start + 30, 5)))
+            self.assertListEqual(list(buf.data['timestamp']),
+                range(max(0, start - 60), start + 30, 5))
+        self.assertLessEqual(buf.capacity, 32)
+
+    def test_big_batch(self):
+        buf = services.RingBuffer(track.DTYPE, 4, window=60)
+        buf.append(self.points(np.arange(1000)))
+        self.assertListEqual(list(buf.data['alt']), range(1000))
+
+    def test_size(self):
+        buf = services.RingBuffer(track.DTYPE, 3, size=3)
+        buf.append(self.points([1, 2]))
+        buf.append(self.points([3, 4]))
+        self.assertListEqual(list(buf.data['timestamp']), [2, 3, 4])
+        buf.append(self.points(np.arange(5, 20)))
+        self.assertListEqual(list(buf.data['timestamp']), [17, 18, 19])
+        self.assertEqual(len(buf), 3)
+
+    def test_late_and_duplicated_points(self):
+        buf = services.RingBuffer(track.DTYPE, 4, window=60)
+        buf.append(self.points([10, 20, 30]))
+        late = self.points([30, 15, 20, 40])
+        late['alt'] = -1
+        buf.append(late)
+        self.assertListEqual(list(buf.data['timestamp']), [10, 15, 20, 30, 40])
+        self.assertListEqual(list(buf.data['alt']), [10, -1, 20, 30, -1])
+
+    def test_reset(self):
+        buf = services.RingBuffer(track.DTYPE, 2, window=60)
+        buf.reset(self.points(np.arange(10)))
+        self.assertEqual(len(buf), 10)
+        buf.append(self.points([65]))
+        self.assertListEqual(list(buf.data['timestamp']), [5, 6, 7, 8, 9, 65])
+
+
+class TestDownsample(unittest.TestCase):
+    def test_min_max(self):
+        times = np.array([0, 1, 2, 3, 10, 11, 0, 5])
+        alt = np.array([5, 9, 1, 5, 7, 7, 3, 3])
+        tracks = np.array(['1', '1', '1', '1', '1', '1', '2', '2'],
+            dtype=object)
+        idxs = services.downsample(tracks, times, alt, 10)
+        self.assertListEqual(list(idxs), [1, 2, 4, 5, 6, 7])
+
+    def test_against_loop(self):
+        np.random.seed(3)
+        ids = np.random.randint(0, 5, 500)
+        times = np.random.permutation(np.arange(500)) * 7 % 1000
+        alt = np.random.randint(0, 3000, 500)
+        idxs = services.downsample(ids, times, alt, 60)
+        expected = set()
+        for key in set(zip(ids, times // 60)):
+            group = [i for i in range(500) if (ids[i], times[i] // 60) == key]
+            expected.add(min(group, key=lambda i: (alt[i], times[i])))
+            expected.add(max(group, key=lambda i: (alt[i], times[i])))
+        self.assertSetEqual(set(idxs), expected)
+        self.assertListEqual(list(idxs), sorted(idxs,
+            key=lambda i: (ids[i], times[i])))
+
+    def test_empty(self):
+        self.assertEqual(len(services.downsample(np.array([]), np.array([]),
+            np.array([]), 10)), 0)
+
+
+class TestDownsamplingPyramid(unittest.TestCase):
+    def points(self, _id, times):
+        result = np.zeros(len(times), dtype=track.DTYPE)
+        result['id'] = _id
+        result['timestamp'] = times
+        result['alt'] = times
+        return result
+
+    def add(self, pyramid, points, **kw):
+        ranges, state = pyramid.add(points, **kw)
+        pyramid.commit(state)
+        return sorted(zip(*ranges))
+
+    def test_incremental(self):
+        pyramid = services.DownsamplingPyramid((10, 60), timeout=1000)
+        batch = np.concatenate((self.points(1, range(0, 25)),
+            self.points(2, range(0, 5))))
+        self.assertListEqual(self.add(pyramid, batch), [(10, 1, 0, 20)])
+        # Bucket with late point is downsampled again, open buckets are
+        # closed by the next points of their tracks.
+        result = self.add(pyramid, np.concatenate((self.points(1, [5, 61]),
+            self.points(2, [30]))))
+        self.assertListEqual(result, [(10, 1, 0, 10), (10, 1, 20, 60),
+            (10, 2, 0, 30), (60, 1, 0, 60)])
+        self.assertEqual(len(pyramid), 2)
+
+    def test_timeout(self):
+        pyramid = services.DownsamplingPyramid((10,), timeout=100)
+        self.add(pyramid, self.points(1, [0, 5]))
+        result = self.add(pyramid, self.points(2, [150]))
+        self.assertListEqual(result, [(10, 1, 0, 10)])
+        self.assertEqual(len(pyramid), 1)
+        self.assertNotIn(1, pyramid)
+
+    def test_not_committed(self):
+        pyramid = services.DownsamplingPyramid((10,), timeout=100)
+        points = self.points(1, range(0, 25))
+        ranges, state = pyramid.add(points)
+        self.assertEqual(len(pyramid), 0)
+        self.assertEqual(pyramid.add(points)[0], ranges)
+        ranges, state = pyramid.add(self.points(2, [0, 15]), state=state)
+        self.assertListEqual(sorted(zip(*ranges)), [(10, 2, 0, 10)])
+        self.assertEqual(len(state[0]), 2)
+
+    def test_opened(self):
+        pyramid = services.DownsamplingPyramid((10, 60), timeout=100)
+        result = self.add(pyramid, self.points(1, [125]),
+            opened={(10, 1): 90, (60, 1): 60})
+        self.assertListEqual(result, [(10, 1, 90, 120), (60, 1, 60, 120)])
+
+
 class TestParagliderSkyEarth(unittest.TestCase):
     def setUp(self):
         tid = track.TrackID()
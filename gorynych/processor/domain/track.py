@@ -44,6 +44,8 @@ class TrackState(ValueObject):
     Hold track state. Memento.
     '''
     states = ['not started', 'started', 'es_taken', 'finished']
+    # Initial number of points in buffer.
+    buffer_capacity = 256
     def __init__(self, id, event_list):
         self.id = id
         # Time when track speed become more then threshold.
@@ -60,8 +62,10 @@ class TrackState(ValueObject):
         # XXX: for aftertask tracks.
         self.es_taken = None
         self.start_time = None
-        # Buffer for points.
-        self._buffer = np.empty(0, dtype=DTYPE)
+        # Buffer for points. Hold only last minute before new points which
+        # is needed for altitude difference calculation.
+        self.points_buffer = services.RingBuffer(DTYPE, self.buffer_capacity,
+            window=services.ParagliderSkyEarth.alt_window)
         # Time at which track has been ended.
         self.end_time = None
         self.ended = False
@@ -70,6 +74,14 @@ class TrackState(ValueObject):
         for ev in event_list:
             self.mutate(ev)
 
+    @property
+    def _buffer(self):
+        return self.points_buffer.data
+
+    @_buffer.setter
+    def _buffer(self, points):
+        self.points_buffer.reset(points)
+
     def mutate(self, ev):
         '''
         Mutate state according to event. Analog of apply method in AggregateRoot.
@@ -147,6 +159,8 @@ class TrackState(ValueObject):
 class Track(AggregateRoot):
 
     dtype = DTYPE
+    # How many processed points to hold.
+    processed_size = 100
 
     def __init__(self, id, events=None):
         super(Track, self).__init__()
@@ -161,10 +175,17 @@ class Track(AggregateRoot):
         # Buffer for appended to track data.
         self.buffer = np.empty(0, dtype=self.dtype)
         # Processed points holded for future processing.
-        self.processed = np.empty(0, dtype=self.dtype)
+        self._processed = services.RingBuffer(self.dtype, self.processed_size,
+            size=self.processed_size)
         # track data can be introduced as
         # np.hstack((processed, points, buffer))
 
+    def __getstate__(self):
+        # Task and type aren't pickled, they are created from state again.
+        state = self.__dict__.copy()
+        state['_task'] = state['_type'] = None
+        return state
+
     def apply(self, ev):
         if isinstance(ev, list):
             for e in ev:
@@ -192,8 +213,7 @@ class Track(AggregateRoot):
         points, processed_evs = self.task.process(points, self._state, self.id)
         self.points = services.create_uniq_hstack(self.points, points)
         # TODO: do it correctly. Introduce correct snapshotting.
-        self._state._buffer = services.create_uniq_hstack(
-            self._state._buffer, self.points)
+        self._state.points_buffer.append(self.points)
         # Look for state after processing and do all correctness.
         postprocessed_evs = self.type.postprocess(self)
         # Apply events from task processing. We don't do it before
@@ -204,6 +224,14 @@ class Track(AggregateRoot):
         self.apply(postprocessed_evs)
         self.changes = services.clean_events(self.changes)
 
+    @property
+    def processed(self):
+        return self._processed.data
+
+    @processed.setter
+    def processed(self, points):
+        self._processed.reset(points)
+
     @property
     def state(self):
         return self._state.get_state()
@@ -223,7 +251,6 @@ class Track(AggregateRoot):
 
     def reset(self):
         self.changes=[]
-        self.processed = services.create_uniq_hstack(self.processed,
-            self.points)[-100:]
+        self._processed.append(self.points)
         self.points = np.empty(0, dtype=self.dtype)
 
@@ -0,0 +1,225 @@
+'''
+Monthly partitions of track_data.
+
+track_data is partitioned by range of timestamp, every partition keeps one
+UTC month and is named track_data_YYYYMM. TrackRepository creates
+partitions when points for them come, queries with timestamp bounds are
+pruned by PostgreSQL.
+
+Usage:
+    python -m gorynych.processor.infrastructure.partitions migrate
+    python -m gorynych.processor.infrastructure.partitions archive \
+        --before 2013-01-01 --directory /var/backups/track_data
+
+migrate moves existing unpartitioned track_data into partitions, it can be
+restarted if interrupted. archive detaches partitions of months before the
+given date, saves them as gzipped binary COPY files (which can be loaded
+back with COPY ... FROM ... WITH BINARY into a table like track_data) and
+drops them. Processor should be stopped while migration runs.
+'''
+import calendar
+import datetime
+import gzip
+import os
+import re
+import sys
+
+import psycopg2
+from twisted.python import log, usage
+
+from gorynych import BaseOptions
+
+PARTITION_PREFIX = 'track_data_'
+
+CREATE_PARTITION = """
+    CREATE TABLE IF NOT EXISTS %s PARTITION OF track_data
+    FOR VALUES FROM (%d) TO (%d);
+    """
+
+SELECT_PARTITIONS = """
+    SELECT c.relname FROM pg_inherits i, pg_class c
+    WHERE i.inhrelid = c.oid AND i.inhparent = 'track_data'::regclass;
+    """
+
+IS_PARTITIONED = """
+    SELECT relkind = 'p' FROM pg_class WHERE relname = 'track_data';
+    """
+
+LEGACY_EXISTS = """
+    SELECT count(*) FROM pg_class WHERE relname = 'track_data_legacy';
+    """
+
+# Unpartitioned table is renamed and partitioned one is created instead.
+RENAME_LEGACY = """
+    ALTER TABLE track_data RENAME TO track_data_legacy;
+    ALTER INDEX track_data_pkey RENAME TO track_data_legacy_pkey;
+    DROP INDEX IF EXISTS track_data_timestamp_idx;
+    CREATE TABLE track_data(
+        id INT REFERENCES track(id) ON DELETE CASCADE,
+        timestamp INTEGER,
+        lat DOUBLE PRECISION,
+        lon DOUBLE PRECISION,
+        alt SMALLINT,
+        g_speed REAL,
+        v_speed REAL,
+        distance INTEGER,
+        PRIMARY KEY (timestamp, id)
+    ) PARTITION BY RANGE (timestamp);
+    """
+
+MOVE_LEGACY = """
+    INSERT INTO track_data SELECT * FROM track_data_legacy
+    WHERE timestamp >= %s AND timestamp < %s ON CONFLICT DO NOTHING;
+    """
+
+
+def month_range(timestamp):
+    '''
+    Return bounds of UTC month with timestamp.
+    @param timestamp: unixtime
+    @type timestamp: C{int}
+    @return: (month start, next month start) in unixtime.
+    @rtype: C{tuple}
+    '''
+    dt = datetime.datetime.utcfromtimestamp(timestamp)
+    start = datetime.datetime(dt.year, dt.month, 1)
+    end = datetime.datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    return calendar.timegm(start.timetuple()), \
+        calendar.timegm(end.timetuple())
+
+
+def partitions(from_time, to_time):
+    '''
+    Return partitions which keep points from time interval.
+    @return: [(partition name, month start, next month start), ...]
+    @rtype: C{list}
+    '''
+    result = []
+    start, end = month_range(from_time)
+    while start <= to_time:
+        name = datetime.datetime.utcfromtimestamp(start).strftime(
+            PARTITION_PREFIX + '%Y%m')
+        result.append((name, start, end))
+        start, end = month_range(end)
+    return result
+
+
+def create_partitions(cur, from_time, to_time, existing=None):
+    '''
+    Create partitions for time interval if they don't exist.
+    @param existing: names of partitions which are known to exist, created
+    partitions are added to it.
+    @type existing: C{set}
+    '''
+    if existing is None:
+        existing = set()
+    for name, start, end in partitions(from_time, to_time):
+        if name not in existing:
+            cur.execute(CREATE_PARTITION % (name, start, end))
+            existing.add(name)
+
+
+def migrate(connection):
+    '''
+    Move points from unpartitioned track_data into monthly partitions.
+    Every month is moved in its own transaction.
+    '''
+    cur = connection.cursor()
+    cur.execute(IS_PARTITIONED)
+    if not cur.fetchone()[0]:
+        cur.execute(RENAME_LEGACY)
+        connection.commit()
+    cur.execute(LEGACY_EXISTS)
+    if not cur.fetchone()[0]:
+        log.msg("track_data is partitioned already")
+        return
+    cur.execute("SELECT min(timestamp), max(timestamp) FROM "
+        "track_data_legacy")
+    first, last = cur.fetchone()
+    if first is not None:
+        for name, start, end in partitions(first, last):
+            create_partitions(cur, start, start)
+            cur.execute(MOVE_LEGACY, (start, end))
+            log.msg("%s rows moved into %s" % (cur.rowcount, name))
+            connection.commit()
+    cur.execute("DROP TABLE track_data_legacy")
+    connection.commit()
+
+
+def archive(connection, before, directory):
+    '''
+    Detach partitions of months which ended before given time, save them
+    into directory as gzipped binary COPY and drop them.
+    @param before: unixtime
+    @type before: C{int}
+    @return: names of archived partitions.
+    @rtype: C{list}
+    '''
+    cur = connection.cursor()
+    cur.execute(SELECT_PARTITIONS)
+    result = []
+    for name, in sorted(cur.fetchall()):
+        match = re.match(PARTITION_PREFIX + r'(\d{4})(\d{2})$', name)
+        if not match:
+            continue
+        start = calendar.timegm((int(match.group(1)), int(match.group(2)),
+            1, 0, 0, 0))
+        if month_range(start)[1] > before:
+            continue
+        filename = os.path.join(directory, name + '.copy.gz')
+        cur.execute("ALTER TABLE track_data DETACH PARTITION %s" % name)
+        f = gzip.open(filename, 'wb')
+        try:
+            cur.copy_expert("COPY %s TO STDOUT WITH BINARY" % name, f)
+        finally:
+            f.close()
+        cur.execute("DROP TABLE %s" % name)
+        connection.commit()
+        log.msg("%s archived into %s" % (name, filename))
+        result.append(name)
+    return result
+
+
+class ArchiveOptions(usage.Options):
+    optParameters = [
+        ['before', 'b', None, "Archive months which ended before this date "
+            "(YYYY-MM-DD)."],
+        ['directory', 'd', '.', "Directory for archived partitions."]
+    ]
+
+    def postOptions(self):
+        if not self['before']:
+            raise usage.UsageError("--before is required")
+        self['before'] = calendar.timegm(datetime.datetime.strptime(
+            self['before'], '%Y-%m-%d').timetuple())
+
+
+class Options(BaseOptions):
+    subCommands = [
+        ['migrate', None, usage.Options,
+            "Move unpartitioned track_data into partitions."],
+        ['archive', None, ArchiveOptions, "Archive old partitions."]
+    ]
+
+
+def main(argv):
+    config = Options()
+    config.parseOptions(argv)
+    log.startLogging(sys.stdout)
+    connection = psycopg2.connect(host=config['dbhost'],
+        database=config['dbname'], user=config['dbuser'],
+        password=config['dbpassword'])
+    try:
+        if config.subCommand == 'migrate':
+            migrate(connection)
+        elif config.subCommand == 'archive':
+            archive(connection, config.subOptions['before'],
+                config.subOptions['directory'])
+        else:
+            raise usage.UsageError("migrate or archive command expected")
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
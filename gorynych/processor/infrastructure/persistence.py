@@ -4,16 +4,25 @@ import time
 import cPickle
 from collections import defaultdict
 import json
-import re
+from io import BytesIO
 
 import numpy as np
 from twisted.internet import defer
 from twisted.python import log
 
-from gorynych.common.infrastructure.persistence import np_as_text
+from gorynych.common.infrastructure.persistence import np_as_text, \
+    np_as_binary
 from gorynych.common.infrastructure import persistence as pe
+from gorynych.common.infrastructure.serializers import SnapshotSerializer
 from gorynych.common.exceptions import NoAggregate
+from gorynych.eventstore.snapshots import SnapshotStore
 from gorynych.processor.domain import track
+from gorynych.processor.domain.services import DownsamplingPyramid
+from gorynych.processor.infrastructure.partitions import create_partitions
+
+
+# Version of pickled TrackState in snapshots, must be changed with TrackState.
+TRACK_SNAPSHOT_VERSION = 1
 
 
 class PickledTrackRepository(object):
@@ -23,16 +32,156 @@ class PickledTrackRepository(object):
         f.close()
 
 
+SELECT_TRACK = pe.select('track')
+
+# Empty last state is inserted with track, so start positions of group
+# know that track has no data yet.
 NEW_TRACK = """
-    INSERT INTO track (start_time, end_time, track_type, track_id)
-    VALUES (%s, %s, (SELECT id FROM track_type WHERE name=%s), %s)
-    RETURNING ID;
+    WITH t AS (
+        INSERT INTO track (start_time, end_time, track_type, track_id)
+        VALUES (%s, %s, (SELECT id FROM track_type WHERE name=%s), %s)
+        RETURNING ID),
+      ls AS (INSERT INTO track_last_state (id) SELECT id FROM t)
+    SELECT id FROM t;
     """
 
 INSERT_SNAPSHOT = """
     INSERT INTO track_snapshot (timestamp, id, snapshot) VALUES(%s, %s, %s)
     """
 
+# Channel on which time intervals of saved points are announced.
+POINTS_CHANNEL = 'track_points'
+
+# Points which are more then NOTIFY_GAP seconds apart are announced in
+# different intervals, intervals are not longer then NOTIFY_LENGTH seconds.
+NOTIFY_GAP = 60
+NOTIFY_LENGTH = 600
+
+# Every interval is announced as "from_time,to_time,group_id,..." with
+# groups of tracks which got points in it. Interval without groups concerns
+# all groups, so it's sent when groups don't fit into payload.
+NOTIFY_POINTS = """
+    SELECT pg_notify('%s', concat_ws(',', from_time, to_time,
+        CASE WHEN sum(length(group_id) + 1) < 7000
+            THEN string_agg(group_id, ',') END))
+    FROM (SELECT DISTINCT n.from_time, n.to_time, tg.group_id
+        FROM unnest(%%s::int[], %%s::int[], %%s::int[])
+            AS n(from_time, to_time, id),
+            tracks_group tg
+        WHERE tg.track_id = n.id) g
+    GROUP BY from_time, to_time;
+    """ % POINTS_CHANNEL
+
+# Timestamp bound lets PostgreSQL scan only fresh partitions.
+SELECT_LAST_TIMESTAMPS = """
+    SELECT id, max(timestamp) FROM track_data
+    WHERE id = ANY(%s) AND timestamp >= %s GROUP BY id;
+    """
+
+# Points which can be in track_data already are inserted only if they
+# aren't there.
+INSERT_MISSING_POINTS = """
+    INSERT INTO track_data
+    SELECT * FROM unnest(%s::int[], %s::int[], %s::float8[], %s::float8[],
+        %s::smallint[], %s::real[], %s::real[], %s::int[])
+        AS p(id, timestamp, lat, lon, alt, g_speed, v_speed, distance)
+    WHERE NOT EXISTS (SELECT 1 FROM track_data td
+        WHERE td.id = p.id AND td.timestamp = p.timestamp)
+    ON CONFLICT DO NOTHING;
+    """
+
+# Newest point of every track is kept in track_last_state.
+UPSERT_LAST_POINTS = """
+    INSERT INTO track_last_state AS ls
+        (id, timestamp, lat, lon, alt, g_speed, v_speed, distance)
+    SELECT * FROM unnest(%s::int[], %s::int[], %s::float8[], %s::float8[],
+        %s::smallint[], %s::real[], %s::real[], %s::int[])
+    ON CONFLICT (id) DO UPDATE SET
+        timestamp = excluded.timestamp, lat = excluded.lat,
+        lon = excluded.lon, alt = excluded.alt, g_speed = excluded.g_speed,
+        v_speed = excluded.v_speed, distance = excluded.distance
+    WHERE ls.timestamp IS NULL OR ls.timestamp < excluded.timestamp;
+    """
+
+# Seconds before points in which written buckets of tracks are looked for.
+LOD_LOOKBACK = 86400
+
+# Start of first bucket which isn't written on every level for tracks which
+# pyramid doesn't know (after restart): bucket after the last written one,
+# or bucket of the newest saved point.
+SELECT_LOD_OPENED = """
+    SELECT l.level, ls.id, coalesce(
+        (SELECT (max(timestamp) / l.level + 1) * l.level FROM track_data_lod
+        WHERE level = l.level AND id = ls.id AND timestamp >= %s),
+        ls.timestamp / l.level * l.level)
+    FROM track_last_state ls, unnest(%s::smallint[]) AS l(level)
+    WHERE ls.id = ANY(%s) AND ls.timestamp >= %s;
+    """
+
+# Buckets are downsampled from track_data: points with minimal and maximal
+# altitude of every bucket are kept, as downsample does. Buckets written
+# before are replaced, so late points get there.
+DELETE_LOD_POINTS = """
+    DELETE FROM track_data_lod l
+    USING unnest(%s::smallint[], %s::int[], %s::int[], %s::int[])
+        AS r(level, id, from_time, to_time)
+    WHERE l.level = r.level AND l.id = r.id AND
+        l.timestamp >= r.from_time AND l.timestamp < r.to_time;
+    """
+
+INSERT_LOD_POINTS = """
+    INSERT INTO track_data_lod
+    SELECT level, id, timestamp, lat, lon, alt, g_speed, v_speed, distance
+    FROM (SELECT r.level, td.*,
+            row_number() OVER (w ORDER BY td.alt, td.timestamp) AS low,
+            row_number() OVER (w ORDER BY td.alt DESC, td.timestamp DESC)
+                AS high
+        FROM unnest(%s::smallint[], %s::int[], %s::int[], %s::int[])
+                AS r(level, id, from_time, to_time),
+            track_data td
+        WHERE td.id = r.id AND td.timestamp >= r.from_time AND
+            td.timestamp < r.to_time
+        WINDOW w AS (PARTITION BY r.level, td.id, td.timestamp / r.level)) b
+    WHERE low = 1 OR high = 1;
+    """
+
+# Last three snapshots of every track are kept in track_last_state. Of
+# snapshots with the same timestamp the first one is kept, existing one
+# before new ones, as in track_snapshot.
+UPSERT_LAST_SNAPSHOTS = """
+    INSERT INTO track_last_state AS ls (id, snapshot_times, snapshots)
+    SELECT id, array_agg(timestamp ORDER BY timestamp),
+        array_agg(snapshot ORDER BY timestamp)
+    FROM (SELECT DISTINCT ON (id, timestamp) id, timestamp, snapshot
+        FROM unnest(%s::int[], %s::int[], %s::text[])
+            WITH ORDINALITY AS s(id, timestamp, snapshot, ord)
+        ORDER BY id, timestamp, ord) s
+    GROUP BY id
+    ON CONFLICT (id) DO UPDATE SET (snapshot_times, snapshots) = (
+        SELECT array_agg(t ORDER BY t), array_agg(s ORDER BY t)
+        FROM (SELECT DISTINCT ON (t) t, s
+            FROM unnest(ls.snapshot_times || excluded.snapshot_times,
+                ls.snapshots || excluded.snapshots)
+                WITH ORDINALITY AS u(t, s, ord)
+            ORDER BY t DESC, ord LIMIT 3) last);
+    """
+
+# Snapshots are copied into staging table first and then moved into
+# track_snapshot skipping rows which are there already.
+CREATE_TRACK_SNAPSHOT_STAGING = """
+    CREATE TEMP TABLE IF NOT EXISTS track_snapshot_staging
+    (LIKE track_snapshot) ON COMMIT DELETE ROWS;
+    """
+
+MOVE_TRACK_SNAPSHOT = """
+    INSERT INTO track_snapshot SELECT * FROM track_snapshot_staging
+    ON CONFLICT DO NOTHING;
+    """
+
+UPDATE_START_TIME = "UPDATE track SET start_time=%s WHERE ID=%s"
+
+UPDATE_END_TIME = "UPDATE track SET end_time=%s WHERE ID=%s"
+
 
 def find_aftertasks_snapshots(data):
     '''
@@ -84,29 +233,147 @@ def get_states_from_events(obj):
     return result
 
 
-class TrackRepository(object):
+def copy_points(cur, points, copy_format='text'):
+    '''
+    Write points into track_data with one COPY.
+    @param cur: cursor in transaction.
+    @param points: points with track database ids.
+    @type points: C{np.ndarray}
+    @param copy_format: 'text' or 'binary' COPY format.
+    @type copy_format: C{str}
+    '''
+    if copy_format == 'binary':
+        cur.copy_expert("COPY track_data FROM STDIN WITH BINARY",
+            np_as_binary(points))
+    else:
+        cur.copy_expert("COPY track_data FROM STDIN ", np_as_text(points))
+
+
+def insert_missing_points(cur, points):
+    '''
+    Insert points which aren't in track_data yet with one statement.
+    @param cur: cursor in transaction.
+    @param points: points with track database ids.
+    @type points: C{np.ndarray}
+    '''
+    cur.execute(INSERT_MISSING_POINTS,
+        [points[name].tolist() for name in points.dtype.names])
+
+
+def copy_snapshots(cur, snapshots):
+    '''
+    Write snapshots into track_snapshot in one COPY, existing snapshots are
+    left as is. Last snapshots of tracks are updated.
+    @param cur: cursor in transaction.
+    @param snapshots: (id, timestamp, snapshot) rows.
+    @type snapshots: C{list}
+    '''
+    data = BytesIO()
+    for row in snapshots:
+        data.write('%d\t%d\t%s\n' % (row[0], row[1],
+            row[2].replace('\\', '\\\\')))
+    data.seek(0)
+    cur.execute(CREATE_TRACK_SNAPSHOT_STAGING)
+    cur.copy_expert("COPY track_snapshot_staging (id, timestamp, snapshot) "
+                    "FROM STDIN ", data)
+    cur.execute(MOVE_TRACK_SNAPSHOT)
+    cur.execute(UPSERT_LAST_SNAPSHOTS, map(list, zip(*snapshots)))
 
-    duplicate_key_ts = r'Key.*\((\d*)\,.*already exists'
 
-    def __init__(self, pool):
+def notify_intervals(points, gap=NOTIFY_GAP, length=NOTIFY_LENGTH):
+    '''
+    Split time span of points into intervals for NOTIFY_POINTS, so late
+    points don't make live interval hours long.
+    @param points: points with track database ids.
+    @type points: C{np.ndarray}
+    @return: from_time, to_time and id lists, one item for every track
+    which has points in interval.
+    @rtype: C{tuple}
+    '''
+    ts = np.unique(points['timestamp'])
+    segment = np.zeros(len(ts), dtype=int)
+    segment[1:] = np.cumsum(np.diff(ts) > gap)
+    chunk = (ts - ts[np.searchsorted(segment, segment)]) // length
+    first = np.ones(len(ts), dtype=bool)
+    first[1:] = (segment[1:] != segment[:-1]) | (chunk[1:] != chunk[:-1])
+    starts = np.nonzero(first)[0]
+    ends = np.append(starts[1:], len(ts)) - 1
+    # Unique (interval number, track id) pairs.
+    number = np.cumsum(first)[np.searchsorted(ts, points['timestamp'])] - 1
+    base = int(points['id'].max()) + 1
+    number, ids = np.divmod(np.unique(number * base +
+        points['id'].astype(np.int64)), base)
+    return ts[starts][number].tolist(), ts[ends][number].tolist(), \
+        ids.tolist()
+
+
+def last_points(points):
+    '''
+    Return newest point of every track.
+    @param points: points with track database ids.
+    @type points: C{np.ndarray}
+    @rtype: C{np.ndarray}
+    '''
+    points = points[np.lexsort((points['timestamp'], points['id']))]
+    last = np.ones(len(points), dtype=bool)
+    last[:-1] = points['id'][1:] != points['id'][:-1]
+    return points[last]
+
+
+class TrackRepository(object):
+
+    def __init__(self, pool, copy_format='binary'):
+        '''
+        @param copy_format: format in which points are sent to database,
+        'binary' or 'text'.
+        @type copy_format: C{str}
+        '''
+        assert copy_format in ('text', 'binary'), \
+            "Unknown COPY format %s" % copy_format
         self.pool = pool
+        self.copy_format = copy_format
+        # {track database id:timestamp after which track has no saved points
+        # or None}
+        self.last_saved = {}
+        # Names of track_data partitions which exist.
+        self.partitions = set()
+        # Written buckets of downsampled tracks in track_data_lod.
+        self.pyramid = DownsamplingPyramid()
+        # State of pyramid with buckets written in current transaction.
+        self._lod_state = None
+        # Snapshots of TrackState.
+        self.snapshots = SnapshotStore(pool,
+            SnapshotSerializer(TRACK_SNAPSHOT_VERSION))
 
     @defer.inlineCallbacks
     def get_by_id(self, id):
-        data = yield self.pool.runQuery(pe.select('track'), (str(id),))
+        data = yield self.pool.runQuery(SELECT_TRACK, (str(id),))
         if not data:
             raise NoAggregate("%s %s" % ('Track', id))
         track_id, _id = data[0]
         tid = track.TrackID.fromstring(track_id)
-        event_list = yield pe.event_store().load_events(tid)
-        result = track.Track(tid, event_list)
+        state, event_list, applied = yield self.snapshots.load_with_events(
+            tid, pe.event_store())
+        if state is None:
+            result = track.Track(tid, event_list)
+        else:
+            result = track.Track(tid, [])
+            result._state = state
+            for ev in event_list:
+                state.mutate(ev)
         result._id = long(_id)
+        yield self.snapshots.save_after(tid, event_list,
+            lambda: result._state, applied)
         defer.returnValue(result)
 
     def save(self, obj):
 
         def handle_Failure(failure):
             log.err(failure)
+            # Partitions and buckets written in failed transaction are
+            # rolled back.
+            self.partitions.clear()
+            self._lod_state = None
             return obj.reset()
 
         d = defer.succeed(1)
@@ -116,32 +383,198 @@ class TrackRepository(object):
             d.addCallback(lambda _: self.pool.runInteraction(self._save_new,
                 obj))
         else:
-            d.addCallback(lambda _: self.pool.runWithConnection(self._update,
+            d.addCallback(lambda _: self.pool.runInteraction(self._update,
                 obj))
             d.addCallback(self._update_times)
         d.addCallback(self._save_snapshots)
-        d.addCallback(lambda obj: obj.reset())
+        d.addCallback(lambda obj: self._lod_committed() or obj.reset())
         d.addErrback(handle_Failure)
         return d
 
+    def save_many(self, objs):
+        '''
+        Save tracks processed in one tick. Events, points and snapshots of
+        all tracks are written in one transaction with one statement per
+        table. If it fails tracks are written one by one, so a bad track
+        doesn't hold back others. Tracks which weren't saved keep their
+        points and events for the next tick.
+        @param objs: tracks
+        @type objs: C{list} of L{gorynych.processor.domain.track.Track}
+        @return: Deferred which fires with saved tracks.
+        '''
+        backup = self._backup(objs)
+        d = self.pool.runInteraction(self._save_many, objs)
+        d.addErrback(self._save_failed, backup)
+        d.addCallback(self._saved)
+        return d
+
+    def _save_failed(self, failure, backup):
+        log.err(failure, "Tracks weren't saved")
+        self._restore(backup)
+        return []
+
+    def _saved(self, objs):
+        self._lod_committed()
+        for obj in objs:
+            obj.reset()
+        return objs
+
+    def _lod_committed(self):
+        if self._lod_state is not None:
+            self.pyramid.commit(self._lod_state)
+            self._lod_state = None
+
+    def _backup(self, objs):
+        '''
+        Remember what writing of tracks changes in repository and tracks, to
+        restore it if transaction is rolled back.
+        '''
+        return (dict(self.last_saved), set(self.partitions), self._lod_state,
+            [(obj, obj._id) for obj in objs])
+
+    def _restore(self, backup):
+        last_saved, partitions, self._lod_state, ids = backup
+        self.last_saved, self.partitions = last_saved, partitions
+        for obj, _id in ids:
+            obj._id = _id
+
+    def _save_many(self, cur, objs):
+        cur.execute("SAVEPOINT tracks")
+        backup = self._backup(objs)
+        try:
+            self._write_tracks(cur, objs)
+            return objs
+        except Exception as e:
+            log.msg("Tracks weren't saved at once, saving them one by one: "
+                "%r" % e)
+            cur.execute("ROLLBACK TO SAVEPOINT tracks")
+            self._restore(backup)
+        saved = []
+        for obj in objs:
+            cur.execute("SAVEPOINT track")
+            backup = self._backup([obj])
+            try:
+                self._write_tracks(cur, [obj])
+                saved.append(obj)
+            except Exception as e:
+                log.err("Track %s wasn't saved: %r" % (obj.id, e))
+                cur.execute("ROLLBACK TO SAVEPOINT track")
+                self._restore(backup)
+            cur.execute("RELEASE SAVEPOINT track")
+        return saved
+
+    def _write_tracks(self, cur, objs):
+        changes = [ev for obj in objs for ev in obj.changes]
+        if changes:
+            pe.event_store().persist_in_transaction(cur, changes)
+        points, snapshots = [], []
+        for obj in objs:
+            if not obj._id:
+                cur.execute(NEW_TRACK, (obj._state.start_time,
+                    obj._state.end_time, obj.type.type, str(obj.id)))
+                obj._id = cur.fetchone()[0]
+                self.last_saved[obj._id] = None
+                log.msg("New track inserted %s and its id %s" % (obj.id,
+                    obj._id))
+            else:
+                for item in obj.changes:
+                    if item.name == 'TrackStarted':
+                        cur.execute(UPDATE_START_TIME,
+                            (obj._state.start_time, obj._id))
+                    if item.name == 'TrackEnded':
+                        cur.execute(UPDATE_END_TIME,
+                            (obj._state.end_time, obj._id))
+            if len(obj.points) > 0:
+                obj.points['id'] = obj._id
+                points.append(obj.points)
+            snaps = get_states_from_events(obj)
+            for snap in snaps:
+                snapshots.append((obj._id, snap, json.dumps(list(snaps[snap]))))
+        if points:
+            self._write_points(cur, np.concatenate(points))
+        if snapshots:
+            copy_snapshots(cur, snapshots)
+
     def _save_new(self, cur, obj):
         cur.execute(NEW_TRACK, (obj._state.start_time, obj._state.end_time,
         obj.type.type, str(obj.id)))
         dbid = cur.fetchone()[0]
+        self.last_saved[dbid] = None
         log.msg("New track inserted %s and its id %s" % (obj.id, dbid))
 
         if len(obj.points) > 0:
             points = obj.points
             points['id'] = np.ones(len(points)) * dbid
-            data = np_as_text(points)
             try:
-                cur.copy_expert("COPY track_data FROM STDIN ", data)
+                self._write_points(cur, points)
             except Exception as e:
                 log.err("Exception occured on inserting points: %r" % e)
+                self.partitions.clear()
                 obj.buffer = np.empty(0, dtype=track.DTYPE)
         obj._id = dbid
         return obj
 
+    def _write_points(self, cur, points):
+        '''
+        Write points of tracks. Points which are newer then last saved
+        point of their track can't be in track_data and are copied there,
+        so usually this is one round-trip. Older points (late or replayed)
+        are inserted with anti-join against track_data. Newest points of
+        tracks are kept in track_last_state, buckets of tracks which are
+        closed by points or got late points are downsampled from
+        track_data into track_data_lod, pyramid takes them when transaction
+        is committed, and time
+        intervals of points are announced on POINTS_CHANNEL with groups of
+        their tracks when transaction commits.
+        @param cur: cursor in transaction.
+        @param points: points with track database ids, timestamps are
+        unique for every track.
+        @type points: C{np.ndarray}
+        '''
+        first = int(points['timestamp'].min())
+        create_partitions(cur, first, int(points['timestamp'].max()),
+            self.partitions)
+        ids = np.unique(points['id'])
+        unknown = [int(i) for i in ids if int(i) not in self.last_saved]
+        if unknown:
+            # Only points newer then the first point of batch matter.
+            cur.execute(SELECT_LAST_TIMESTAMPS, (unknown, first))
+            self.last_saved.update(dict.fromkeys(unknown, first - 1))
+            self.last_saved.update(cur.fetchall())
+        restored = [int(i) for i in ids if int(i) not in
+            (self._lod_state or self.pyramid.state)[0]]
+        opened = {}
+        if restored:
+            cur.execute(SELECT_LOD_OPENED, (first - LOD_LOOKBACK,
+                list(self.pyramid.levels), restored, first - LOD_LOOKBACK))
+            opened = dict(((level, _id), start)
+                for level, _id, start in cur.fetchall())
+        last = np.array([self.last_saved[int(i)] for i in ids], dtype=float)
+        last[np.isnan(last)] = -np.inf
+        idxs = np.searchsorted(ids, points['id'])
+        fresh = points['timestamp'] > last[idxs]
+        if fresh.all():
+            copy_points(cur, points, self.copy_format)
+        else:
+            if fresh.any():
+                copy_points(cur, points[fresh], self.copy_format)
+            insert_missing_points(cur, points[~fresh])
+        last_state = last_points(points)
+        query = UPSERT_LAST_POINTS
+        params = [last_state[name].tolist()
+            for name in last_state.dtype.names]
+        ranges, lod_state = self.pyramid.add(points, opened,
+            self._lod_state)
+        if ranges[0]:
+            query += DELETE_LOD_POINTS + INSERT_LOD_POINTS
+            params.extend(ranges + ranges)
+        cur.execute(query + NOTIFY_POINTS,
+            params + list(notify_intervals(points)))
+        self._lod_state = lod_state
+        np.maximum.at(last, idxs, points['timestamp'])
+        for i, ts in zip(ids, last):
+            self.last_saved[int(i)] = int(ts)
+
     @defer.inlineCallbacks
     def _save_snapshots(self, obj):
         '''
@@ -152,17 +585,27 @@ class TrackRepository(object):
         @rtype: L{gorynych.processor.domain.track.Track}
         '''
         snaps = get_states_from_events(obj)
+        saved = []
         for snap in snaps:
             try:
                 yield self.pool.runOperation(INSERT_SNAPSHOT,
                             (snap, obj._id, json.dumps(list(snaps[snap]))))
+                saved.append(snap)
             except Exception as e:
                 log.err("Error while inserting snapshot %s:%s for track %s: "
                         "%r" %
                         (snap, snaps[snap], obj._id, e))
+        if saved:
+            try:
+                yield self.pool.runOperation(UPSERT_LAST_SNAPSHOTS,
+                    ([obj._id] * len(saved), saved,
+                        [json.dumps(list(snaps[snap])) for snap in saved]))
+            except Exception as e:
+                log.err("Error while updating last snapshots for track %s: "
+                        "%r" % (obj._id, e))
         defer.returnValue(obj)
 
-    def _update(self, con, obj):
+    def _update(self, cur, obj):
         if len(obj.points) == 0:
             return obj
         tdiff = int(time.time()) - obj.points[0]['timestamp']
@@ -170,33 +613,15 @@ class TrackRepository(object):
         log.msg("First points for track %s was %s second ago." % (obj._id,
             tdiff))
 
-        def try_insert_points(points):
-            data = np_as_text(points)
-            cur = con._connection.cursor()
-            cur.copy_expert("COPY track_data FROM STDIN ", data)
-
         points = obj.points
         points['id'] = np.ones(len(points)) * obj._id
-
-        while True:
-            try:
-                try_insert_points(points)
-                break
-            except Exception as e:
-                if e.pgcode == '23505':
-                    dup_tc = re.findall(self.duplicate_key_ts, e.message)
-                    if not dup_tc:
-                        break
-                    dup_tc = int(dup_tc[0])
-                    idx = np.where(points['timestamp'] != dup_tc)
-                    points = points[idx]
-                    if len(points) == 0:
-                        break
-                    con._connection.rollback()
-                else:
-                    log.err("Error occured while COPY data on update for track %s: "
-                            "%r" % (obj._id, e))
-                    obj.buffer = np.empty(0, dtype=track.DTYPE)
+        try:
+            self._write_points(cur, points)
+        except Exception as e:
+            log.err("Error occured while COPY data on update for track %s: "
+                    "%r" % (obj._id, e))
+            self.partitions.clear()
+            obj.buffer = np.empty(0, dtype=track.DTYPE)
         return obj
 
     def _update_times(self, obj):
@@ -0,0 +1,64 @@
+import calendar
+import os
+import shutil
+import tempfile
+
+import mock
+from twisted.trial import unittest
+
+from gorynych.processor.infrastructure import partitions
+
+
+def utc(*args):
+    return calendar.timegm(args + (0, 0, 0))
+
+
+class TestPartitions(unittest.TestCase):
+    def test_month_range(self):
+        self.assertEqual(partitions.month_range(utc(2013, 7, 19)),
+            (utc(2013, 7, 1), utc(2013, 8, 1)))
+        self.assertEqual(partitions.month_range(utc(2013, 12, 31) + 86399),
+            (utc(2013, 12, 1), utc(2014, 1, 1)))
+        self.assertEqual(partitions.month_range(utc(2014, 1, 1)),
+            (utc(2014, 1, 1), utc(2014, 2, 1)))
+
+    def test_partitions(self):
+        self.assertEqual(partitions.partitions(utc(2013, 12, 5),
+            utc(2014, 1, 1)), [
+            ('track_data_201312', utc(2013, 12, 1), utc(2014, 1, 1)),
+            ('track_data_201401', utc(2014, 1, 1), utc(2014, 2, 1))])
+        self.assertEqual(len(partitions.partitions(utc(2013, 7, 1),
+            utc(2013, 7, 31))), 1)
+
+    def test_create_partitions(self):
+        cur = mock.Mock()
+        existing = set(['track_data_201312'])
+        partitions.create_partitions(cur, utc(2013, 12, 5), utc(2014, 1, 2),
+            existing)
+        self.assertEqual(cur.execute.call_count, 1)
+        self.assertIn('track_data_201401 PARTITION OF track_data',
+            cur.execute.call_args[0][0])
+        self.assertIn('FROM (%d) TO (%d)' % (utc(2014, 1, 1),
+            utc(2014, 2, 1)), cur.execute.call_args[0][0])
+        self.assertEqual(existing, set(['track_data_201312',
+            'track_data_201401']))
+        partitions.create_partitions(cur, utc(2014, 1, 5), utc(2014, 1, 6),
+            existing)
+        self.assertEqual(cur.execute.call_count, 1)
+
+    def test_archive(self):
+        cur = mock.Mock()
+        cur.fetchall.return_value = [('track_data_201302',),
+            ('track_data_201301',), ('track_data_other',)]
+        connection = mock.Mock()
+        connection.cursor.return_value = cur
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        result = partitions.archive(connection, utc(2013, 2, 1), directory)
+        self.assertEqual(result, ['track_data_201301'])
+        queries = [c[0][0] for c in cur.execute.call_args_list]
+        self.assertEqual(queries[1:], [
+            'ALTER TABLE track_data DETACH PARTITION track_data_201301',
+            'DROP TABLE track_data_201301'])
+        self.assertTrue(os.path.exists(os.path.join(directory,
+            'track_data_201301.copy.gz')))
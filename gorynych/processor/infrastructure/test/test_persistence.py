@@ -1,5 +1,6 @@
 import time
 
+import mock
 from twisted.internet import defer
 from twisted.trial import unittest
 import numpy as np
@@ -131,6 +132,211 @@ class TrackRepositoryTestCase(MockeryTestCase):
         self._compare_points(retrieved_data, self.data)
 
 
+    @defer.inlineCallbacks
+    def test_save_many(self):
+        old, new = self._sample(), self._sample()
+        old.points = self._get_points(self.data[:1])
+        yield self.repo.save(old)
+        old.points = self._get_points(self.data)
+        new.points = self._get_points(self.data)
+        t = int(time.time())
+        new.apply(events.TrackStarted(new.id, None, 'track', t))
+
+        result = yield self.repo.save_many([old, new])
+        self.assertListEqual(result, [old, new])
+        self.assertIsNotNone(new._id)
+        for trck in [old, new]:
+            retrieved_data = yield POOL.runQuery(DATA_QUERY, (str(trck.id),))
+            self._compare_points(retrieved_data, self.data)
+            self.assertEqual(len(trck.points), 0)
+        snaps = yield POOL.runQuery(
+            "SELECT timestamp, snapshot FROM track_snapshot WHERE id=%s",
+            (new._id,))
+        self.assertListEqual(snaps, [(t, '["started"]')])
+
+    @defer.inlineCallbacks
+    def test_replayed_points(self):
+        trck = self._sample()
+        late = dict(self.data[0], timestamp=self.data[0]['timestamp'] + 10)
+        expected = [self.data[0], late, self.data[1]]
+        trck.points = self._get_points(self.data[:1])
+        yield self.repo.save(trck)
+        trck.points = self._get_points(self.data)
+        yield self.repo.save(trck)
+        # Replays after restart of repository and with late point.
+        for i in range(2):
+            self.repo.last_saved.clear()
+            trck.points = self._get_points(expected)
+            yield self.repo.save_many([trck])
+            trck.points = self._get_points(self.data)
+            yield self.repo.save(trck)
+        retrieved_data = yield POOL.runQuery(DATA_QUERY, (str(trck.id),))
+        self._compare_points(sorted(retrieved_data, key=lambda r: r[1]),
+            expected)
+
+    @defer.inlineCallbacks
+    def test_last_state(self):
+        trck = self._sample()
+        trck.points = self._get_points(self.data)
+        t = self.data[0]['timestamp']
+        trck.apply(events.TrackStarted(trck.id, None, 'track', t))
+        yield self.repo.save_many([trck])
+        # Late point and more snapshots.
+        trck.points = self._get_points([dict(self.data[0], timestamp=t + 1)])
+        for i in range(1, 4):
+            trck.apply(events.TrackStarted(trck.id, None, 'track', t + i))
+        yield self.repo.save_many([trck])
+        state = yield POOL.runQuery("SELECT timestamp, lat, snapshot_times, "
+            "snapshots FROM track_last_state WHERE id=%s", (trck._id,))
+        self.assertEqual(state, [(self.data[1]['timestamp'],
+            self.data[1]['lat'], [t + 1, t + 2, t + 3], ['["started"]'] * 3)])
+
+    @defer.inlineCallbacks
+    def test_last_state_same_timestamp(self):
+        trck = self._sample()
+        trck.points = self._get_points(self.data)
+        t = self.data[0]['timestamp']
+        trck.apply(events.TrackStarted(trck.id, None, 'track', t))
+        yield self.repo.save_many([trck])
+        # Another snapshot with timestamp of saved one.
+        trck.points = self._get_points([dict(self.data[0], timestamp=t + 1)])
+        trck.apply(events.TrackLanded(trck.id, 100, 'track', t))
+        trck.apply(events.TrackStarted(trck.id, None, 'track', t + 1))
+        yield self.repo.save_many([trck])
+        snaps = yield POOL.runQuery("SELECT timestamp, snapshot FROM "
+            "track_snapshot WHERE id=%s ORDER BY timestamp", (trck._id,))
+        state = yield POOL.runQuery("SELECT snapshot_times, snapshots FROM "
+            "track_last_state WHERE id=%s", (trck._id,))
+        self.assertIn(t, [row[0] for row in snaps])
+        self.assertEqual(state, [([row[0] for row in snaps],
+            [row[1] for row in snaps])])
+
+    @defer.inlineCallbacks
+    def test_downsampled_points(self):
+        trck = self._sample()
+        t = self.data[0]['timestamp'] // 300 * 300
+        trck.points = self._get_points([dict(self.data[0], timestamp=t + i,
+            alt=100 + i % 7) for i in range(25)])
+        yield self.repo.save_many([trck])
+        rows = yield POOL.runQuery("SELECT level, timestamp, alt FROM "
+            "track_data_lod WHERE id=%s ORDER BY level, timestamp",
+            (trck._id,))
+        self.assertEqual(rows, [(10, t, 100), (10, t + 6, 106),
+            (10, t + 13, 106), (10, t + 14, 100)])
+
+
+class FakePool(object):
+    def __init__(self):
+        self.cursor = mock.Mock()
+
+    def runInteraction(self, interaction, *args):
+        return defer.maybeDeferred(interaction, self.cursor, *args)
+
+
+class TestSaveMany(unittest.TestCase):
+    def setUp(self):
+        self.repo = persistence.TrackRepository(FakePool())
+        self.pe = mock.patch(
+            'gorynych.processor.infrastructure.persistence.pe').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _track(self):
+        t = track.Track(track.TrackID(), [])
+        t.points = np.ones(3, dtype=track.DTYPE)
+        t.changes = [events.TrackStarted(t.id, None, 'track', 1)]
+        return t
+
+    @defer.inlineCallbacks
+    def test_bad_track_is_isolated(self):
+        good, bad = self._track(), self._track()
+
+        def write_tracks(cur, objs):
+            for obj in objs:
+                obj._id = 1
+            self.repo.last_saved[1] = 5
+            if bad in objs:
+                raise ValueError("bad row")
+        self.repo._write_tracks = write_tracks
+
+        saved = yield self.repo.save_many([good, bad])
+        self.assertListEqual(saved, [good])
+        self.assertEqual((len(good.points), len(good.changes)), (0, 0))
+        self.assertEqual((len(bad.points), len(bad.changes)), (3, 1))
+        self.assertIsNone(bad._id)
+        queries = [c[0][0] for c in self.repo.pool.cursor.execute.call_args_list]
+        self.assertListEqual(queries, ["SAVEPOINT tracks",
+            "ROLLBACK TO SAVEPOINT tracks",
+            "SAVEPOINT track", "RELEASE SAVEPOINT track",
+            "SAVEPOINT track", "ROLLBACK TO SAVEPOINT track",
+            "RELEASE SAVEPOINT track"])
+
+    @defer.inlineCallbacks
+    def test_failed_transaction(self):
+        trck = self._track()
+        self.repo.pool.cursor.execute.side_effect = ValueError("no db")
+        saved = yield self.repo.save_many([trck])
+        self.assertListEqual(saved, [])
+        self.assertEqual((len(trck.points), len(trck.changes)), (3, 1))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+class TestDownsampledBuckets(unittest.TestCase):
+    def setUp(self):
+        self.repo = persistence.TrackRepository(FakePool())
+        self.repo.partitions.update(['track_data_%s' % month
+            for month in ('197001', '201307')])
+        self.cur = self.repo.pool.cursor
+        self.cur.fetchall.return_value = []
+
+    def points(self, times):
+        points = np.ones(len(times), dtype=track.DTYPE)
+        points['timestamp'] = times
+        return points
+
+    def test_committed_after_save(self):
+        self.repo._write_points(self.cur, self.points(range(0, 25)))
+        query, params = self.cur.execute.call_args[0]
+        self.assertIn(persistence.INSERT_LOD_POINTS, query)
+        self.assertEqual(params[8:16], [[10], [1], [0], [20]] * 2)
+        self.assertEqual(len(self.repo.pyramid), 0)
+        self.repo._saved([])
+        self.assertIn(1, self.repo.pyramid)
+        self.assertIsNone(self.repo._lod_state)
+
+    def test_failed_write(self):
+        self.cur.execute.side_effect = [None, None, ValueError("no db")]
+        self.assertRaises(ValueError, self.repo._write_points, self.cur,
+            self.points(range(0, 25)))
+        self.assertIsNone(self.repo._lod_state)
+
+    def test_restored_buckets(self):
+        self.repo.last_saved[1] = 100
+        self.cur.fetchall.return_value = [(10, 1, 90), (60, 1, 60),
+            (300, 1, 0)]
+        self.repo._write_points(self.cur, self.points([125]))
+        self.assertEqual(self.cur.execute.call_args_list[0][0],
+            (persistence.SELECT_LOD_OPENED, (125 - persistence.LOD_LOOKBACK,
+                [10, 60, 300], [1], 125 - persistence.LOD_LOOKBACK)))
+        params = self.cur.execute.call_args[0][1]
+        self.assertEqual(params[8:12], [[10, 60], [1, 1], [90, 60],
+            [120, 120]])
+
+
+class TestNotifyIntervals(unittest.TestCase):
+    def test_late_points_split(self):
+        points = np.ones(6, dtype=track.DTYPE)
+        points['id'] = [1, 1, 2, 2, 1, 3]
+        points['timestamp'] = [1000, 1001, 1000, 1002, 100, 100]
+        self.assertEqual(persistence.notify_intervals(points),
+            ([100, 100, 1000, 1000], [100, 100, 1002, 1002], [1, 3, 1, 2]))
+
+    def test_long_interval_split(self):
+        points = np.ones(131, dtype=track.DTYPE)
+        points['timestamp'] = range(0, 1310, 10)
+        self.assertEqual(persistence.notify_intervals(points),
+            ([0, 600, 1200], [590, 1190, 1300], [1, 1, 1]))
+
+
 class TestGetStatesFromEvents(unittest.TestCase):
     def setUp(self):
         self.track = track.Track(track.TrackID(), [])
@@ -1,15 +1,54 @@
-from gorynych.info.restui.base_resource import APIResource
+from twisted.web import server
+
+from gorynych.info.restui.base_resource import APIResource, json_renderer
+from gorynych.processor.services.visualization import BINARY_CONTENT_TYPE
 
 
 # TODO: do this without subclassing APIResource?
 class TracksResource(APIResource):
     '''
     /group/{id}/tracks
-    Return track data and state.
+    Return track data and state. Binary timeline is returned instead of
+    json for format=binary parameter or binary timeline in Accept header.
     '''
     service_command = dict(GET='get_track_data')
+    renderers = {'application/json': json_renderer,
+        BINARY_CONTENT_TYPE: lambda data, template_name=None: data}
     isLeaf = True
 
+    def parameters_from_request(self, req):
+        params = APIResource.parameters_from_request(self, req)
+        accept = req.getHeader('accept') or ''
+        if BINARY_CONTENT_TYPE in accept:
+            params['format'] = 'binary'
+        if params.get('format') == 'binary':
+            req.setHeader('Content-Type', BINARY_CONTENT_TYPE)
+        return params
+
     def read_GET(self, trs, params=None):
         if trs:
             return trs
+
+
+class TracksStreamResource(APIResource):
+    '''
+    /stream/{id}
+    Stream new track data and state of tracks group as server-sent events.
+    '''
+    isLeaf = True
+
+    def render_GET(self, request):
+        try:
+            group_id = self.parameters_from_request(request)['stream']
+        except Exception as error:
+            self._handle_error(request, 400, "Bad input parameters or URI",
+                repr(error))
+            return server.NOT_DONE_YET
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        # Send headers to client.
+        request.write(':\n\n')
+        self.service.subscribe(group_id, request)
+        request.notifyFinish().addBoth(
+            lambda _: self.service.unsubscribe(group_id, request))
+        return server.NOT_DONE_YET
@@ -135,7 +135,7 @@ class TestProcessorService(unittest.TestCase):
 
         ev1 = events.ParagliderFoundInArchive(rid, payload=i0)
         ev2 = events.TrackArchiveUnpacked(rid, payload=[[i0], i1, i2])
-        expected = [mock.call(ev1), mock.call(ev2)]
+        expected = [mock.call([ev1, ev2])]
         self.assertListEqual(es.persist.mock_calls, expected)
 
 
@@ -1,5 +1,13 @@
+import mock
+import simplejson as json
+from twisted.internet import defer
 from twisted.trial import unittest
-from gorynych.processor.services.visualization import parse_result
+from gorynych.processor.services.visualization import parse_result, \
+    BucketCache, TrackVisualizationService, SELECT_DATA_SNAPSHOTS, \
+    SELECT_POINTS, GET_LAST_STATES, GET_HEADERS_DATA, GET_HEADERS_SNAPSHOTS, \
+    encode_timeline, decode_timeline, SELECT_LOD_POINTS, lod_level, \
+    align_snapshots
+from gorynych.processor.services import visualization
 
 
 class TestTrackData(unittest.TestCase):
@@ -9,3 +17,402 @@ class TestTrackData(unittest.TestCase):
         result = parse_result(raw_data)
         self.assertEquals(
             result, {'crds': [45.385, 23.4318, 1744], 'spds': [6.2, -1.67], 'dist': 4157})
+
+
+class FakePool(object):
+    '''
+    Pool which answers data queries from rows in memory.
+    '''
+    def __init__(self, points, snaps, lod=()):
+        self.rows = {SELECT_POINTS: points, SELECT_DATA_SNAPSHOTS: snaps,
+            SELECT_LOD_POINTS: lod}
+        self.queries = []
+
+    def runQuery(self, query, args):
+        if query == SELECT_LOD_POINTS:
+            group_id, level, from_time, to_time = args
+        else:
+            group_id, from_time, to_time = args
+        self.queries.append((from_time, to_time))
+        ts = 0 if query == SELECT_DATA_SNAPSHOTS else 1
+        return defer.succeed([row for row in self.rows[query]
+            if from_time <= row[ts] <= to_time])
+
+
+class TestBucketCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = BucketCache(bucket=60)
+        self.assertEqual(cache.start(119), 60)
+        self.assertIsNone(cache.get('g', 60))
+        cache.put('g', 60, [(61, 'a')], [])
+        self.assertEqual(cache.get('g', 60), ([(61, 'a')], []))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        cache = BucketCache(bucket=60)
+        cache.put('g', 0, [(1, 'a' * 100)], [])
+        cache.max_size = cache.size * 2
+        cache.put('g', 60, [(61, 'b' * 100)], [])
+        cache.get('g', 0)
+        cache.put('g', 120, [(121, 'c' * 100)], [])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('g', 60))
+        self.assertIsNotNone(cache.get('g', 0))
+        self.assertLessEqual(cache.size, cache.max_size)
+
+    def test_invalidate(self):
+        cache = BucketCache(bucket=60)
+        for group_id in ('g', 'h'):
+            for start in (0, 60, 120, 180):
+                cache.put(group_id, start, [(start + 1, 'a')], [])
+        cache.invalidate(70, 130, set(['g']))
+        self.assertEqual(len(cache), 6)
+        self.assertIsNone(cache.get('g', 60))
+        self.assertIsNone(cache.get('g', 120))
+        self.assertIsNotNone(cache.get('h', 60))
+        cache.invalidate(0, 59)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.version, 2)
+        cache.invalidate(0, 1000)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class TestSelectGroupData(unittest.TestCase):
+    def setUp(self):
+        self.points = [('1', ts, 1., 2., 3, 4., 5., 6)
+            for ts in range(0, 1000, 7)]
+        self.snaps = [(ts, '["started"]', '1') for ts in range(0, 1000, 50)]
+        self.pool = FakePool(self.points, self.snaps)
+        self.service = TrackVisualizationService(self.pool)
+        self.service.bucket_delay = 0
+
+    @defer.inlineCallbacks
+    def test_assembled_from_buckets(self):
+        for from_time, to_time in [(30, 500), (0, 999), (95, 100), (130, 700)]:
+            points, snaps = yield self.service.select_group_data('g',
+                from_time, to_time, 1000)
+            self.assertEqual(points, [row for row in self.points
+                if from_time <= row[1] <= to_time])
+            self.assertEqual(sorted(snaps), [row for row in self.snaps
+                if from_time <= row[0] <= to_time])
+
+    @defer.inlineCallbacks
+    def test_closed_buckets_cached(self):
+        yield self.service.select_group_data('g', 0, 500, 1000)
+        self.assertEqual(self.pool.queries, [(0, 539)] * 2)
+        del self.pool.queries[:]
+        yield self.service.select_group_data('g', 100, 700, 1000)
+        self.assertEqual(self.pool.queries, [(540, 719)] * 2)
+        self.assertEqual(self.service.cache.hits, 8)
+
+    @defer.inlineCallbacks
+    def test_saved_points_invalidate_buckets(self):
+        yield self.service.select_group_data('g', 0, 500, 1000)
+        self.points.append(('2', 130, 1., 2., 3, 4., 5., 6))
+        self.points.sort(key=lambda row: (row[0], row[1]))
+        self.service.points_saved(130, 130)
+        del self.pool.queries[:]
+        points, snaps = yield self.service.select_group_data('g', 0, 500,
+            1000)
+        self.assertIn(('2', 130, 1., 2., 3, 4., 5., 6), points)
+        self.assertEqual(self.pool.queries, [(120, 179)] * 2)
+
+    @defer.inlineCallbacks
+    def test_stale_selection_not_cached(self):
+        d = defer.Deferred()
+        run_query = self.pool.runQuery
+        self.pool.runQuery = lambda *args: d.addCallback(
+            lambda _: run_query(*args))
+        result = self.service.select_group_data('g', 0, 100, 1000)
+        self.pool.runQuery = run_query
+        self.service.cache.invalidate(0, 100)
+        d.callback(None)
+        yield result
+        self.assertEqual(len(self.service.cache), 0)
+
+    @defer.inlineCallbacks
+    def test_live_bucket_not_cached(self):
+        for i in range(2):
+            points, snaps = yield self.service.select_group_data('g', 850,
+                999, 990)
+        self.assertEqual(points, [row for row in self.points
+            if 850 <= row[1] <= 999])
+        # Bucket 900-959 is closed at 990, 960-1019 is live.
+        self.assertEqual(self.pool.queries, [(840, 959)] * 2 +
+            [(960, 999)] * 4)
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.events = []
+
+    def write(self, data):
+        self.events.append(data)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        points = [('1', ts, 1., 2., 3, 4., 5., 6)
+            for ts in range(0, 100, 10)]
+        self.pool = FakePool(points, [(10, '["started"]', '1')])
+        self.service = TrackVisualizationService(self.pool)
+        self.subscribers = [Subscriber() for i in range(3)]
+        for subscriber in self.subscribers:
+            self.service.subscribe('g', subscriber)
+
+    def test_fan_out(self):
+        self.service.points_saved(5, 25)
+        self.assertEqual(len(self.pool.queries), 2)
+        for subscriber in self.subscribers:
+            self.assertEqual(len(subscriber.events), 1)
+            self.assertIs(subscriber.events[0], self.subscribers[0].events[0])
+        event = self.subscribers[0].events[0]
+        self.assertTrue(event.startswith('data: ') and event.endswith('\n\n'))
+        timeline = json.loads(event[6:])['timeline']
+        self.assertEqual(sorted(timeline.keys()), ['10', '20'])
+        self.assertEqual(timeline['10']['1']['state'], 'started')
+
+    def test_unsubscribe(self):
+        self.service.unsubscribe('g', self.subscribers[0])
+        self.service.points_saved(5, 25)
+        self.assertEqual(len(self.subscribers[0].events), 0)
+        self.assertEqual(len(self.subscribers[1].events), 1)
+        for subscriber in self.subscribers[1:]:
+            self.service.unsubscribe('g', subscriber)
+        self.service.points_saved(5, 25)
+        self.assertEqual(len(self.pool.queries), 2)
+
+    def test_intervals_joined_while_sending(self):
+        d = defer.Deferred()
+        run_query = self.pool.runQuery
+        self.pool.runQuery = lambda *args: d.addCallback(
+            lambda _: run_query(*args))
+        self.service.points_saved(5, 15)
+        self.service.points_saved(30, 35)
+        self.service.points_saved(20, 25)
+        self.pool.runQuery = run_query
+        d.callback(None)
+        self.assertEqual(self.pool.queries, [(5, 15)] * 2 + [(20, 35)] * 2)
+        self.assertEqual(len(self.subscribers[0].events), 2)
+
+    def test_notify(self):
+        notify = type('Notify', (object,), dict(payload='5,25'))
+        self.service._on_notify(notify)
+        self.assertEqual(self.pool.queries, [(5, 25)] * 2)
+
+    def test_notify_groups(self):
+        self.service.cache.put('g', 0, [], [])
+        self.service.cache.put('h', 0, [], [])
+        notify = type('Notify', (object,), dict(payload='5,25,h,i'))
+        self.service._on_notify(notify)
+        self.assertEqual(self.pool.queries, [])
+        self.assertEqual(len(self.service.cache), 1)
+        notify.payload = '5,25,g,h'
+        self.service._on_notify(notify)
+        self.assertEqual(self.pool.queries, [(5, 25)] * 2)
+        self.assertEqual(len(self.service.cache), 0)
+
+    @mock.patch.object(visualization.time, 'time')
+    def test_listener_reconnected(self, now):
+        self.service.listener = mock.Mock()
+        self.service.listener.runOperation.return_value = defer.succeed(None)
+        self.service.bucket_delay = 20
+        now.return_value = 50
+        self.service._on_notify(type('Notify', (object,),
+            dict(payload='5,25,h')))
+        self.service.cache.put('g', 0, [], [])
+        self.service.cache.put('h', 3600, [], [])
+        # Listener is dropped and reconnected, points saved meanwhile
+        # weren't announced.
+        now.return_value = 95
+        self.service._reconnected()
+        self.service.listener.runOperation.assert_called_once_with(
+            'LISTEN %s' % visualization.POINTS_CHANNEL)
+        self.assertEqual((len(self.service.cache), self.service.cache.size),
+            (0, 0))
+        self.assertEqual(self.pool.queries, [(30, 95)] * 2)
+        self.assertEqual(len(self.subscribers[0].events), 1)
+        self.assertEqual(self.service._heard_at, 95)
+
+    def test_long_interval_split(self):
+        self.service.max_interval = 40
+        self.service.points_saved(5, 95)
+        self.assertEqual(self.pool.queries,
+            [(5, 44)] * 2 + [(45, 84)] * 2 + [(85, 95)] * 2)
+        self.assertEqual(len(self.subscribers[0].events), 3)
+
+
+class TestBinaryTimeline(unittest.TestCase):
+    points = [('1', 100, 45.385001, 23.4318, 1744, -1.67, 6.2, 4157),
+        ('1', 101, 45.385002, 23.4319, 1745, -1.6, 6.25, 4158),
+        ('1', 100000, 45.4, 23.5, 1800, 0.5, float('nan'), 5000),
+        ('12', 100, -45.5, -120.123456, 10, 0, 0, 0)]
+    snaps = [(100, '["started", "in_air_true"]', '1'), (90, 'bad', '12')]
+
+    def test_round_trip(self):
+        data = encode_timeline(self.points, self.snaps, {'12': {'x': 1}})
+        header, tracks = decode_timeline(data)
+        self.assertEqual(header, {'start': {'12': {'x': 1}},
+            'states': {'1': [[100, ['started', 'in_air_true']]]}})
+        self.assertEqual(sorted(tracks), ['1', '12'])
+        self.assertEqual(list(tracks['1']['timestamp']), [100, 101, 100000])
+        self.assertEqual(list(tracks['1']['alt']), [1744, 1745, 1800])
+        self.assertEqual(list(tracks['1']['gspd']), [6.2, 6.25, 0])
+        self.assertEqual(list(tracks['12']['lon']), [-120.123456])
+        for row in self.points:
+            point = tracks[row[0]][tracks[row[0]]['timestamp'] == row[1]][0]
+            self.assertAlmostEqual(point['lat'], row[2], 6)
+            self.assertAlmostEqual(point['vspd'], row[5], 2)
+            self.assertEqual(point['dist'], row[7])
+
+    def test_compact(self):
+        points = [('1', 1000 + i, 45., 23., 1000, 1., 1., i)
+            for i in range(1000)]
+        data = encode_timeline(points, [])
+        # timestamp delta, lat, lon, alt, vspd, gspd, dist
+        self.assertLess(len(data), 1000 * (2 + 4 + 4 + 2 + 2 + 2 + 4) + 100)
+
+    def test_empty(self):
+        header, tracks = decode_timeline(encode_timeline([], []))
+        self.assertEqual(header, {'start': None, 'states': {}})
+        self.assertEqual(tracks, {})
+
+    def test_bad_format(self):
+        self.assertRaises(ValueError, decode_timeline, 'JSN\x01\x00\x00\x00\x00')
+
+    @defer.inlineCallbacks
+    def test_get_track_data(self):
+        pool = FakePool(self.points, self.snaps)
+        service = TrackVisualizationService(pool)
+        data = yield service.get_track_data(dict(group_id='g',
+            from_time=100, to_time=101, format='binary'))
+        header, tracks = decode_timeline(data)
+        self.assertEqual(len(tracks['1']), 2)
+        self.assertEqual(len(tracks['12']), 1)
+
+    def test_unordered_points(self):
+        header, tracks = decode_timeline(encode_timeline(
+            sorted(self.points, key=lambda row: row[1]), []))
+        self.assertEqual(list(tracks['1']['timestamp']), [100, 101, 100000])
+        self.assertEqual(len(tracks['12']), 1)
+
+
+class TestPrepareResult(unittest.TestCase):
+    def test_prepare_result(self):
+        points = [('1', 100, 45.3850014, 23.4318, 1744, -1.67, 6.2, 4157),
+            ('2', 100, 45.1, 23.1, 10, float('nan'), float('inf'), 1),
+            ('1', 101, 45.4, 23.5, 1745, -1.6, 6.25, 4158)]
+        snaps = [(100, '["started", "in_air_false"]', '1'),
+            (101, 'bad', '1')]
+        service = TrackVisualizationService(None)
+        result = service.prepare_result(points, snaps)
+        self.assertEqual(result, {
+            100: {'1': {'crds': [45.385001, 23.4318, 1744],
+                        'spds': [6.2, -1.67], 'dist': 4157,
+                        'in_air': False, 'state': 'started'},
+                  '2': {'crds': [45.1, 23.1, 10], 'spds': [1, 0],
+                        'dist': 1}},
+            101: {'1': {'crds': [45.4, 23.5, 1745], 'spds': [6.25, -1.6],
+                        'dist': 4158}}})
+        self.assertEqual(service.prepare_result([], []), {})
+
+
+class TestStartData(unittest.TestCase):
+    states = [('1', 100, '45.1,23.1,10,1.5,2.5,7', [90, 95, 100],
+            ['["started"]', '["in_air_true"]', '["es_taken"]'], True),
+        ('2', 10, '45.2,23.2,11,1,2,3', None, None, True),
+        ('3', None, '', [50], ['["started"]'], True),
+        ('4', None, '', None, None, True)]
+
+    def setUp(self):
+        self.service = TrackVisualizationService(None)
+        self.service.track_gap = 100
+
+    def test_headers_from_states(self):
+        hdata, hsnaps = self.service.headers_from_states(self.states, 105)
+        self.assertEqual(hdata, [('1', '45.1,23.1,10,1.5,2.5,7', 100),
+            ('2', '45.2,23.2,11,1,2,3', 10)])
+        self.assertEqual(hsnaps, [('1', '["started"]', 90),
+            ('1', '["in_air_true"]', 95), ('1', '["es_taken"]', 100),
+            ('3', '["started"]', 50)])
+        hdata, hsnaps = self.service.headers_from_states(self.states, 200)
+        self.assertEqual(hdata, [('1', '45.1,23.1,10,1.5,2.5,7', 100)])
+
+    def test_newer_states(self):
+        self.assertIsNone(self.service.headers_from_states(self.states, 99))
+        self.assertIsNone(self.service.headers_from_states(
+            self.states[1:], 49))
+
+    def test_track_without_state(self):
+        self.assertIsNone(self.service.headers_from_states(self.states +
+            [('5', None, '', None, None, False)], 105))
+
+    @defer.inlineCallbacks
+    def test_select_start_data(self):
+        queries = []
+
+        def run_query(query, args):
+            queries.append(query)
+            if query == GET_LAST_STATES:
+                return defer.succeed(self.states)
+            return defer.succeed([])
+        self.service.pool = type('Pool', (object,), {})()
+        self.service.pool.runQuery = run_query
+        hdata, hsnaps = yield self.service.select_start_data('g', 105)
+        self.assertEqual(len(hdata), 2)
+        self.assertEqual(queries, [GET_LAST_STATES])
+        hdata, hsnaps = yield self.service.select_start_data('g', 50)
+        self.assertEqual((hdata, hsnaps), ([], []))
+        self.assertEqual(queries[1:], [GET_LAST_STATES, GET_HEADERS_DATA,
+            GET_HEADERS_SNAPSHOTS])
+        start = self.service.prepare_start_data(*self.service.
+            headers_from_states(self.states, 105))
+        self.assertEqual(start['1']['finish_time'], 100)
+        self.assertEqual(start['3']['state'], 'started')
+
+
+class TestLevelOfDetail(unittest.TestCase):
+    def setUp(self):
+        self.points = [('1', ts, 1., 2., ts % 13, 4., 5., 6)
+            for ts in range(0, 1000, 7)]
+        self.lod = [('1', ts, 1., 2., 3, 4., 5., 6)
+            for ts in range(0, 960, 30)]
+        self.snaps = [(10, '["started"]', '1'), (950, '["in_air_false"]', '1')]
+        self.pool = FakePool(self.points, self.snaps, self.lod)
+        self.service = TrackVisualizationService(self.pool)
+        self.service.bucket_delay = 0
+
+    def test_lod_level(self):
+        self.assertIsNone(lod_level(0, 3600))
+        self.assertIsNone(lod_level(0, 3600, '5'))
+        self.assertEqual(lod_level(0, 3600, '30'), 10)
+        self.assertEqual(lod_level(0, 3600, 1000), 300)
+        self.assertEqual(lod_level(0, 3600, points='12'), 300)
+        self.assertEqual(lod_level(0, 3600, points=100), 10)
+        self.assertIsNone(lod_level(0, 3600, points=1000))
+
+    @defer.inlineCallbacks
+    def test_select_lod_data(self):
+        points, snaps = yield self.service.select_lod_data('g', 0, 999, 60,
+            1000)
+        # Pyramid for closed buckets, downsampled track_data for live one.
+        self.assertEqual(self.pool.queries, [(0, 959), (960, 999), (0, 999)])
+        self.assertEqual([row[1] for row in points], range(0, 960, 30) +
+            [966, 987])
+        self.assertEqual(snaps, [(30, '["started"]', '1'),
+            (966, '["in_air_false"]', '1')])
+
+    @defer.inlineCallbacks
+    def test_get_track_data(self):
+        result = yield self.service.get_track_data(dict(group_id='g',
+            from_time=0, to_time=999, points='10'))
+        self.assertEqual(len(result['timeline']), 32)
+        self.assertEqual(result['timeline'][930]['1']['in_air'], False)
+
+    def test_align_snapshots(self):
+        points = [('1', 10), ('1', 20), ('2', 15)]
+        snaps = [(11, '["started"]', '1'), (12, '["in_air_true"]', '1'),
+            (30, '["finished"]', '1'), (1, '["started"]', '3')]
+        self.assertEqual(align_snapshots(points, snaps), [
+            (20, '["started", "in_air_true", "finished"]', '1')])
@@ -0,0 +1,128 @@
+import time
+
+import numpy as np
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from gorynych.common.domain import events
+from gorynych.processor.domain import track
+from gorynych.processor.domain.test.test_track import test_race
+from gorynych.processor.services.workers import TrackWorkers
+
+
+def create_track():
+    tid = track.TrackID()
+    tc = events.TrackCreated(tid,
+        dict(race_task=test_race, track_type='online'))
+    return track.Track(tid, [tc])
+
+
+def points(start, n):
+    data = []
+    for i in xrange(start, start + n):
+        data.append(dict(ts=1374227400 + i * 5, lat=42.687497 - i * 0.0005,
+            lon=24.750131 + i * 0.001, alt=1000 + i % 7, h_speed=40))
+    return data
+
+
+class HungTrack(track.Track):
+    def process_data(self):
+        time.sleep(3600)
+
+
+class TestTrackWorkers(unittest.TestCase):
+    def setUp(self):
+        self.workers = TrackWorkers(2)
+
+    def tearDown(self):
+        self.workers.stop()
+
+    @defer.inlineCallbacks
+    def test_process(self):
+        local, remote = create_track(), create_track()
+        for tick in xrange(3):
+            data = points(tick * 12, 12)
+            local.append_data(data)
+            remote.append_data(data)
+            local.process_data()
+            result = yield self.workers.process([remote])
+            self.assertListEqual(result, [remote])
+            self.assertListEqual(remote.points.tolist(), local.points.tolist())
+            self.assertListEqual([ev.name for ev in remote.changes],
+                [ev.name for ev in local.changes])
+            self.assertEqual(len(remote.buffer), 0)
+            self.assertListEqual(remote._state.points_buffer.data.tolist(),
+                local._state.points_buffer.data.tolist())
+            local.reset()
+            remote.reset()
+            self.assertListEqual(remote.processed.tolist(),
+                local.processed.tolist())
+        self.assertEqual(remote._state.start_time, local._state.start_time)
+        self.assertIsNotNone(remote._state.start_time)
+
+    @defer.inlineCallbacks
+    def test_failed_track_keeps_points(self):
+        good, bad = create_track(), create_track()
+        good.append_data(points(0, 12))
+        bad.buffer = good.buffer.copy()
+        bad._state.track_type = 'unknown'
+        result = yield self.workers.process([good, bad])
+        self.assertListEqual(result, [good])
+        self.assertEqual(len(bad.buffer), 12)
+
+    def test_points_appended_while_processing(self):
+        trck = create_track()
+        trck.append_data(points(0, 12))
+        jobs, shipped = self.workers._jobs([trck])
+        self.assertEqual(len(trck.buffer), 0)
+        trck.append_data(points(12, 3))
+        results = []
+        for shard in jobs:
+            self.workers.connections[shard].send(jobs[shard])
+            results.append((shard,
+                (True, self.workers.connections[shard].recv())))
+        self.assertListEqual(self.workers._apply(results, [trck], shipped),
+            [trck])
+        self.assertEqual(len(trck.buffer), 3)
+        self.assertTrue(len(trck.points) > 0)
+
+    @defer.inlineCallbacks
+    def test_dead_worker_is_restarted(self):
+        trck = create_track()
+        trck.append_data(points(0, 12))
+        shard = self.workers.shard(trck.id)
+        dead = self.workers.processes[shard]
+        dead.terminate()
+        dead.join()
+        result = yield self.workers.process([trck])
+        self.assertListEqual(result, [])
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(len(trck.buffer), 12)
+        self.assertIsNot(self.workers.processes[shard], dead)
+        self.assertTrue(self.workers.processes[shard].is_alive())
+        result = yield self.workers.process([trck])
+        self.assertListEqual(result, [trck])
+        self.assertEqual(len(trck.buffer), 0)
+
+    @defer.inlineCallbacks
+    def test_hung_worker_is_restarted(self):
+        self.workers.timeout = 0.5
+        hung, trck = create_track(), create_track()
+        hung.__class__ = HungTrack
+        hung.append_data(points(0, 12))
+        shard = self.workers.shard(hung.id)
+        process = self.workers.processes[shard]
+        result = yield self.workers.process([hung])
+        self.assertListEqual(result, [])
+        self.assertEqual(len(self.flushLoggedErrors(defer.TimeoutError)), 1)
+        self.assertEqual(len(hung.buffer), 12)
+        self.assertFalse(process.is_alive())
+        self.assertTrue(self.workers.processes[shard].is_alive())
+        trck.append_data(points(0, 12))
+        result = yield self.workers.process([trck])
+        self.assertListEqual(result, [trck])
+
+    def test_shard(self):
+        tid = track.TrackID()
+        self.assertEqual(self.workers.shard(tid), self.workers.shard(str(tid)))
+        self.assertIn(self.workers.shard(tid), [0, 1])
@@ -3,13 +3,15 @@ from collections import defaultdict
 import time
 import cPickle
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import threads, defer, task
 
 from gorynych.common.domain import events
 from gorynych.common.exceptions import NoGPSData
 from gorynych.common.infrastructure import persistence as pe
 from gorynych.processor.domain import TrackArchive, track
+from gorynych.processor.infrastructure.persistence import POINTS_CHANNEL
+from gorynych.processor.services.workers import TrackWorkers
 from gorynych.common.application import EventPollingService
 from gorynych.common.domain.services import APIAccessor, SinglePollerService
 
@@ -27,6 +29,23 @@ ADD_TRACK_TO_GROUP = """
         (SELECT ID FROM TRACK WHERE TRACK_ID=%s), %s);
 """
 
+# Points which track has already become points of group, their time interval
+# is announced as saved.
+NOTIFY_GROUP_TRACK_POINTS = """
+    SELECT pg_notify('%s', concat_ws(',', min(timestamp), max(timestamp),
+        %%s::text))
+    FROM track_data WHERE id = (SELECT ID FROM TRACK WHERE TRACK_ID=%%s)
+    HAVING count(*) > 0;
+""" % POINTS_CHANNEL
+
+SELECT_DEVICES_OF_RACES = pe.select('devices_of_races', 'race')
+
+SELECT_DEVICES_OF_RACE = pe.select('devices_of_race', 'race')
+
+SELECT_RACES_OF_DEVICE = pe.select('races_of_device', 'race')
+
+SELECT_TRACK_N_LABEL = pe.select('track_n_label', 'track')
+
 
 class ProcessorService(EventPollingService):
     '''
@@ -58,14 +77,12 @@ class ProcessorService(EventPollingService):
         '''
         # TODO: add events for extra tracks and left paragliders.
         tracks, extra_tracks, left_paragliders = archinfo
-        dlist = []
-        es = pe.event_store()
-        for di in tracks:
-            ev = events.ParagliderFoundInArchive(race_id, payload=di, aggregate_type='race')
-            dlist.append(es.persist(ev))
-        d = defer.DeferredList(dlist, fireOnOneErrback=True)
-        d.addCallback(lambda _:es.persist(events
-                .TrackArchiveUnpacked(race_id, payload=archinfo, aggregate_type='race')))
+        evlist = [events.ParagliderFoundInArchive(race_id, payload=di,
+            aggregate_type='race') for di in tracks]
+        evlist.append(events.TrackArchiveUnpacked(race_id, payload=archinfo,
+            aggregate_type='race'))
+        # Events are appended by one statement in order of the list.
+        d = pe.event_store().persist(evlist)
         d.addCallback(lambda _:log.msg("Track archive for race %s unpacked"
                                        % race_id))
         return d
@@ -81,8 +98,9 @@ class ProcessorService(EventPollingService):
         try:
             log.msg(">>>Adding track %s to group %s <<<" % (track_id,
                                                                 group_id))
-            yield self.pool.runOperation(ADD_TRACK_TO_GROUP, (group_id,
-                track_id, cn))
+            yield self.pool.runOperation(
+                ADD_TRACK_TO_GROUP + NOTIFY_GROUP_TRACK_POINTS, (group_id,
+                track_id, cn, group_id, track_id))
         except Exception as e:
             log.msg("Track %s hasn't been added to group %s because of %r" %
                     (track_id, group_id, e))
@@ -104,8 +122,8 @@ class TrackService(EventPollingService):
     TrackService parse track archive.
     '''
 
-    def __init__(self, pool, event_store, track_repository):
-        EventPollingService.__init__(self, pool, event_store)
+    def __init__(self, pool, event_store, track_repository, batch_size=None):
+        EventPollingService.__init__(self, pool, event_store, batch_size)
         self.aggregates = dict()
         self.track_repository = track_repository
 
@@ -205,15 +223,263 @@ class TrackService(EventPollingService):
         return d
 
 
+class IngestionStats(object):
+    '''
+    Count points appended to tracks and their lag: how many seconds passed
+    from point timestamp to the moment it was appended.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.points = 0
+        self.lag_sum = 0
+        self.lag_max = 0
+
+    def add(self, now, points):
+        '''
+        @param now: time when points were appended.
+        @type now: C{int}
+        @param points: points from tracker messages.
+        @type points: C{list} of C{dict}
+        '''
+        lags = [now - int(p['ts']) for p in points]
+        self.points += len(lags)
+        self.lag_sum += sum(lags)
+        self.lag_max = max(self.lag_max, max(lags))
+
+    def points_per_second(self):
+        return self.points / max(time.time() - self.since, 1e-6)
+
+    def lag(self):
+        '''
+        @return: mean and maximum lag in seconds.
+        @rtype: C{tuple}
+        '''
+        if not self.points:
+            return 0, 0
+        return float(self.lag_sum) / self.points, self.lag_max
+
+
+class DeviceRaceIndex(object):
+    '''
+    Resolve tracker device to race which it flies in at given time.
+    Devices of all current and upcoming races are loaded by one query, so
+    trackers which appear at race start don't go to database one by one.
+    Index doesn't expire: it follows event store and reloads race on
+    RaceCheckpointsChanged and the whole index on events which change race
+    paragliders or their trackers. Device which isn't in the index is
+    looked up alone, concurrent lookups of one device share a query.
+    '''
+    # Events with race as aggregate which change its time or devices.
+    race_events = frozenset(['RaceCheckpointsChanged'])
+    # Events which can change devices of any race.
+    global_events = frozenset(['ParagliderRegisteredOnContest',
+        'TrackerAssigned', 'TrackerUnAssigned', 'ContestRaceCreated'])
+    # Event id is taken on INSERT, so event can be committed after events
+    # with bigger ids. Events are read again while their ids are in this
+    # window from the last event.
+    window = 100000
+    # Index is loaded again after this time in seconds, in case event was
+    # committed when it had left the window.
+    reload_interval = 600
+
+    def __init__(self, pool, event_store=None, poll_interval=5):
+        '''
+        @param event_store: store to follow, index is never invalidated
+        without it.
+        @type event_store: L{gorynych.eventstore.eventstore.EventStore}
+        @param poll_interval: how often to read new events, in seconds.
+        @type poll_interval: C{int}
+        '''
+        self.pool = pool
+        self.event_store = event_store
+        self.poll_interval = poll_interval
+        # device_id:{race_id:(start_time, end_time, contest_number)}
+        # Devices which aren't in races have empty dict.
+        self.devices = {}
+        self.loaded = False
+        # Id of the last event which is applied to index.
+        self.last_event = None
+        # Ids of applied events which are in window.
+        self.applied = set()
+        self.loaded_at = None
+        # Changed on reloads, so lookups which started before them aren't
+        # stored.
+        self.generation = 0
+        # key:[Deferred,] requests waiting for the running query.
+        self._waiting = {}
+        self.poller = task.LoopingCall(
+            lambda: self.poll_events().addErrback(log.err))
+
+    def start(self):
+        if self.event_store and not self.poller.running:
+            self.poller.start(self.poll_interval, now=False)
+
+    def stop(self):
+        if self.poller.running:
+            self.poller.stop()
+
+    def get(self, device_id, now):
+        '''
+        @param device_id: tracker device id (imei).
+        @type device_id: C{str}
+        @param now: time for which race is looked for.
+        @type now: C{int}
+        @return: Deferred which fires with (race_id, contest_number) or
+        None if device isn't in a race at this time.
+        '''
+        if not self.loaded:
+            d = self.load(now)
+            return d.addCallback(lambda _: self.get(device_id, now))
+        if device_id in self.devices:
+            return defer.succeed(self.find(device_id, now))
+        d = self._coalesce(('device', device_id), self._lookup, device_id,
+            now)
+        return d.addCallback(lambda _: self.find(device_id, now))
+
+    def find(self, device_id, now):
+        '''
+        Find race in index without queries.
+        @return: (race_id, contest_number) or None.
+        '''
+        found = [(start, race_id, contest_number) for race_id,
+            (start, end, contest_number) in
+            self.devices.get(device_id, {}).iteritems()
+            if start <= now <= end]
+        if found:
+            start, race_id, contest_number = max(found)
+            return race_id, contest_number
+
+    def add(self, rows):
+        '''
+        @param rows: (device_id, race_id, contest_number, start_time,
+        end_time)
+        @type rows: C{list}
+        '''
+        for device_id, race_id, contest_number, start, end in rows:
+            self.devices.setdefault(device_id, {})[race_id] = (start, end,
+                contest_number)
+
+    def load(self, now=None):
+        '''
+        Load devices of all races which aren't finished at time now.
+        '''
+        return self._coalesce(('all',), self._load, now or int(time.time()))
+
+    def reload_race(self, race_id):
+        return self._coalesce(('race', race_id), self._reload_race, race_id)
+
+    @defer.inlineCallbacks
+    def poll_events(self):
+        '''
+        Apply events which happened since the last poll or were committed
+        late.
+        '''
+        if self.last_event is None:
+            return
+        if time.time() - self.loaded_at > self.reload_interval:
+            yield self.load()
+            return
+        evs = yield self._window_events(self.last_event)
+        evs = [ev for ev in evs if ev.id not in self.applied]
+        if not evs:
+            return
+        if set(ev.__class__.__name__ for ev in evs) & self.global_events:
+            log.msg("Reloading devices index after %s events" % len(evs))
+            yield self.load()
+        else:
+            for race_id in set(str(ev.aggregate_id) for ev in evs):
+                log.msg("Reloading devices of race %s" % race_id)
+                yield self.reload_race(race_id)
+            self._remember(self.last_event, evs)
+
+    def _window_events(self, last_event):
+        return self.event_store.load_events_since(
+            max(0, last_event - self.window),
+            sorted(self.race_events | self.global_events))
+
+    def _remember(self, last_event, evs):
+        self.applied.update(ev.id for ev in evs)
+        self.last_event = max([last_event] + [ev.id for ev in evs])
+        self.applied = set(i for i in self.applied
+            if i > self.last_event - self.window)
+
+    @defer.inlineCallbacks
+    def _load(self, now):
+        last_event, evs = None, []
+        if self.event_store:
+            # Read before races, so events which happen during loading
+            # will be applied after it, and events which are already in
+            # races aren't applied again.
+            last_event = yield self.event_store.last_event_id()
+            evs = yield self._window_events(last_event)
+        rows = yield self.pool.runQuery(SELECT_DEVICES_OF_RACES, (now,))
+        self.devices = {}
+        self.generation += 1
+        self.add(rows)
+        if last_event is not None:
+            self.applied = set()
+            self._remember(last_event, evs)
+        self.loaded = True
+        self.loaded_at = time.time()
+        log.msg("Devices index loaded: %s devices in races" %
+            len(self.devices))
+
+    @defer.inlineCallbacks
+    def _reload_race(self, race_id):
+        rows = yield self.pool.runQuery(SELECT_DEVICES_OF_RACE, (race_id,))
+        for races in self.devices.itervalues():
+            races.pop(race_id, None)
+        self.generation += 1
+        self.add(rows)
+
+    @defer.inlineCallbacks
+    def _lookup(self, device_id, now):
+        generation = self.generation
+        rows = yield self.pool.runQuery(SELECT_RACES_OF_DEVICE,
+            (device_id, now))
+        if generation == self.generation:
+            self.devices.setdefault(device_id, {})
+            self.add(rows)
+
+    def _coalesce(self, key, function, *args):
+        '''
+        Call function if there is no running call with the same key and
+        return Deferred which fires with result of the running call.
+        '''
+        d = defer.Deferred()
+        waiting = self._waiting.setdefault(key, [])
+        waiting.append(d)
+        if len(waiting) == 1:
+            function(*args).addBoth(self._fire, key)
+        return d
+
+    def _fire(self, result, key):
+        for d in self._waiting.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
 class OnlineTrashService(SinglePollerService):
     '''
     receive messages with track data from rabbitmq queue.
+    Received points are grouped by device and appended to tracks every
+    batch_interval seconds, one append per track. If workers keyword is
+    given tracks are processed in so many processes. Races of devices are
+    found in L{DeviceRaceIndex} which follows event_store if it's given.
     '''
+    batch_interval = 10
 
     def __init__(self, pool, repo, connection, **kw):
         poll_interval = kw.get('interval', 0.0)
         SinglePollerService.__init__(self, connection, poll_interval, queue_name='rdp')
         self.pool = pool
+        # Queries are made for every unknown device.
+        pe.prepare(pool, SELECT_RACES_OF_DEVICE, SELECT_TRACK_N_LABEL)
         self.did_aid = {}
         self.repo = repo
         # {race_id:{track_id:Track}}
@@ -221,8 +487,26 @@ class OnlineTrashService(SinglePollerService):
         self.processor = task.LoopingCall(self.process)
         # TODO: remove this from constructor.
         self.processor.start(60, False)
-        # device_id:(race_id, contest_number, time)
-        self.devices = dict()
+        self.races = DeviceRaceIndex(pool, kw.get('event_store'))
+        # device_id:[data,] received since last append.
+        self.pending = defaultdict(list)
+        self.stats = IngestionStats()
+        self.ingester = task.LoopingCall(self.append_pending)
+        self.ingester.start(kw.get('batch_interval', self.batch_interval),
+            False)
+        self.workers = None
+        if kw.get('workers'):
+            self.workers = TrackWorkers(kw['workers'])
+
+    def startService(self):
+        self.races.start()
+        return SinglePollerService.startService(self)
+
+    def stopService(self):
+        self.races.stop()
+        if self.workers:
+            self.workers.stop()
+        SinglePollerService.stopService(self)
 
     def handle_payload(self, channel, method_frame, header_frame, body, queue_name):
         data = cPickle.loads(body)
@@ -231,29 +515,31 @@ class OnlineTrashService(SinglePollerService):
             return
         if data['lat'] < 0.1 and data['lon'] < 0.1:
             return
-        return self.handle_track_data(data)
+        self.pending[data['imei']].append(data)
 
-    def handle_track_data(self, data):
+    def append_pending(self):
+        '''
+        Append points received since previous call to tracks.
+        '''
+        pending, self.pending = self.pending, defaultdict(list)
         now = int(time.time())
-        d = self._get_race_by_tracker(data['imei'], now)
-        d.addCallback(self._get_track, data['imei'])
+        dlist = []
+        for device_id, data in pending.iteritems():
+            self.stats.add(now, data)
+            dlist.append(self.handle_track_data(device_id, data, now))
+        return defer.DeferredList(dlist)
+
+    def handle_track_data(self, device_id, data, now):
+        '''
+        @param data: points from one device.
+        @type data: C{list} of C{dict}
+        '''
+        d = self.races.get(device_id, now)
+        d.addCallback(self._get_track, device_id)
         d.addCallback(lambda tr: tr.append_data(data))
+        d.addErrback(log.err)
         return d
 
-    @defer.inlineCallbacks
-    def _get_race_by_tracker(self, device_id, now):
-        result = self.devices.get(device_id)
-        if result and now - result[2] < 300:
-            defer.returnValue((result[0], result[1]))
-        row = yield self.pool.runQuery(pe.select('current_race_by_tracker',
-            'race'),(device_id, now))
-        # row can be (race.race_id, paraglider.contest_number).
-        if not row:
-            defer.returnValue(None)
-        race_id, contest_number = row[0]
-        self.devices[device_id] = (race_id, contest_number, int(time.time()))
-        defer.returnValue(row[0])
-
     def _get_track(self, row, device_id):
         if not row:
             # Null-object.
@@ -265,7 +551,7 @@ class OnlineTrashService(SinglePollerService):
             # Race and track are in memory. Return Track for work.
             return self.tracks[rid][device_id]
         else:
-            d = self.pool.runQuery(pe.select('track_n_label', 'track'),
+            d = self.pool.runQuery(SELECT_TRACK_N_LABEL,
                 ('_'.join((rid, 'online')), cnumber))
             d.addCallback(self._restore_or_create_track, rid, device_id, cnumber)
             return d
@@ -317,12 +603,23 @@ class OnlineTrashService(SinglePollerService):
         @return:
         @rtype:
         '''
-        for rid in self.tracks.keys():
-            for key in self.tracks[rid].keys():
-                try:
-                    self.tracks[rid][key].process_data()
-                    yield self.repo.save(self.tracks[rid][key])
-                except Exception as e:
-                    log.err("%r" % e)
-        return
+        lag = self.stats.lag()
+        log.msg("Ingested %.1f points/s, lag %.1f s (max %s s)" % (
+            self.stats.points_per_second(), lag[0], lag[1]))
+        self.stats.reset()
+        tracks = [trck for rid in self.tracks.keys()
+            for trck in self.tracks[rid].values()]
+        if self.workers:
+            tracks = yield self.workers.process(tracks)
+        else:
+            tracks = filter(self._process_track, tracks)
+        yield self.repo.save_many(tracks)
+
+    def _process_track(self, trck):
+        try:
+            trck.process_data()
+            return True
+        except Exception as e:
+            log.err("%r" % e)
+            return False
 
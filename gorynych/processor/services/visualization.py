@@ -1,25 +1,30 @@
 '''
 This application service return tracks data to visualisation.
 '''
+import sys
 import time
+import bisect
 import math
-from collections import defaultdict
+import struct
+from collections import defaultdict, OrderedDict
 
+import numpy as np
 from twisted.application.service import Service
 from twisted.internet import defer
 from twisted.python import log
+from txpostgres import txpostgres, reconnection
 import simplejson as json
 
+from gorynych.processor.infrastructure.persistence import POINTS_CHANNEL
+from gorynych.processor.domain.services import LOD_LEVELS, downsample
+
 __author__ = 'Boris Tsema'
 
 
-# Select track data.
-SELECT_DATA = """
+# Select track points ordered by track.
+SELECT_POINTS = """
     SELECT
-      t.timestamp,
-      string_agg(
-        concat_ws(',', tg.track_label, t.lat::text, t.lon::text, t.alt::text, t.v_speed::text, t.g_speed::text, t.distance::text),
-      ';')
+      tg.track_label, t.timestamp, t.lat, t.lon, t.alt, t.v_speed, t.g_speed, t.distance
     FROM
       track_data t,
       tracks_group tg
@@ -27,46 +32,72 @@ SELECT_DATA = """
       t.id = tg.track_id AND
       tg.group_id = %s AND
       t.timestamp BETWEEN %s AND %s
-    GROUP BY
-      t.timestamp
     ORDER BY
-      t.timestamp;
+      tg.track_label, t.timestamp;
     """
 
-# Select track state.
-SELECT_DATA_SNAPSHOTS = """
+# Select track points for some tracks.
+SELECT_POINTS_BY_LABEL = """
     SELECT
-      s.timestamp,
-      s.snapshot,
-      tg.track_label
+      tg.track_label, t.timestamp, t.lat, t.lon, t.alt, t.v_speed, t.g_speed, t.distance
     FROM
-      track_snapshot s,
+      track_data t,
       tracks_group tg
     WHERE
-      s.id = tg.track_id AND
+      t.id = tg.track_id AND
       tg.group_id = %s AND
-      s.timestamp BETWEEN %s AND %s;
+      t.timestamp BETWEEN %s AND %s AND
+      tg.track_label in %s
+    ORDER BY
+      tg.track_label, t.timestamp;
     """
 
-# Select track data just for some tracks.
-SELECT_DATA_BY_LABEL = """
+# Select downsampled track points ordered by track.
+SELECT_LOD_POINTS = """
     SELECT
-      t.timestamp,
-      string_agg(
-        concat_ws(',', tg.track_label, t.lat::text, t.lon::text, t.alt::text, t.v_speed::text, t.g_speed::text, t.distance::text),
-      ';')
+      tg.track_label, t.timestamp, t.lat, t.lon, t.alt, t.v_speed, t.g_speed, t.distance
     FROM
-      track_data t,
+      track_data_lod t,
+      tracks_group tg
+    WHERE
+      t.id = tg.track_id AND
+      tg.group_id = %s AND
+      t.level = %s AND
+      t.timestamp BETWEEN %s AND %s
+    ORDER BY
+      tg.track_label, t.timestamp;
+    """
+
+# Select downsampled track points for some tracks.
+SELECT_LOD_POINTS_BY_LABEL = """
+    SELECT
+      tg.track_label, t.timestamp, t.lat, t.lon, t.alt, t.v_speed, t.g_speed, t.distance
+    FROM
+      track_data_lod t,
       tracks_group tg
     WHERE
       t.id = tg.track_id AND
       tg.group_id = %s AND
+      t.level = %s AND
       t.timestamp BETWEEN %s AND %s AND
       tg.track_label in %s
-    GROUP BY
-      t.timestamp
     ORDER BY
-      t.timestamp;
+      tg.track_label, t.timestamp;
+    """
+
+# Select track state.
+SELECT_DATA_SNAPSHOTS = """
+    SELECT
+      s.timestamp,
+      s.snapshot,
+      tg.track_label
+    FROM
+      track_snapshot s,
+      tracks_group tg
+    WHERE
+      s.id = tg.track_id AND
+      tg.group_id = %s AND
+      s.timestamp BETWEEN %s AND %s;
     """
 
 # Select track state changes for some tracks.
@@ -85,6 +116,23 @@ SELECT_DATA_SNAPSHOTS_BY_LABEL = """
       tg.track_label in %s;
     """
 
+# Select newest point and last snapshots of every track, last column is
+# false for tracks which have no row in track_last_state.
+GET_LAST_STATES = """
+    SELECT
+      tg.track_label,
+      ls.timestamp,
+      concat_ws(',', ls.lat::text, ls.lon::text, ls.alt::text, ls.v_speed::text, ls.g_speed::text, ls.distance::text),
+      ls.snapshot_times,
+      ls.snapshots,
+      ls.id IS NOT NULL
+    FROM
+      tracks_group tg
+      LEFT JOIN track_last_state ls ON ls.id = tg.track_id
+    WHERE
+      tg.group_id = %s;
+    """
+
 # Select last track point in the past for every track.
 GET_HEADERS_DATA = """
     WITH tdata AS (
@@ -138,22 +186,246 @@ GET_HEADERS_SNAPSHOTS = """
     """
 
 
+def _rows_size(rows):
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(x) for x in row)
+        for row in rows)
+
+
+class BucketCache(object):
+    '''
+    LRU cache for track data and snapshots of tracks groups. Data is stored
+    by time buckets of fixed length, every bucket keeps rows of
+    SELECT_POINTS and SELECT_DATA_SNAPSHOTS queries which has timestamps
+    inside it. Least recently used buckets are evicted when cache size
+    becomes bigger then max_size. Buckets into which points are saved
+    are invalidated.
+    '''
+    def __init__(self, bucket=60, max_size=64 * 1024 * 1024):
+        '''
+        @param bucket: length of time bucket in seconds.
+        @type bucket: C{int}
+        @param max_size: maximum approximate size of cached data in bytes.
+        @type max_size: C{int}
+        '''
+        self.bucket = bucket
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Changed on every invalidation, data which was selected before it
+        # can be stale and isn't put.
+        self.version = 0
+        # {(group_id, bucket start):(size, points, snaps)}
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def start(self, timestamp):
+        '''
+        Return start of bucket for timestamp.
+        '''
+        return timestamp // self.bucket * self.bucket
+
+    def get(self, group_id, start):
+        '''
+        @return: (points, snaps) or None if bucket isn't cached.
+        @rtype: C{tuple}
+        '''
+        key = (group_id, start)
+        value = self._buckets.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        self._buckets[key] = value
+        return value[1:]
+
+    def put(self, group_id, start, points, snaps):
+        key = (group_id, start)
+        if key in self._buckets:
+            self.size -= self._buckets.pop(key)[0]
+        size = _rows_size(points) + _rows_size(snaps)
+        self._buckets[key] = (size, points, snaps)
+        self.size += size
+        while self.size > self.max_size and self._buckets:
+            self.size -= self._buckets.popitem(last=False)[1][0]
+
+    def invalidate(self, from_time, to_time, group_ids=None):
+        '''
+        Drop buckets which overlap time interval of saved points.
+        @param group_ids: groups which buckets are dropped, all groups by
+        default.
+        @type group_ids: C{set}
+        '''
+        first, last = self.start(from_time), self.start(to_time)
+        for key in [key for key in self._buckets
+                if first <= key[1] <= last and
+                (group_ids is None or key[0] in group_ids)]:
+            self.size -= self._buckets.pop(key)[0]
+        self.version += 1
+
+    def clear(self):
+        '''
+        Drop all buckets.
+        '''
+        self._buckets.clear()
+        self.size = 0
+        self.version += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, buckets=len(self),
+            size=self.size)
+
+
 class TrackVisualizationService(Service):
     # Don't show pilots earlier then time - track_gap. In seconds
     track_gap = 15000
+    # Time bucket can be cached when no more points can be saved into it,
+    # i.e. bucket_delay seconds after its end. In seconds.
+    bucket_delay = 120
+    # Data of longer intervals is sent to subscribers in parts. In seconds.
+    max_interval = 600
 
-    def __init__(self, pool):
+    def __init__(self, pool, cache=None):
         self.pool = pool
+        self.cache = cache or BucketCache()
+        # {group_id:set of subscribers}
+        self.subscribers = defaultdict(set)
+        # Connection which listens for saved points.
+        self.listener = None
+        # When listener was known to be connected: last notification or
+        # LISTEN. Unixtime.
+        self._heard_at = None
+        # {group_id:[time intervals of saved points which haven't been
+        # sent yet]}
+        self._unsent = OrderedDict()
+        self._sending = False
 
+    @defer.inlineCallbacks
     def startService(self):
         Service.startService(self)
         log.msg("Starting DB pool")
-        return self.pool.start()
+        yield self.pool.start()
+        self.listener = txpostgres.Connection(
+            detector=reconnection.DeadConnectionDetector())
+        self.listener.addNotifyObserver(self._on_notify)
+        self.listener.detector.addRecoveryHandler(self._reconnected)
+        d = self.listener.connect(*self.pool.connargs, **self.pool.connkw)
+        d.addCallbacks(lambda _: self._listen(),
+            self.listener.detector.checkForDeadConnection)
+        d.addErrback(log.err, "Points listener isn't connected")
+        yield d
 
     def stopService(self):
         Service.stopService(self)
+        if self.listener:
+            self.listener.detector.removeRecoveryHandler(self._reconnected)
+            self.listener.close()
         return self.pool.close()
 
+    def _listen(self):
+        d = self.listener.runOperation("LISTEN %s" % POINTS_CHANNEL)
+        d.addCallback(lambda _: setattr(self, '_heard_at', time.time()))
+        return d
+
+    def _reconnected(self):
+        '''
+        Notifications about points saved while listener was disconnected
+        are lost, so all cached buckets are dropped and data since listener
+        was heard last time is sent to subscribers again.
+        '''
+        now = int(time.time())
+        since = int(self._heard_at or now) - self.bucket_delay
+        d = self._listen()
+        d.addCallback(lambda _: self.cache.clear())
+        d.addCallback(lambda _: self.points_saved(
+            max(since, now - self.track_gap), now))
+        return d
+
+    def subscribe(self, group_id, subscriber):
+        '''
+        Subscribe to new data of tracks group.
+        @param subscriber: object with write method which receives server-sent
+        events with {'timeline':result of prepare_result} json.
+        '''
+        self.subscribers[group_id].add(subscriber)
+
+    def unsubscribe(self, group_id, subscriber):
+        self.subscribers[group_id].discard(subscriber)
+        if not self.subscribers[group_id]:
+            del self.subscribers[group_id]
+
+    def _on_notify(self, notify):
+        self._heard_at = time.time()
+        fields = notify.payload.split(',')
+        return self.points_saved(int(fields[0]), int(fields[1]),
+            fields[2:] or None)
+
+    def points_saved(self, from_time, to_time, group_ids=None):
+        '''
+        Send data saved in time interval to subscribers of groups which
+        tracks got points. Data is selected once for every subscribed group.
+        Intervals which come while data is being sent are joined if joined
+        interval isn't longer then max_interval and sent after that, long
+        intervals are split. Cached buckets of the interval are
+        invalidated: late and replayed points can be saved into closed
+        buckets.
+        @param group_ids: groups which tracks got points, all groups if
+        None.
+        @type group_ids: C{list}
+        '''
+        self.cache.invalidate(from_time, to_time,
+            None if group_ids is None else set(group_ids))
+        if group_ids is None:
+            group_ids = self.subscribers.keys()
+        for group_id in group_ids:
+            if group_id not in self.subscribers:
+                continue
+            for start in xrange(from_time, to_time + 1, self.max_interval):
+                self._add_unsent(group_id, start,
+                    min(to_time, start + self.max_interval - 1))
+        if self._unsent and not self._sending:
+            return self._send_unsent()
+
+    def _add_unsent(self, group_id, from_time, to_time):
+        intervals = self._unsent.setdefault(group_id, [])
+        for i, (first, last) in enumerate(intervals):
+            first, last = min(first, from_time), max(last, to_time)
+            if last - first < self.max_interval:
+                intervals[i] = first, last
+                return
+        intervals.append((from_time, to_time))
+
+    @defer.inlineCallbacks
+    def _send_unsent(self):
+        self._sending = True
+        try:
+            while self._unsent:
+                group_id, intervals = self._unsent.popitem(last=False)
+                for from_time, to_time in intervals:
+                    try:
+                        yield self._send_group_data(group_id, from_time,
+                            to_time)
+                    except Exception as e:
+                        log.err(e, "Error while sending data for group %s"
+                            % group_id)
+        finally:
+            self._sending = False
+
+    @defer.inlineCallbacks
+    def _send_group_data(self, group_id, from_time, to_time):
+        points = yield self.pool.runQuery(SELECT_POINTS,
+            (group_id, from_time, to_time))
+        if not points:
+            return
+        snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS,
+            (group_id, from_time, to_time))
+        event = 'data: %s\n\n' % json.dumps(
+            dict(timeline=self.prepare_result(points, snaps)))
+        for subscriber in list(self.subscribers.get(group_id, ())):
+            subscriber.write(event)
+
     @defer.inlineCallbacks
     def get_track_data(self, params):
         '''
@@ -161,7 +433,9 @@ class TrackVisualizationService(Service):
         @param params: request parameters, consist of group_id (domain id of
          tracks group), from_time (unixtime) to_time (unixtime),
          start_positions (show of not last track's position in the past),
-         track_labels (return result only for tracks with specified labels).
+         track_labels (return result only for tracks with specified labels),
+         lod (seconds per point) or points (points per track) for
+         downsampled data.
         @type params: dict
         @return:
         @rtype: dict
@@ -173,38 +447,193 @@ class TrackVisualizationService(Service):
         to_time = int(params['to_time'])
         start_positions = params.get('start_positions')
         track_labels = params.get('track_labels', '')
+        binary = params.get('format') == 'binary'
+        level = lod_level(from_time, to_time, params.get('lod'),
+            params.get('points'))
         t1 = time.time()
 
         if track_labels:
-            track_labels = track_labels.split(',')
-            tracks = yield self.pool.runQuery(SELECT_DATA_BY_LABEL,
-                (group_id, from_time,
-                to_time, tuple(track_labels)))
+            track_labels = tuple(track_labels.split(','))
+        if level:
+            points, snaps = yield self.select_lod_data(group_id, from_time,
+                to_time, level, int(t1), track_labels)
+        elif track_labels:
+            points = yield self.pool.runQuery(SELECT_POINTS_BY_LABEL,
+                (group_id, from_time, to_time, track_labels))
             snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS_BY_LABEL,
-                (group_id, from_time, to_time, tuple(track_labels)))
-
+                (group_id, from_time, to_time, track_labels))
         else:
-            tracks = yield self.pool.runQuery(SELECT_DATA,
-                (group_id, from_time,
-                to_time))
-            snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS,
-                (group_id, from_time, to_time))
+            points, snaps = yield self.select_group_data(group_id,
+                from_time, to_time, int(t1))
 
         t2 = time.time()
-        result['timeline'] = self.prepare_result(tracks, snaps)
-        log.msg("data requested in %0.3f" % (t2 - t1))
+        log.msg("data requested in %0.3f, lod: %s, cache: %r" % (t2 - t1,
+            level, self.cache.stats()))
         if start_positions:
             ts1 = time.time()
-            hdata = yield self.pool.runQuery(GET_HEADERS_DATA, (group_id,
-            from_time - self.track_gap, from_time))
-            hsnaps = yield self.pool.runQuery(GET_HEADERS_SNAPSHOTS,
-                (group_id, from_time))
+            hdata, hsnaps = yield self.select_start_data(group_id, from_time)
             ts2 = time.time()
             start_data = self.prepare_start_data(hdata, hsnaps)
             result['start'] = start_data
             log.msg("start positions requested in %0.3f" % (ts2 - ts1))
+        t3 = time.time()
+        if binary:
+            result = encode_timeline(points, snaps, result.get('start'))
+        else:
+            result['timeline'] = self.prepare_result(points, snaps)
+        log.msg("result for %s points prepared in %0.3f" % (len(points),
+            time.time() - t3))
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def select_group_data(self, group_id, from_time, to_time, now):
+        '''
+        Select track data and snapshots for tracks group. Closed time
+        buckets are taken from cache, missed ones are selected and cached
+        unless points were saved meanwhile, data for live buckets is
+        selected every time.
+        @return: (points, snaps) as from SELECT_POINTS and
+        SELECT_DATA_SNAPSHOTS queries.
+        @rtype: C{tuple}
+        '''
+        cache = self.cache
+        version = cache.version
+        last_closed = min(to_time, now - self.bucket_delay - cache.bucket)
+        starts = range(cache.start(from_time), last_closed + 1, cache.bucket)
+        buckets = {}
+        missed = []
+        for start in starts:
+            value = cache.get(group_id, start)
+            if value is None:
+                missed.append(start)
+            else:
+                buckets[start] = value
+        # Select missed buckets by continuous intervals.
+        i = 0
+        while i < len(missed):
+            j = i
+            while j + 1 < len(missed) and \
+                    missed[j + 1] - missed[j] == cache.bucket:
+                j += 1
+            first, last = missed[i], missed[j] + cache.bucket - 1
+            points = yield self.pool.runQuery(SELECT_POINTS,
+                (group_id, first, last))
+            snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS,
+                (group_id, first, last))
+            selected = dict((start, ([], [])) for start in missed[i:j + 1])
+            for row in points:
+                selected[cache.start(row[1])][0].append(row)
+            for row in snaps:
+                selected[cache.start(row[0])][1].append(row)
+            if cache.version == version:
+                for start, value in selected.iteritems():
+                    cache.put(group_id, start, *value)
+            buckets.update(selected)
+            i = j + 1
+
+        points, snaps = [], []
+        for start in starts:
+            bpoints, bsnaps = buckets[start]
+            points.extend(row for row in bpoints
+                if from_time <= row[1] <= to_time)
+            snaps.extend(row for row in bsnaps
+                if from_time <= row[0] <= to_time)
+        live_from = starts[-1] + cache.bucket if starts else from_time
+        if live_from <= to_time:
+            lpoints = yield self.pool.runQuery(SELECT_POINTS,
+                (group_id, live_from, to_time))
+            lsnaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS,
+                (group_id, live_from, to_time))
+            points.extend(lpoints)
+            snaps.extend(lsnaps)
+        defer.returnValue((points, snaps))
+
+    @defer.inlineCallbacks
+    def select_lod_data(self, group_id, from_time, to_time, level, now,
+            track_labels=None):
+        '''
+        Select downsampled track data and snapshots. Buckets which ended
+        bucket_delay seconds ago are read from track_data_lod, the rest is
+        selected from track_data and downsampled here. Snapshots are moved
+        to the next downsampled point of their track.
+        @param level: one of LOD_LEVELS.
+        @param track_labels: labels of tracks to select or None for all.
+        @type track_labels: C{tuple}
+        @return: (points, snaps) as from SELECT_POINTS and
+        SELECT_DATA_SNAPSHOTS queries.
+        @rtype: C{tuple}
+        '''
+        closed = (now - self.bucket_delay) // level * level
+        points = []
+        if from_time < closed:
+            query, args = SELECT_LOD_POINTS, (group_id, level, from_time,
+                min(to_time, closed - 1))
+            if track_labels:
+                query, args = SELECT_LOD_POINTS_BY_LABEL, args + (track_labels,)
+            points = yield self.pool.runQuery(query, args)
+        if to_time >= closed:
+            query, args = SELECT_POINTS, (group_id, max(from_time, closed),
+                to_time)
+            if track_labels:
+                query, args = SELECT_POINTS_BY_LABEL, args + (track_labels,)
+            live = yield self.pool.runQuery(query, args)
+            rows = np.array(live, dtype=POINTS_ROW_DTYPE)
+            points = list(points) + [live[i] for i in downsample(
+                rows['label'], rows['timestamp'], rows['alt'], level)]
+        if track_labels:
+            snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS_BY_LABEL,
+                (group_id, from_time, to_time, track_labels))
+        else:
+            snaps = yield self.pool.runQuery(SELECT_DATA_SNAPSHOTS,
+                (group_id, from_time, to_time))
+        defer.returnValue((points, align_snapshots(points, snaps)))
+
+    @defer.inlineCallbacks
+    def select_start_data(self, group_id, from_time):
+        '''
+        Select last points and snapshots of tracks at from_time. They are
+        read from track_last_state when every track has a row there and no
+        track has newer data there, and from track_data and track_snapshot
+        otherwise (replays, tracks saved before track_last_state).
+        @return: (hdata, hsnaps) as from GET_HEADERS_DATA and
+        GET_HEADERS_SNAPSHOTS queries.
+        @rtype: C{tuple}
+        '''
+        states = yield self.pool.runQuery(GET_LAST_STATES, (group_id,))
+        result = self.headers_from_states(states, from_time)
+        if result is None:
+            hdata = yield self.pool.runQuery(GET_HEADERS_DATA, (group_id,
+                from_time - self.track_gap, from_time))
+            hsnaps = yield self.pool.runQuery(GET_HEADERS_SNAPSHOTS,
+                (group_id, from_time))
+            result = hdata, hsnaps
+        defer.returnValue(result)
+
+    def headers_from_states(self, states, from_time):
+        '''
+        Convert rows of GET_LAST_STATES into rows of GET_HEADERS_DATA and
+        GET_HEADERS_SNAPSHOTS queries.
+        @return: (hdata, hsnaps) or None if some track has data newer then
+        from_time or has no last state.
+        @rtype: C{tuple}
+        '''
+        hdata, hsnaps = [], []
+        for label, timestamp, data, snapshot_times, snapshots, known in \
+                states:
+            snapshot_times = snapshot_times or []
+            if not known:
+                return
+            if timestamp is not None and timestamp > from_time or \
+                    snapshot_times and snapshot_times[-1] > from_time:
+                return
+            if timestamp is not None and \
+                    timestamp >= from_time - self.track_gap:
+                hdata.append((label, data, timestamp))
+            for snapshot_time, snapshot in zip(snapshot_times,
+                    snapshots or []):
+                hsnaps.append((label, snapshot, snapshot_time))
+        return hdata, hsnaps
+
     def prepare_start_data(self, hdata, hsnaps):
         '''
         Prepare last state of tracks from their coordinates and snapshots.
@@ -256,23 +685,27 @@ class TrackVisualizationService(Service):
                 result[contest_number]['in_air'] = True
         return result
 
-    def prepare_result(self, tracks, snaps):
+    def prepare_result(self, points, snaps):
         '''
 
-        @param tracks: [(timestamp, contest_number,lat,lon,
-        ...;contest_number,lat,lon..),...]
+        @param points: [(contest_number, timestamp, lat, lon, alt, v_speed,
+        g_speed, distance), ...]
         @param snaps: [(timestamp, snapshot, contest_number), ...]
-        @type tracks: list of tuple
-        @return:{timestamp:{'contnumber':[lat,lon...], },}
+        @type points: list of tuple
+        @return:{timestamp:{'contnumber':{'crds':[lat, lon, alt],
+        'spds':[gspd, vspd], 'dist':dist}, },}
         @rtype:
         '''
         # TODO: does this method need to be part of interface or it can be
         # static ?
         result = defaultdict(dict)
-        for row in tracks:
-            for data in row[1].split(';'):
-                result[int(row[0])][str(data.split(',')[0])
-                ] = parse_result(data.split(',')[1:])
+        rows = np.array(points, dtype=POINTS_ROW_DTYPE)
+        columns = [rows['timestamp'].tolist(), rows['label'].tolist()] + \
+            [_floats(rows[name]) for name in ('lat', 'lon', 'gspd', 'vspd')] \
+            + [rows[name].astype(int).tolist() for name in ('alt', 'dist')]
+        for ts, label, lat, lon, gspd, vspd, alt, dist in zip(*columns):
+            result[ts][str(label)] = dict(dist=dist, spds=[gspd, vspd],
+                crds=[lat, lon, alt])
 
         for row in snaps:
             timestamp, snapshot, contest_number = row
@@ -294,6 +727,58 @@ class TrackVisualizationService(Service):
         return result
 
 
+def lod_level(from_time, to_time, seconds=None, points=None):
+    '''
+    Choose downsampling level for requested resolution: the coarsest level
+    which isn't coarser then requested.
+    @param seconds: seconds per point.
+    @param points: points per track for the whole time interval.
+    @return: level from LOD_LEVELS or None if all points should be returned.
+    @rtype: C{int}
+    '''
+    if points:
+        seconds = (to_time - from_time) / max(float(points), 1)
+    if not seconds:
+        return None
+    levels = [level for level in LOD_LEVELS if level <= float(seconds)]
+    if levels:
+        return levels[-1]
+
+
+def align_snapshots(points, snaps):
+    '''
+    Move every snapshot to the first point of its track at or after it (or
+    to the last point of track), so downsampled timeline keeps states.
+    @param points: rows of SELECT_POINTS query.
+    @param snaps: rows of SELECT_DATA_SNAPSHOTS query.
+    @return: snaps with changed timestamps. Snapshots which are moved to
+    the same point are joined.
+    @rtype: C{list}
+    '''
+    times = defaultdict(list)
+    for row in points:
+        times[row[0]].append(row[1])
+    for label in times:
+        times[label].sort()
+    result = OrderedDict()
+    for timestamp, snapshot, label in sorted(snaps):
+        track = times.get(label)
+        if not track:
+            continue
+        timestamp = track[min(bisect.bisect_left(track, timestamp),
+            len(track) - 1)]
+        key = (timestamp, label)
+        if key in result:
+            try:
+                snapshot = json.dumps(json.loads(result[key]) +
+                    json.loads(snapshot))
+            except ValueError:
+                continue
+        result[key] = snapshot
+    return [(timestamp, snapshot, label)
+        for (timestamp, label), snapshot in result.iteritems()]
+
+
 def parse_result(data):
     res = dict()
     res['lat'], res['lon'], res['alt'], res['vspd'], res['gspd'], \
@@ -316,3 +801,126 @@ def parse_result(data):
     return dict(dist=res['dist'],
         spds=[res['gspd'], res['vspd']],
         crds=[res['lat'], res['lon'], res['alt']])
+
+
+def _floats(column):
+    '''
+    Vectorized parse_result for float column.
+    @rtype: C{list}
+    '''
+    result = np.round(column, 6)
+    if np.isnan(result).any():
+        log.msg("Nan found in float.")
+        result[np.isnan(result)] = 0
+    if np.isinf(result).any():
+        log.msg("Infinity found in float.")
+        result[np.isinf(result)] = 1
+    return result.tolist()
+
+
+# Binary timeline format, all numbers are little-endian.
+#   header: magic, version, length of json part
+#   json: {'start': start positions or null,
+#          'states': {label: [[timestamp, snapshot list], ...]}}
+#   number of tracks (uint16), then for every track:
+#   label length (uint8), label, number of points n (uint32), first
+#   timestamp (int32), size of timestamp deltas (uint8, 2 or 4),
+#   n - 1 timestamp deltas, lat and lon in microdegrees (int32[n]),
+#   alt in meters (int16[n]), vspd and gspd in hundredths (int16[n]),
+#   dist (int32[n]).
+BINARY_CONTENT_TYPE = 'application/x-gorynych-timeline'
+TIMELINE_MAGIC = 'GTL'
+TIMELINE_VERSION = 1
+_HEADER = struct.Struct('<3sBI')
+POINTS_ROW_DTYPE = [('label', 'O'), ('timestamp', 'i4'), ('lat', 'f8'),
+    ('lon', 'f8'), ('alt', 'f8'), ('vspd', 'f8'), ('gspd', 'f8'),
+    ('dist', 'f8')]
+# (column, type, multiplier)
+_COLUMNS = [('lat', '<i4', 1e6), ('lon', '<i4', 1e6), ('alt', '<i2', 1),
+    ('vspd', '<i2', 100), ('gspd', '<i2', 100), ('dist', '<i4', 1)]
+
+
+def _fixed(column, dtype, multiplier):
+    info = np.iinfo(dtype)
+    values = np.nan_to_num(column * multiplier)
+    return np.clip(np.round(values), info.min, info.max).astype(dtype)
+
+
+def encode_timeline(points, snaps, start=None):
+    '''
+    Encode track points and snapshots into binary timeline.
+    @param points: rows of SELECT_POINTS query ordered by timestamp.
+    @type points: C{list} of C{tuple}
+    @param snaps: rows of SELECT_DATA_SNAPSHOTS query.
+    @type snaps: C{list} of C{tuple}
+    @param start: start positions as from prepare_start_data.
+    @type start: C{dict}
+    @rtype: C{str}
+    '''
+    states = defaultdict(list)
+    for timestamp, snapshot, label in sorted(snaps):
+        try:
+            snapshot = json.loads(snapshot)
+        except ValueError:
+            continue
+        states[label].append([timestamp, snapshot])
+    header = json.dumps(dict(start=start, states=states))
+    result = [_HEADER.pack(TIMELINE_MAGIC, TIMELINE_VERSION, len(header)),
+        header]
+    rows = np.array(points, dtype=POINTS_ROW_DTYPE)
+    if len(rows) and not (rows['label'][1:] >= rows['label'][:-1]).all():
+        rows = rows[np.argsort(rows['label'], kind='mergesort')]
+    labels = rows['label']
+    bounds = [0] + list(np.flatnonzero(labels[1:] != labels[:-1]) + 1) + \
+        [len(rows)]
+    if not len(rows):
+        bounds = [0]
+    result.append(struct.pack('<H', len(bounds) - 1))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        track = rows[first:last]
+        label = str(track['label'][0])
+        result.append(struct.pack('<B', len(label)) + label)
+        result.append(struct.pack('<Ii', len(track), track['timestamp'][0]))
+        deltas = np.diff(track['timestamp'])
+        delta_type = '<u2' if not len(deltas) or deltas.max() < 2 ** 16 \
+            else '<u4'
+        result.append(struct.pack('<B', np.dtype(delta_type).itemsize))
+        result.append(deltas.astype(delta_type).tostring())
+        for name, dtype, multiplier in _COLUMNS:
+            result.append(_fixed(track[name], dtype, multiplier).tostring())
+    return ''.join(result)
+
+
+def decode_timeline(data):
+    '''
+    Decode binary timeline.
+    @return: (json part, {label:points}) where points are structured array
+    with timestamp, lat, lon, alt, vspd, gspd and dist fields.
+    @rtype: C{tuple}
+    '''
+    magic, version, length = _HEADER.unpack_from(data)
+    if magic != TIMELINE_MAGIC or version != TIMELINE_VERSION:
+        raise ValueError("Unknown timeline format %r %r" % (magic, version))
+    offset = _HEADER.size
+    header = json.loads(data[offset:offset + length])
+    offset += length
+    tracks = {}
+    count, = struct.unpack_from('<H', data, offset)
+    offset += 2
+    for i in xrange(count):
+        size, = struct.unpack_from('<B', data, offset)
+        label = data[offset + 1:offset + 1 + size]
+        offset += 1 + size
+        n, first, delta_size = struct.unpack_from('<IiB', data, offset)
+        offset += 9
+        deltas = np.frombuffer(data, '<u%s' % delta_size, n - 1, offset)
+        offset += deltas.nbytes
+        track = np.empty(n, dtype=[('timestamp', 'i4')] + [
+            (name, 'f8') for name, _, _ in _COLUMNS])
+        track['timestamp'] = first + np.hstack(([0], np.cumsum(deltas)))
+        for name, dtype, multiplier in _COLUMNS:
+            column = np.frombuffer(data, dtype, n, offset)
+            offset += column.nbytes
+            track[name] = column / float(multiplier)
+        tracks[label] = track
+    return header, tracks
@@ -0,0 +1,201 @@
+# coding=utf-8
+'''
+Processing of online tracks in worker processes.
+'''
+import copy
+import multiprocessing
+import os
+import signal
+import zlib
+
+import numpy as np
+from twisted.internet import threads, defer
+from twisted.python import log
+
+from gorynych.processor.domain import services
+
+
+def _work(conn):
+    '''
+    Worker process loop. Worker receives tracks with new points, processes
+    them and sends them back. Only race tasks are kept between ticks: they
+    hold state of checkpoints and aren't pickled with track. Tasks of tracks
+    which weren't in the last jobs are dropped.
+    @param conn: worker end of pipe.
+    @type conn: C{multiprocessing.Connection}
+    '''
+    # Worker is forked from process with reactor which handles SIGTERM, but
+    # it must die when it's terminated.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # {(track id, track key):task}
+    tasks = {}
+    while True:
+        jobs = conn.recv()
+        if jobs is None:
+            break
+        result = []
+        seen = {}
+        for key, trck in jobs:
+            trck._task = tasks.get(key)
+            try:
+                trck.process_data()
+                result.append((key, trck, None))
+            except Exception as e:
+                result.append((key, None, repr(e)))
+            if trck._task is not None:
+                seen[key] = trck._task
+        tasks = seen
+        conn.send(result)
+    conn.close()
+
+
+def _receive(conn, shard, timeout):
+    '''
+    Wait for results of worker in thread. Worker which doesn't answer in
+    timeout seconds is considered hung.
+    '''
+    if not conn.poll(timeout):
+        raise defer.TimeoutError("Track worker %s didn't answer in %s "
+            "seconds" % (shard, timeout))
+    return conn.recv()
+
+
+class TrackWorkers(object):
+    '''
+    Pool of processes which process online tracks. Track is sent to worker
+    with its new points every tick and comes back processed, so track in
+    main process is always up to date and is what is saved. Tracks are
+    sharded by track id, so race task of track stays in the same worker.
+    Arrays are pickled as raw data. Dead and hung workers are restarted.
+    '''
+    def __init__(self, workers, timeout=60):
+        '''
+        @param workers: number of worker processes.
+        @type workers: C{int}
+        @param timeout: how long to wait for results of worker, in seconds.
+        @type timeout: C{float}
+        '''
+        self.timeout = timeout
+        self.connections = [None] * workers
+        self.processes = [None] * workers
+        for shard in xrange(workers):
+            self._start(shard)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def _start(self, shard):
+        conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_work, args=(child_conn,))
+        p.daemon = True
+        p.start()
+        self.connections[shard] = conn
+        self.processes[shard] = p
+
+    def _restart(self, shard):
+        log.msg("Restarting track worker %s" % shard)
+        p = self.processes[shard]
+        if p.is_alive():
+            p.terminate()
+            p.join(5)
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGKILL)
+        p.join()
+        self.connections[shard].close()
+        self._start(shard)
+
+    def shard(self, track_id):
+        return zlib.crc32(str(track_id)) % len(self.processes)
+
+    def process(self, tracks):
+        '''
+        Process tracks in workers. Tracks are updated with results in
+        reactor thread, so they can be saved after it. Tracks which failed
+        keep their new points for the next tick, as tracks of worker which
+        died or didn't answer in time.
+        @param tracks: tracks to process.
+        @type tracks: C{list} of L{gorynych.processor.domain.track.Track}
+        @return: Deferred which fires with list of tracks processed
+        without errors.
+        @rtype: C{Deferred}
+        '''
+        jobs, shipped = self._jobs(tracks)
+        shards = sorted(jobs)
+        dlist = []
+        for shard in shards:
+            try:
+                self.connections[shard].send(jobs[shard])
+            except Exception:
+                dlist.append(defer.fail())
+            else:
+                dlist.append(threads.deferToThread(_receive,
+                    self.connections[shard], shard, self.timeout))
+        d = defer.DeferredList(dlist, consumeErrors=True)
+        d.addCallback(lambda results: self._apply(zip(shards, results),
+            tracks, shipped))
+        return d
+
+    def _jobs(self, tracks):
+        '''
+        Take new points from tracks and group copies of tracks with them by
+        worker. Points which are appended while workers are busy stay in
+        track buffer.
+        @return: {shard:[((track_id, key), track copy)]} and {track_id:(new points,
+        number of track changes)}
+        @rtype: C{tuple}
+        '''
+        result = {}
+        shipped = {}
+        for trck in tracks:
+            track_id = str(trck.id)
+            job = copy.copy(trck)
+            shipped[track_id] = (trck.buffer, len(trck.changes))
+            trck.buffer = np.empty(0, dtype=trck.dtype)
+            # Restored or recreated track is another object and gets new
+            # task in worker, as it would in main process.
+            result.setdefault(self.shard(track_id), []).append(
+                ((track_id, id(trck)), job))
+        return result, shipped
+
+    def _apply(self, results, tracks, shipped):
+        done = {}
+        for shard, (success, result) in results:
+            if not success:
+                log.err(result, "Track worker %s failed" % shard)
+                self._restart(shard)
+                continue
+            for (track_id, _), processed, error in result:
+                if error:
+                    log.err("Error while processing track %s: %s" % (
+                        track_id, error))
+                    continue
+                done[track_id] = processed
+        ok = []
+        for trck in tracks:
+            track_id = str(trck.id)
+            points, n_changes = shipped[track_id]
+            if track_id not in done:
+                # Points are processed again on the next tick.
+                trck.buffer = services.create_uniq_hstack(points,
+                    trck.buffer)
+                continue
+            state = done[track_id].__dict__
+            # Task and type aren't pickled, the ones of track are kept.
+            del state['_task'], state['_type']
+            state['buffer'] = services.create_uniq_hstack(state['buffer'],
+                trck.buffer)
+            state['changes'] = state['changes'] + trck.changes[n_changes:]
+            trck.__dict__.update(state)
+            ok.append(trck)
+        return ok
+
+    def stop(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except Exception:
+                pass
+        for p in self.processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
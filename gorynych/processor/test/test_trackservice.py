@@ -1,7 +1,14 @@
+import cPickle
+import time
+
+import mock
+from twisted.internet import defer
 from twisted.trial.unittest import TestCase
 from twisted.trial.unittest import SkipTest
 
+from gorynych.common.domain import events
 from gorynych.processor.trackservice import OnlineTrashService
+from gorynych.processor.services import trackservice
 from gorynych.common.infrastructure.messaging import FakeRabbitMQObject, RabbitMQObject
 
 
@@ -19,3 +26,186 @@ class TestTrackService(TestCase):
         received = self.sender.read(message)
         self.assertEquals(received, message)
 
+
+class TestOnlineTrashService(TestCase):
+    def setUp(self):
+        self.service = OnlineTrashService(mock.Mock(), mock.Mock(),
+            mock.Mock())
+        now = int(time.time())
+        self.tracks = {}
+        self.service.races.loaded = True
+        for imei in ['1', '2']:
+            self.service.races.add([(imei, 'race', imei, now - 60, now)])
+            self.tracks[imei] = self.service.tracks['race'][imei] = \
+                mock.Mock()
+
+    def tearDown(self):
+        self.service.processor.stop()
+        self.service.ingester.stop()
+
+    def send(self, imei, ts):
+        body = cPickle.dumps(dict(imei=imei, ts=ts, lat=40., lon=40.,
+            alt=100, h_speed=10))
+        self.service.handle_payload(None, None, None, body, 'rdp')
+
+    def test_points_are_appended_in_batch(self):
+        now = int(time.time())
+        self.send('1', now - 2)
+        self.send('2', now - 10)
+        self.send('1', now - 1)
+        self.assertFalse(self.tracks['1'].append_data.called)
+
+        self.service.append_pending()
+        data = self.tracks['1'].append_data.call_args[0][0]
+        self.assertListEqual([p['ts'] for p in data], [now - 2, now - 1])
+        self.assertEqual(self.tracks['2'].append_data.call_count, 1)
+        self.assertEqual(self.service.stats.points, 3)
+        self.assertEqual(self.service.stats.lag()[1], 10)
+
+        self.service.append_pending()
+        self.assertEqual(self.tracks['1'].append_data.call_count, 1)
+
+
+class FakePool(object):
+    '''
+    Pool which records queries and answers them when told to.
+    '''
+    def __init__(self):
+        self.queries = []
+
+    def runQuery(self, query, args=None):
+        d = defer.Deferred()
+        self.queries.append((query, args, d))
+        return d
+
+    def answer(self, rows):
+        query, args, d = self.queries[-1]
+        d.callback(rows)
+
+
+class TestDeviceRaceIndex(TestCase):
+    def setUp(self):
+        self.pool = FakePool()
+        self.event_store = mock.Mock()
+        self.last_event, self.events = 10, []
+        self.event_store.last_event_id.side_effect = lambda: defer.succeed(
+            self.last_event)
+        self.event_store.load_events_since.side_effect = \
+            lambda *args: defer.succeed(self.events)
+        self.index = trackservice.DeviceRaceIndex(self.pool,
+            self.event_store)
+        self.index.window = 5
+        self.now = 1374223800
+
+    def get(self, device_id, now=None):
+        result = []
+        self.index.get(device_id, now or self.now).addCallback(result.append)
+        return result
+
+    def load(self):
+        result = self.get('1')
+        self.pool.answer([('1', 'r1', '11', self.now - 60, self.now + 60),
+            ('2', 'r1', '12', self.now - 60, self.now + 60),
+            ('1', 'r2', '21', self.now + 60, self.now + 120)])
+        return result
+
+    def test_misses_are_coalesced(self):
+        first, second = self.get('1'), self.get('1')
+        self.assertEqual(len(self.pool.queries), 1)
+        self.assertEqual(self.pool.queries[0][:2],
+            (trackservice.SELECT_DEVICES_OF_RACES, (self.now,)))
+        self.pool.answer([('1', 'r1', '11', self.now - 60, self.now + 60)])
+        self.assertEqual(first, [('r1', '11')])
+        self.assertEqual(second, [('r1', '11')])
+
+        unknown = [self.get('x'), self.get('x')]
+        self.assertEqual(len(self.pool.queries), 2)
+        self.assertEqual(self.pool.queries[1][:2],
+            (trackservice.SELECT_RACES_OF_DEVICE, ('x', self.now)))
+        self.pool.answer([])
+        self.assertEqual(unknown, [[None], [None]])
+        self.assertEqual(self.get('x'), [None])
+        self.assertEqual(len(self.pool.queries), 2)
+
+    def test_race_windows(self):
+        self.assertEqual(self.load(), [('r1', '11')])
+        self.assertEqual(self.get('1', self.now + 90), [('r2', '21')])
+        self.assertEqual(self.get('1', self.now + 60), [('r2', '21')])
+        self.assertEqual(self.get('2', self.now + 90), [None])
+        self.assertEqual(len(self.pool.queries), 1)
+
+    def test_invalidated_by_events(self):
+        self.load()
+        self.events = [self.event(11, 'r1')]
+        self.index.poll_events()
+        self.assertEqual(self.event_store.load_events_since.call_args[0][0],
+            5)
+        self.assertEqual(self.pool.queries[-1][:2],
+            (trackservice.SELECT_DEVICES_OF_RACE, ('r1',)))
+        self.pool.answer([('2', 'r1', '12', self.now, self.now + 60)])
+        self.assertEqual(self.get('1'), [None])
+        self.assertEqual(self.get('2', self.now - 30), [None])
+        self.assertEqual(self.get('1', self.now + 90), [('r2', '21')])
+        self.assertEqual(self.index.last_event, 11)
+
+        self.last_event = 12
+        self.events = [events.TrackerAssigned('pers-1',
+            aggregate_type='person')]
+        self.events[0].id = 12
+        self.index.poll_events()
+        self.assertEqual(self.pool.queries[-1][0],
+            trackservice.SELECT_DEVICES_OF_RACES)
+        self.pool.answer([('3', 'r1', '13', self.now - 60, self.now + 60)])
+        self.assertEqual(self.get('3'), [('r1', '13')])
+        self.assertEqual(self.index.last_event, 12)
+        # Device isn't in races after reload and is looked up alone.
+        result = self.get('2')
+        self.assertEqual(self.pool.queries[-1][0],
+            trackservice.SELECT_RACES_OF_DEVICE)
+        self.pool.answer([])
+        self.assertEqual(result, [None])
+
+    def event(self, event_id, race_id):
+        ev = events.RaceCheckpointsChanged(race_id, aggregate_type='race')
+        ev.id = event_id
+        return ev
+
+    def test_late_events(self):
+        self.events = [self.event(9, 'r1')]
+        self.load()
+        self.assertEqual(self.index.applied, set([9]))
+        # Event 8 is committed after events 9 and 11.
+        self.events = [self.event(9, 'r1'), self.event(11, 'r2')]
+        self.index.poll_events()
+        self.assertEqual(self.pool.queries[-1][:2],
+            (trackservice.SELECT_DEVICES_OF_RACE, ('r2',)))
+        self.pool.answer([])
+        queries = len(self.pool.queries)
+        self.events = [self.event(8, 'r3'), self.event(9, 'r1'),
+            self.event(11, 'r2')]
+        self.index.poll_events()
+        self.assertEqual(len(self.pool.queries), queries + 1)
+        self.assertEqual(self.pool.queries[-1][:2],
+            (trackservice.SELECT_DEVICES_OF_RACE, ('r3',)))
+        self.pool.answer([])
+        self.assertEqual(self.index.last_event, 11)
+        self.assertEqual(self.index.applied, set([8, 9, 11]))
+        self.index.poll_events()
+        self.assertEqual(len(self.pool.queries), queries + 1)
+
+    def test_periodic_reload(self):
+        self.load()
+        self.index.loaded_at -= self.index.reload_interval + 1
+        self.index.poll_events()
+        self.assertEqual(self.pool.queries[-1][0],
+            trackservice.SELECT_DEVICES_OF_RACES)
+        self.assertEqual(len(self.pool.queries), 2)
+
+    def test_lookup_older_than_reload_is_dropped(self):
+        self.load()
+        result = self.get('x')
+        self.index.reload_race('r2')
+        self.pool.answer([])
+        self.pool.queries[-2][2].callback([('x', 'r2', '1', 0, self.now)])
+        self.assertEqual(result, [None])
+        self.assertNotIn('x', self.index.devices)
@@ -1,27 +1,28 @@
 from twisted.application import service
-from twisted.enterprise import adbapi
 
 from gorynych import BaseOptions
 from gorynych.processor.services.trackservice import TrackService, ProcessorService, OnlineTrashService
 from gorynych.processor.infrastructure.persistence import TrackRepository
 from gorynych.common.infrastructure import persistence
+from gorynych.common.infrastructure.dbpool import make_pool
 from gorynych.common.infrastructure.messaging import RabbitMQObject
 from gorynych.eventstore.eventstore import EventStore
 from gorynych.eventstore.store import PGSQLAppendOnlyStore
 
 
 class Options(BaseOptions):
-    pass
+    optParameters = [
+        ['workers', '', 0, 'Number of processes for online tracks '
+                           'processing, 0 to process them in main process.',
+            int]
+    ]
 
 
 def makeService(config, services=None):
     if not services:
         services = service.MultiService()
 
-    pool = adbapi.ConnectionPool('psycopg2', database=config['dbname'],
-        user=config['dbuser'],
-        password=config['dbpassword'],
-        host=config['dbhost'], cp_max=16)
+    pool = make_pool(config)
 
     # EventStore init
     event_store = EventStore(PGSQLAppendOnlyStore(pool))
@@ -33,10 +34,14 @@ def makeService(config, services=None):
     rabbit_connection = RabbitMQObject(host='localhost', port=5672,
                                        exchange='receiver', queues_no_ack=True,
                                        exchange_type='fanout')
-    online_service = OnlineTrashService(pool, track_repository, rabbit_connection)
-
-    track_service = TrackService(pool, event_store, track_repository)
-    processor_service = ProcessorService(pool, event_store)
+    online_service = OnlineTrashService(pool, track_repository,
+        rabbit_connection, event_store=event_store,
+        workers=config['workers'])
+
+    track_service = TrackService(pool, event_store, track_repository,
+        batch_size=config['eventbatch'])
+    processor_service = ProcessorService(pool, event_store,
+        batch_size=config['eventbatch'])
 
     track_service.setServiceParent(services)
     processor_service.setServiceParent(services)
@@ -1,10 +1,10 @@
 import os
 
-from txpostgres import txpostgres
 from twisted.application import service, internet
 from twisted.web import server
 
 from gorynych import BaseOptions
+from gorynych.common.infrastructure.dbpool import make_pool
 from gorynych.processor.services.visualization import TrackVisualizationService
 # TODO: remove this dependency
 from gorynych.info.restui import base_resource
@@ -19,12 +19,7 @@ class Options(BaseOptions):
 def makeService(config, services=None):
     if not services:
         services = service.MultiService()
-    pool = txpostgres.ConnectionPool(None,
-                                     host=config['dbhost'],
-                                     database=config['dbname'],
-                                     user=config['dbuser'],
-                                     password=config['dbpassword'],
-                                     min=config['poolthreads'])
+    pool = make_pool(config)
     vis_service = TrackVisualizationService(pool)
     vis_service.setServiceParent(services)
 
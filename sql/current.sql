@@ -138,24 +138,33 @@ CREATE TABLE IF NOT EXISTS events
   OCCURED_ON TIMESTAMP NOT NULL
 );
 
+-- Index of existing big table is built by PGSQLAppendOnlyStore.initialize
+-- concurrently, here it's built with table.
+CREATE INDEX IF NOT EXISTS events_aggregate ON events (AGGREGATE_ID, EVENT_ID);
+
 CREATE TABLE IF NOT EXISTS dispatch (
   EVENT_ID bigint REFERENCES events(EVENT_ID) ON DELETE CASCADE,
+  EVENT_NAME TEXT,
   TAKEN BOOLEAN DEFAULT FALSE ,
   TIME TIMESTAMP DEFAULT NOW(),
 
   PRIMARY KEY (EVENT_ID)
 );
 
-CREATE OR REPLACE FUNCTION add_to_dispatch() RETURNS TRIGGER AS $$
-        BEGIN
-          INSERT INTO dispatch (EVENT_ID) VALUES (NEW.EVENT_ID);
-          RETURN NEW;
-        END;
-    $$ LANGUAGE plpgsql;
+CREATE INDEX IF NOT EXISTS dispatch_claim ON dispatch (EVENT_NAME, TIME)
+  WHERE NOT TAKEN;
 
-CREATE TRIGGER to_dispatch
-AFTER INSERT ON events
-FOR EACH ROW EXECUTE PROCEDURE add_to_dispatch();
+-- Function add_to_dispatch and trigger to_dispatch which fill dispatch table
+-- are created by PGSQLAppendOnlyStore from its list of events which aren't
+-- dispatched, when services start.
+
+CREATE TABLE IF NOT EXISTS aggregate_snapshot (
+  AGGREGATE_ID TEXT PRIMARY KEY,
+  EVENT_ID BIGINT NOT NULL,
+  SNAPSHOT BYTEA NOT NULL,
+  APPLIED BIGINT[]
+);
+ALTER TABLE aggregate_snapshot ADD COLUMN IF NOT EXISTS APPLIED BIGINT[];
 
 
 -- Aggregate Track -------------------------------------
@@ -186,11 +195,25 @@ CREATE TABLE TRACK_DATA(
 	DISTANCE INTEGER ,
 
   PRIMARY KEY (TIMESTAMP, ID)
-);
+) PARTITION BY RANGE (TIMESTAMP);
+-- Monthly partitions track_data_YYYYMM are created by TrackRepository, see
+-- gorynych/processor/infrastructure/partitions.py.
+
+-- Downsampled track_data: points with minimal and maximal altitude of every
+-- LEVEL seconds of track (see DownsamplingPyramid).
+CREATE TABLE TRACK_DATA_LOD(
+  LEVEL SMALLINT,
+	ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,
+	TIMESTAMP INTEGER,
+	LAT DOUBLE PRECISION ,
+	LON DOUBLE PRECISION ,
+	ALT SMALLINT ,
+	G_SPEED REAL,
+	V_SPEED REAL,
+	DISTANCE INTEGER ,
 
-CREATE INDEX track_data_timestamp_idx
-  ON track_data
-  USING btree (timestamp);
+  PRIMARY KEY (LEVEL, TIMESTAMP, ID)
+);
 
 CREATE TABLE TRACK_SNAPSHOT(
   ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,
@@ -200,6 +223,20 @@ CREATE TABLE TRACK_SNAPSHOT(
   PRIMARY KEY (ID, TIMESTAMP)
 );
 
+-- Newest point and last three snapshots of every track.
+CREATE TABLE TRACK_LAST_STATE(
+  ID INT PRIMARY KEY REFERENCES TRACK(ID) ON DELETE CASCADE ,
+  TIMESTAMP INTEGER ,
+  LAT DOUBLE PRECISION ,
+  LON DOUBLE PRECISION ,
+  ALT SMALLINT ,
+  G_SPEED REAL,
+  V_SPEED REAL,
+  DISTANCE INTEGER ,
+  SNAPSHOT_TIMES INTEGER[] ,
+  SNAPSHOTS TEXT[]
+);
+
 CREATE TABLE TRACKS_GROUP(
   GROUP_ID TEXT ,
   TRACK_ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,
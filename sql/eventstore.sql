@@ -9,21 +9,30 @@ CREATE TABLE IF NOT EXISTS events
       OCCURED_ON TIMESTAMP NOT NULL
     );
 
+-- Index of existing big table is built by PGSQLAppendOnlyStore.initialize
+-- concurrently, here it's built with table.
+CREATE INDEX IF NOT EXISTS events_aggregate ON events (AGGREGATE_ID, EVENT_ID);
+
 CREATE TABLE IF NOT EXISTS dispatch (
   EVENT_ID bigint REFERENCES events(EVENT_ID) ON DELETE CASCADE,
+  EVENT_NAME TEXT,
   TAKEN BOOLEAN DEFAULT FALSE ,
   TIME TIMESTAMP DEFAULT NOW(),
 
   PRIMARY KEY (EVENT_ID)
 );
 
-CREATE OR REPLACE FUNCTION add_to_dispatch() RETURNS TRIGGER AS $$
-        BEGIN
-          INSERT INTO dispatch (EVENT_ID) VALUES (NEW.EVENT_ID);
-          RETURN NEW;
-        END;
-    $$ LANGUAGE plpgsql;
+CREATE INDEX IF NOT EXISTS dispatch_claim ON dispatch (EVENT_NAME, TIME)
+  WHERE NOT TAKEN;
+
+-- Function add_to_dispatch and trigger to_dispatch which fill dispatch table
+-- are created by PGSQLAppendOnlyStore from its list of events which aren't
+-- dispatched, when services start.
 
-CREATE TRIGGER to_dispatch
-    AFTER INSERT ON events
-    FOR EACH ROW EXECUTE PROCEDURE add_to_dispatch();
\ No newline at end of file
+CREATE TABLE IF NOT EXISTS aggregate_snapshot (
+  AGGREGATE_ID TEXT PRIMARY KEY,
+  EVENT_ID BIGINT NOT NULL,
+  SNAPSHOT BYTEA NOT NULL,
+  APPLIED BIGINT[]
+);
+ALTER TABLE aggregate_snapshot ADD COLUMN IF NOT EXISTS APPLIED BIGINT[];
\ No newline at end of file
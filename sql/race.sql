@@ -96,16 +96,45 @@ SELECT * FROM PARAGLIDER WHERE ID=%s;
 -- Insert paraglider
 INSERT INTO PARAGLIDER VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
 
--- Select current_race_by_tracker
+-- Select devices_of_races
 SELECT
-  r.race_id, p.contest_number
+  t.device_id, r.race_id, p.contest_number, r.start_time,
+  r.end_time + 7*3600
 FROM
   race r,
-  paraglider p
+  paraglider p,
+  tracker t
 WHERE
   r.id = p.id AND
-  p.tracker_id = (select tracker_id from tracker where device_id=%s) AND
-  %s BETWEEN r.start_time AND r.end_time + 7*3600;
+  p.tracker_id = t.tracker_id AND
+  r.end_time + 7*3600 >= %s;
+
+-- Select devices_of_race
+SELECT
+  t.device_id, r.race_id, p.contest_number, r.start_time,
+  r.end_time + 7*3600
+FROM
+  race r,
+  paraglider p,
+  tracker t
+WHERE
+  r.id = p.id AND
+  p.tracker_id = t.tracker_id AND
+  r.race_id = %s;
+
+-- Select races_of_device
+SELECT
+  t.device_id, r.race_id, p.contest_number, r.start_time,
+  r.end_time + 7*3600
+FROM
+  race r,
+  paraglider p,
+  tracker t
+WHERE
+  r.id = p.id AND
+  p.tracker_id = t.tracker_id AND
+  t.device_id = %s AND
+  r.end_time + 7*3600 >= %s;
 
 
 -- select transport
@@ -26,11 +26,25 @@ CREATE TABLE TRACK_DATA(
 	DISTANCE INTEGER ,
 
   PRIMARY KEY (TIMESTAMP, ID)
-);
+) PARTITION BY RANGE (TIMESTAMP);
+-- Monthly partitions track_data_YYYYMM are created by TrackRepository, see
+-- gorynych/processor/infrastructure/partitions.py.
+
+-- Downsampled track_data: points with minimal and maximal altitude of every
+-- LEVEL seconds of track (see DownsamplingPyramid).
+CREATE TABLE TRACK_DATA_LOD(
+  LEVEL SMALLINT,
+	ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,
+	TIMESTAMP INTEGER,
+	LAT DOUBLE PRECISION ,
+	LON DOUBLE PRECISION ,
+	ALT SMALLINT ,
+	G_SPEED REAL,
+	V_SPEED REAL,
+	DISTANCE INTEGER ,
 
-CREATE INDEX track_data_timestamp_idx
-  ON track_data
-  USING btree (timestamp);
+  PRIMARY KEY (LEVEL, TIMESTAMP, ID)
+);
 
 CREATE TABLE TRACK_SNAPSHOT(
   ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,
@@ -40,6 +54,20 @@ CREATE TABLE TRACK_SNAPSHOT(
   PRIMARY KEY (ID, TIMESTAMP)
 );
 
+-- Newest point and last three snapshots of every track.
+CREATE TABLE TRACK_LAST_STATE(
+  ID INT PRIMARY KEY REFERENCES TRACK(ID) ON DELETE CASCADE ,
+	TIMESTAMP INTEGER ,
+	LAT DOUBLE PRECISION ,
+	LON DOUBLE PRECISION ,
+	ALT SMALLINT ,
+	G_SPEED REAL,
+	V_SPEED REAL,
+	DISTANCE INTEGER ,
+	SNAPSHOT_TIMES INTEGER[] ,
+	SNAPSHOTS TEXT[]
+);
+
 CREATE TABLE TRACKS_GROUP(
   GROUP_ID TEXT ,
   TRACK_ID INT REFERENCES TRACK(ID) ON DELETE CASCADE ,